@@ -1,4 +1,6 @@
+import json
 import os
+import time
 from subprocess import Popen, PIPE
 from os import mkdir, path
 from argparse import ArgumentParser
@@ -106,6 +108,202 @@ class Benchmarker:
         return filename
 
 
+class ExtractionBenchmark:
+    """
+    Micro-benchmark: reading the statistics of fitted per-taxon models from a rendered summary table versus directly
+    from the result objects (LinDAFit.extract).
+    """
+
+    def __init__(self, taxa: int = 200, samples: int = 100, groups: int = 20):
+        import numpy as np
+        import pandas as pd
+
+        rng = np.random.default_rng(0)
+        self.Z = pd.DataFrame({"grp": rng.choice(["a", "b"], samples), "age": rng.normal(size=samples),
+                               "subject": rng.integers(0, groups, samples)})
+        self.W = pd.DataFrame(rng.normal(size=(samples, taxa)))
+
+        print("Extraction micro-benchmark, %d taxa, %d samples" % (taxa, samples))
+        for name, fit in [("ols", self.fit_ols), ("mixedlm", self.fit_mixed)]:
+            # separate fits, statsmodels caches bse and p-values on first access
+            summary = self.timing([fit(col) for col in self.W.columns], self.from_summary)
+            direct = self.timing([fit(col) for col in self.W.columns], self.direct)
+            print("%-8s summary table: %8.1f us/taxon, direct: %6.1f us/taxon, saving: %8.1f us/taxon (%.0fx)" %
+                  (name, summary, direct, summary - direct, summary / direct))
+
+    def fit_ols(self, col):
+        import statsmodels.formula.api as smf
+        Wcol = self.W[col]
+        return smf.ols("Wcol ~ grp + age", data=self.Z).fit()
+
+    def fit_mixed(self, col):
+        import warnings
+        import statsmodels.formula.api as smf
+        Wcol = self.W[col]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return smf.mixedlm("Wcol ~ grp + age", data=self.Z, groups=self.Z["subject"]).fit()
+
+    @staticmethod
+    def from_summary(result):
+        import pandas as pd
+        from io import StringIO
+        table = result.summary().tables[1]
+        if isinstance(table, pd.DataFrame):  # MixedLM, already a table of formatted strings
+            return table.loc[result.model.exog_names].apply(pd.to_numeric, errors="coerce")
+        return pd.read_html(StringIO(str(table.as_html())), header=0, index_col=0)[0]
+
+    @staticmethod
+    def direct(result):
+        from gLinDA.lib.linda_fit import LinDAFit
+        return LinDAFit.extract(result)
+
+    @staticmethod
+    def timing(results: list, func) -> float:
+        start = time.perf_counter()
+        for result in results:
+            func(result)
+        return (time.perf_counter() - start) / len(results) * 1e6
+
+
+class SuiteBenchmark:
+    """
+    In-process benchmark: times LinDA.run_local, LinDA.run_sl (per peer) and LinDA.run_sl_avg on synthetic data over a
+    grid of taxa, samples and sparsity and writes the timings as JSON (benchmark.json). The stages of run_local (table
+    reading, preprocessing, fit, ...) are timed by the profiler, so parsing and compute are reported separately.
+    Failed runs (no results) are reported as failed instead of a timing. The S-5000 example serves as golden
+    correctness check.
+    """
+
+    golden: dict = {"config": os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "s5000.ini"),
+                    "variable": "grp", "results": 500, "rejects": 74}
+    formula: str = "~ grp + cov1"
+
+    def __init__(self, taxa: list, samples: list, sparsity: list, peers: list, repeats: int = 3,
+                 output: str = "benchmark", seed: int = 0):
+        import platform
+        import tempfile
+        import numpy as np
+        from gLinDA.lib.config import Config
+
+        self.repeats = max(1, repeats)
+        self.peers = [p for p in peers if p > 1]
+        self.linda = dict(Config(check_sanity=False).get()["LINDA"], formula=self.formula, cache=False)
+        report = {"python": platform.python_version(), "numpy": np.__version__, "repeats": self.repeats,
+                  "golden": self.golden_check(), "grid": []}
+        print("Golden check: %s" % report["golden"]["status"])
+
+        with tempfile.TemporaryDirectory() as directory:
+            for n_taxa in taxa:
+                for n_samples in samples:
+                    for zeros in sparsity:
+                        point = self.measure(directory, n_taxa, n_samples, zeros, seed)
+                        report["grid"].append(point)
+                        print("Taxa: %d, Samples: %d, Sparsity: %.2f, run_local: %s%s" % (
+                            n_taxa, n_samples, zeros, self.describe(point["run_local"]),
+                            "".join(", run_sl (%d peers): %s, run_sl_avg: %s" % (
+                                p, self.describe(point["peers"][str(p)]["run_sl"]),
+                                self.describe(point["peers"][str(p)]["run_sl_avg"])) for p in self.peers)))
+
+        if not path.exists(output):
+            os.makedirs(output)
+        with open(path.join(output, "benchmark.json"), "w") as file:
+            json.dump(report, file, indent=2)
+
+    def measure(self, directory: str, taxa: int, samples: int, sparsity: float, seed: int) -> dict:
+        from gLinDA.lib.linda import LinDA
+        from gLinDA.lib.linda_profile import LinDAProfiler
+        from gLinDA.lib.errors import LindaInternalError
+        from gLinDA.lib.synthetic import SyntheticData
+
+        feature, meta, differential = SyntheticData.generate(taxa, samples, sparsity, seed=seed)
+        name = "t%d_s%d_z%d" % (taxa, samples, round(sparsity * 100))
+        cfg = dict(self.linda, **SyntheticData.write(directory, feature, meta, name))
+        point = {"taxa": taxa, "samples": samples, "sparsity": sparsity, "differential": len(differential)}
+
+        timings, stages = [], []
+        for i in range(self.repeats):
+            LinDAProfiler.enable(memory=False)
+            start = time.perf_counter()
+            results = LinDA.run_local(cfg)
+            seconds = time.perf_counter() - start
+            summary = LinDAProfiler.disable().summary()
+            if not len(results):
+                break
+            timings.append(seconds)
+            stages.append(summary)
+        point["run_local"] = self.statistics(timings) if len(results) else self.failed("run_local without results")
+        point["stages"] = {stage: self.statistics([s[stage]["wall"] for s in stages if stage in s])
+                           for stage in (stages[0] if len(stages) and len(results) else [])}
+        rejects = set(results["grp[T.control]"].index[results["grp[T.control]"]["reject"]]) if len(results) else set()
+        point["rejects"] = {"total": len(rejects), "true": len(rejects & set(differential))}
+
+        point["peers"] = {}
+        for peers in self.peers:
+            configurations = [dict(self.linda, **SyntheticData.write(directory, f, m, "%s_p%d_%d" % (name, peers, k)))
+                              for k, (f, m) in enumerate(SyntheticData.split(feature, meta, peers, seed))]
+            sl_timings, avg_timings, failure = [], [], None
+            for i in range(self.repeats):
+                parameters = {}
+                for k, peer in enumerate(configurations):
+                    start = time.perf_counter()
+                    try:
+                        parameters[k] = LinDA.run_sl(peer)
+                    except LindaInternalError as e:
+                        failure = {"run_sl": self.failed("peer %d: %s" % (k, e))}
+                        break
+                    sl_timings.append(time.perf_counter() - start)
+                if failure is not None:
+                    break
+                start = time.perf_counter()
+                averaged = LinDA.run_sl_avg(parameters, self.formula, not self.linda["intersection"],
+                                            self.linda["modeest_bins"])
+                seconds = time.perf_counter() - start
+                if not len(averaged):
+                    failure = {"run_sl": self.statistics(sl_timings),
+                               "run_sl_avg": self.failed("run_sl_avg without results")}
+                    break
+                avg_timings.append(seconds)
+            point["peers"][str(peers)] = dict({"run_sl": self.failed("not run"), "run_sl_avg": self.failed("not run")},
+                                              **failure) if failure is not None else {
+                "run_sl": self.statistics(sl_timings), "run_sl_avg": self.statistics(avg_timings)}
+        return point
+
+    def golden_check(self) -> dict:
+        """
+        Runs the S-5000 example, expecting 500 results and 74 rejects for grp.
+        """
+        from gLinDA.lib.config import Config
+        from gLinDA.lib.linda import LinDA
+
+        # the table paths of the example configurations are relative to the repository
+        root = path.dirname(path.abspath(__file__))
+        cfg = dict(Config(ini_path=self.golden["config"], check_sanity=False).get()["LINDA"])
+        for table in ["feature_table", "meta_table"]:
+            cfg[table] = path.join(root, cfg[table])
+            if not path.exists(cfg[table]):
+                return {"status": "skipped", "reason": "%s is missing" % cfg[table]}
+        start = time.perf_counter()
+        results = LinDA.run_local(cfg).get(self.golden["variable"], [])
+        seconds = time.perf_counter() - start
+        found = {"results": len(results), "rejects": int(results["reject"].sum()) if len(results) else 0}
+        passed = found["results"] == self.golden["results"] and found["rejects"] == self.golden["rejects"]
+        return dict(found, status="passed" if passed else "failed", seconds=seconds)
+
+    @staticmethod
+    def statistics(timings: list) -> dict:
+        import numpy as np
+        return {"min": min(timings), "median": float(np.median(timings)), "max": max(timings), "runs": len(timings)}
+
+    @staticmethod
+    def failed(reason: str) -> dict:
+        return {"failed": True, "reason": reason}
+
+    @staticmethod
+    def describe(statistics: dict) -> str:
+        return "failed" if statistics.get("failed") else "%.3f s" % statistics["median"]
+
+
 def main():
     """
     Parses arguments
@@ -116,8 +314,22 @@ def main():
     parser.add_argument("-configs", nargs="+",
                         help="A list of configuration files")
     parser.add_argument("--output", type=str, default="benchmark", help="directory to store all results")
+    parser.add_argument("--micro", type=str, default=None, choices=["extraction"],
+                        help="run a micro-benchmark instead of the peer benchmark")
+    parser.add_argument("--suite", default=False, action="store_true",
+                        help="in-process benchmark on synthetic data, writes benchmark.json to the output directory")
+    parser.add_argument("--taxa", nargs="+", type=int, default=[500, 2000], help="suite: numbers of taxa")
+    parser.add_argument("--samples", nargs="+", type=int, default=[100, 400], help="suite: numbers of samples")
+    parser.add_argument("--sparsity", nargs="+", type=float, default=[0.6], help="suite: fractions of zero counts")
+    parser.add_argument("--repeats", type=int, default=3, help="suite: repetitions per measurement")
     args = parser.parse_args()
-    Benchmarker(args)
+    if args.micro == "extraction":
+        ExtractionBenchmark()
+    elif args.suite:
+        SuiteBenchmark(args.taxa, args.samples, args.sparsity, [int(x) for x in args.peers or ["1", "2", "4"]],
+                       args.repeats, args.output)
+    else:
+        Benchmarker(args)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
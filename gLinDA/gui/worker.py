@@ -3,6 +3,7 @@ from PyQt6 import QtCore
 from gLinDA.lib.errors import LindaInternalError, GlindaP2PError
 from gLinDA.lib.p2p import Runner
 from gLinDA.lib.linda import LinDA
+from gLinDA.lib.linda_wire import LinDAWire
 
 
 class gLinDALocalWorker(QtCore.QObject):
@@ -77,10 +78,14 @@ class gLinDAP2PWorker(QtCore.QObject):
             p2p = Runner(self.config["P2P"])
 
             self.progress.emit(2)
-            replies: dict = p2p.broadcast_obj(params)
+            if cfg["federation"] == "exact":
+                replies: dict = p2p.broadcast(params, bytes, bytes, False)
+            else:
+                replies: dict = p2p.broadcast(params, lambda c: LinDAWire.encode(c, cfg["precision"]),
+                                              LinDAWire.decode, False)
             replies.update({0: params})
 
-            results = linda.run_sl_avg(replies, cfg["formula"], not cfg["intersection"])
+            results = linda.run_sl_merge(replies, cfg)
 
         except LindaInternalError as e:
             results: dict = {"ERROR": e}
@@ -17,13 +17,53 @@ class Arguments:
         parser.add_argument("-t", "--test", type=str, default=None, help="Developers")
         parser.add_argument('-v', '--verbose', action='count',
                             help="Enables verbose mode, repeat v for a higher verbose level")
+        parser.add_argument("--chunk-size", type=int, default=None,
+                            help="Bytes per frame of the P2P protocol, negotiated with every peer (64 KB - 4 MB)")
+        parser.add_argument("--transport", type=str, default=None, choices=["threads", "asyncio"],
+                            help="P2P transport: a server thread with a blocking client or one asyncio event loop")
+        parser.add_argument("--timeout", type=float, default=None,
+                            help="Seconds per network operation of the asyncio transport, 0 waits without a limit")
+        parser.add_argument("--compression", type=str, default=None, choices=["none", "zlib", "lzma", "bz2"],
+                            help="Compression of the P2P payloads before their encryption")
+        parser.add_argument("--compression-level", type=int, default=None, help="Compression level, 0 - 9")
         parser.add_argument("--ignore-keys", default=False, action='store_true',
                             help="Ignores wrong keys. Will not stop execution if wrong password communication are appearing")
         parser.add_argument("--intersection", default=False, action='store_true',
                             help="Use only intersection of commonly existing features instead the union")
+        parser.add_argument("--federation", type=str, default=None, choices=["average", "exact"],
+                            help="Averages the local fits or pools their sufficient statistics for an exact fit")
+        parser.add_argument("--precision", type=str, default=None, choices=["float64", "float32"],
+                            help="Precision of the coefficients sent to the peers, float32 halves the payload")
         parser.add_argument("--config", type=str, help="path to config file")
         parser.add_argument("--standalone", default=False, action='store_true', help="Forces to run gLinDA in the solo mode")
         parser.add_argument("--output", type=str, default="", help="path to an output directory")
+        parser.add_argument("--engine", type=str, default=None, choices=["batched", "statsmodels"],
+                            help="Model engine for the per-taxon models, batched least squares or statsmodels")
+        parser.add_argument("--n-jobs", type=int, default=None,
+                            help="Number of worker processes for the per-taxon models, 0 uses all cores")
+        parser.add_argument("--backend", type=str, default=None, choices=["serial", "process"],
+                            help="Execution backend for the per-taxon models")
+        parser.add_argument("--modeest-bins", type=int, default=None,
+                            help="Number of histogram bins of the mode estimation, 0 uses the exact estimation")
+        parser.add_argument("--sparse", default=False, action='store_true',
+                            help="Loads and filters the feature table as a sparse matrix")
+        parser.add_argument("--formulas", nargs="+", default=None,
+                            help="Batch mode: runs every formula on the same tables and preprocessing, e.g. "
+                                 "--formulas \"~ grp\" \"~ grp + age\"")
+        parser.add_argument("--memory-budget", type=float, default=None,
+                            help="Memory budget in MB, streams the feature table from disk in blocks (out-of-core)")
+        parser.add_argument("--profile", default=False, action='store_true',
+                            help="Records time and memory of the pipeline stages, written to profile.json")
+        parser.add_argument("--state", type=str, default=None,
+                            help="Incremental mode: adds the samples to this state file and reports stale stages")
+        parser.add_argument("--cache", default=False, action='store_true',
+                            help="Keeps binary copies of the parsed tables in the cache directory")
+        parser.add_argument("--stage-cache", default=False, action='store_true',
+                            help="Keeps the outputs of the pipeline stages in the cache directory for reruns")
+        parser.add_argument("--no-cache", default=False, action='store_true',
+                            help="Disables both caches, overrides --cache, --stage-cache and the configuration file")
+        parser.add_argument("--clear-cache", default=False, action='store_true',
+                            help="Removes all entries of the table cache before running")
         self.__args = parser.parse_args()
 
     def get_args(self):
@@ -17,12 +17,18 @@ class Config:
             "verbose": 0,
             "asymmetric": True,
             "solo_mode": False,
+            "chunk_size": 1048576,  # bytes per frame, negotiated with every peer (64 KB - 4 MB)
+            "transport": "threads",  # threads (server thread and blocking client) or asyncio
+            "compression": "none",  # codec of the payloads (none, zlib, lzma, bz2), peers decode every codec
+            "compression_level": 6,
+            "timeout": 300,  # seconds per network operation (asyncio) and waiting for a busy peer, 0 = no limit
             "ignore_keys": False,  # only for internal use
             "test": None,          # only for internal use
             "resolve_host": True,  # only for internal use
         },
         "LINDA": {
             "formula": "",
+            "formulas": [],  # batch mode, one result set per formula
             "feature_table": "",
             "feature_index": "",
             "feature_transpose": False,
@@ -40,9 +46,30 @@ class Config:
             "winsor": True,
             "adaptive": True,
             "intersection": False,
+            "federation": "average",  # average of the local fits or exact (pooled sufficient statistics)
+            "precision": "float64",  # of the coefficients sent to the peers (float64 or float32)
             "output": "",
+            "engine": "batched",
+            "n_jobs": 1,
+            "backend": "serial",
+            "modeest_bins": 0,
+            "sparse": False,
+            "cache": False,  # binary copies of the parsed tables in cache_dir (default ~/.cache/glinda)
+            "stage_cache": False,  # outputs of the pipeline stages (count and CLR matrices) in cache_dir/stages
+            "cache_dir": "",
+            "cache_size": 2048,  # MB
+            "clear_cache": False,
+            "memory_budget": 0,  # MB, 0 keeps all data in memory
+            "profile": False,  # writes the timings of the pipeline stages to profile.json
+            "state": "",  # incremental mode: state file with the statistics of the samples analysed so far
         }
     }
+    engines: list = ["batched", "statsmodels"]
+    backends: list = ["serial", "process"]
+    federations: list = ["average", "exact"]
+    precisions: list = ["float64", "float32"]
+    transports: list = ["threads", "asyncio"]
+    compressions: list = ["none", "zlib", "lzma", "bz2"]
     ip_filter: list = ["localhost", "127.0.0.1", "::1"]
     msg: str = ""
 
@@ -66,6 +93,37 @@ class Config:
                 self.config["LINDA"]["output"] = arguments.output
             if arguments.standalone:
                 self.config["P2P"]["solo_mode"] = True
+            if getattr(arguments, "engine", None) is not None:
+                self.config["LINDA"]["engine"] = arguments.engine
+            if getattr(arguments, "n_jobs", None) is not None:
+                self.config["LINDA"]["n_jobs"] = arguments.n_jobs
+            if getattr(arguments, "backend", None) is not None:
+                self.config["LINDA"]["backend"] = arguments.backend
+            if getattr(arguments, "modeest_bins", None) is not None:
+                self.config["LINDA"]["modeest_bins"] = arguments.modeest_bins
+            if getattr(arguments, "sparse", False):
+                self.config["LINDA"]["sparse"] = True
+            if getattr(arguments, "cache", False):
+                self.config["LINDA"]["cache"] = True
+            if getattr(arguments, "stage_cache", False):
+                self.config["LINDA"]["stage_cache"] = True
+            if getattr(arguments, "no_cache", False):
+                self.config["LINDA"]["cache"] = False
+                self.config["LINDA"]["stage_cache"] = False
+            if getattr(arguments, "formulas", None):
+                self.config["LINDA"]["formulas"] = arguments.formulas
+            if getattr(arguments, "memory_budget", None) is not None:
+                self.config["LINDA"]["memory_budget"] = arguments.memory_budget
+            if getattr(arguments, "clear_cache", False):
+                self.config["LINDA"]["clear_cache"] = True
+            if getattr(arguments, "profile", False):
+                self.config["LINDA"]["profile"] = True
+            if getattr(arguments, "state", None) is not None:
+                self.config["LINDA"]["state"] = arguments.state
+            if getattr(arguments, "federation", None) is not None:
+                self.config["LINDA"]["federation"] = arguments.federation
+            if getattr(arguments, "precision", None) is not None:
+                self.config["LINDA"]["precision"] = arguments.precision
 
         self.cast_parameters()
         if self.config["P2P"]["resolve_host"] and self.config["P2P"]["resolve_host"] is not None:
@@ -91,6 +149,9 @@ class Config:
         self.config["P2P"]["ignore_keys"] = self._cast_bool(self.config["P2P"]["ignore_keys"])
         self.config["P2P"]["asymmetric"] = self._cast_bool(self.config["P2P"]["asymmetric"])
         self.config["P2P"]["solo_mode"] = self._cast_bool(self.config["P2P"]["solo_mode"])
+        self.config["P2P"]["chunk_size"] = int(self.config["P2P"]["chunk_size"])
+        self.config["P2P"]["timeout"] = self._cast_float(self.config["P2P"]["timeout"])
+        self.config["P2P"]["compression_level"] = int(self.config["P2P"]["compression_level"])
 
         self.config["LINDA"]["feature_transpose"] = self._cast_bool(self.config["LINDA"]["feature_transpose"])
         self.config["LINDA"]["winsor"] = self._cast_bool(self.config["LINDA"]["winsor"])
@@ -104,10 +165,26 @@ class Config:
         self.config["LINDA"]["pseudo_count"] = self._cast_float(self.config["LINDA"]["pseudo_count"])
 
         self.config["LINDA"]["intersection"] = self._cast_bool(self.config["LINDA"]["intersection"])
+        self.config["LINDA"]["sparse"] = self._cast_bool(self.config["LINDA"]["sparse"])
+        self.config["LINDA"]["cache"] = self._cast_bool(self.config["LINDA"]["cache"])
+        self.config["LINDA"]["stage_cache"] = self._cast_bool(self.config["LINDA"]["stage_cache"])
+        self.config["LINDA"]["clear_cache"] = self._cast_bool(self.config["LINDA"]["clear_cache"])
+        self.config["LINDA"]["cache_size"] = self._cast_float(self.config["LINDA"]["cache_size"])
+        self.config["LINDA"]["memory_budget"] = self._cast_float(self.config["LINDA"]["memory_budget"])
+        self.config["LINDA"]["profile"] = self._cast_bool(self.config["LINDA"]["profile"])
+
+        if type(self.config["LINDA"]["formulas"]) is str:
+            self.config["LINDA"]["formulas"] = [f.strip() for f in self.config["LINDA"]["formulas"].split(";")
+                                                if len(f.strip())]
 
         if type(self.config["LINDA"]["verbose"]) is str:
             self.config["LINDA"]["verbose"] = int(self.config["LINDA"]["verbose"])
 
+        if type(self.config["LINDA"]["n_jobs"]) is str:
+            self.config["LINDA"]["n_jobs"] = int(self.config["LINDA"]["n_jobs"])
+
+        self.config["LINDA"]["modeest_bins"] = self._cast_int(self.config["LINDA"]["modeest_bins"])
+
     def __resolve_host(self, include_own_host: bool = False) -> bool:
         """
         Try to resolve a fitting host from all peers based on the own available own ip addresses.
@@ -205,7 +282,37 @@ class Config:
         if not self.__check_path("meta_table"):
             return False
 
-        if not len(self.config["LINDA"]["formula"]):
+        if self.config["LINDA"]["engine"] not in self.engines:
+            self.msg = "Config: Unknown engine %s, expecting one of %s" % (self.config["LINDA"]["engine"],
+                                                                           self.engines)
+            print(self.msg)
+            return False
+
+        if self.config["LINDA"]["backend"] not in self.backends:
+            self.msg = "Config: Unknown backend %s, expecting one of %s" % (self.config["LINDA"]["backend"],
+                                                                            self.backends)
+            print(self.msg)
+            return False
+
+        if self.config["LINDA"]["federation"] not in self.federations:
+            self.msg = "Config: Unknown federation %s, expecting one of %s" % (self.config["LINDA"]["federation"],
+                                                                               self.federations)
+            print(self.msg)
+            return False
+
+        if self.config["LINDA"]["precision"] not in self.precisions:
+            self.msg = "Config: Unknown precision %s, expecting one of %s" % (self.config["LINDA"]["precision"],
+                                                                              self.precisions)
+            print(self.msg)
+            return False
+
+        if type(self.config["LINDA"]["modeest_bins"]) is not int or self.config["LINDA"]["modeest_bins"] < 0:
+            self.msg = ("Config: modeest_bins (%s) should be an integer, 0 or bigger" %
+                        self.config["LINDA"]["modeest_bins"])
+            print(self.msg)
+            return False
+
+        if not len(self.config["LINDA"]["formula"]) and not len(self.config["LINDA"]["formulas"]):
             self.msg = "Config: Formula is missing"
             print(self.msg)
             return False
@@ -215,6 +322,18 @@ class Config:
         if self.config["P2P"]["solo_mode"] is not None and self.config["P2P"]["solo_mode"]:
             return True
 
+        if self.config["P2P"]["transport"] not in self.transports:
+            self.msg = "Config: Unknown transport %s, expecting one of %s" % (self.config["P2P"]["transport"],
+                                                                              self.transports)
+            print(self.msg)
+            return False
+
+        if self.config["P2P"]["compression"] not in self.compressions:
+            self.msg = "Config: Unknown compression %s, expecting one of %s" % (self.config["P2P"]["compression"],
+                                                                                self.compressions)
+            print(self.msg)
+            return False
+
         if self.config["P2P"]["password"] is None or len(self.config["P2P"]["password"]) == 0:
             self.msg = "Config: Can not run without a common password."
             print(self.msg)
@@ -321,6 +440,18 @@ class Config:
         else:
             return 0.0
 
+    @staticmethod
+    def _cast_int(value):
+        """
+        Cast a (string) value to an integer, keeps the value if it is none, the sanity check reports it
+        :param value: the value
+        :return: an integer or the unchanged value
+        """
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+
     @staticmethod
     def _config_parser(config_file_path: str) -> dict:
         """
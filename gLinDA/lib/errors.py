@@ -16,3 +16,7 @@ class LindaWrongData(LindaInternalError):
 
 class GlindaP2PError(Exception):
     pass
+
+
+class GlindaP2PProtocolError(GlindaP2PError):
+    pass
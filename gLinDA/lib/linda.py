@@ -2,11 +2,23 @@ import pandas as pd
 import numpy as np
 import statsmodels.formula.api as smf
 import statsmodels.stats.multitest as mult
+import bz2
+import csv
+import gzip
+import lzma
 import math
+import os
+import re
+import tempfile
 import scipy as sp
-from io import StringIO
 
 from gLinDA.lib.errors import LindaInternalError, LindaWrongData
+from gLinDA.lib.linda_cache import MemoryStageCache, StageCache, TableCache
+from gLinDA.lib.linda_federation import LinDAFederation
+from gLinDA.lib.linda_incremental import LinDAIncremental
+from gLinDA.lib.linda_fit import LinDAFit
+from gLinDA.lib.linda_prep import LinDAPrep
+from gLinDA.lib.linda_profile import LinDAProfiler
 
 __version__ = "1.0.0"
 __author__ = "Leon Fehse, Mohammad Tajabadi, Roman Martin"
@@ -15,98 +27,232 @@ __credits__ = "Heinrich Heine University Düsseldorf"
 
 class LinDA:
 
+    index_columns: list = ["ID", "id", "SampleID", "Sample", "sample", "sample_name"]
+    feature_dtypes: dict = {"count": np.int32, "proportion": np.float64}
+    compressions: dict = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
     @staticmethod
-    def default_shorth(x):
-        ny = len(x)
+    def shorth(X):
+        """
+        Midpoint (mean) of the shortest half of each column, ties are resolved by the mean of their positions.
+        :param X: array (values x variables)
+        :return: array (variables)
+        """
+        ny = X.shape[0]
         k = math.ceil(ny / 2) - 1
-        y = sorted(x)
-        inf = y[:(ny - k)]
-        sup = y[k:]
-        diffs = np.array(sup) - np.array(inf)
-        i = np.where(diffs == min(diffs))
-        if len(i[0]) > 1:
-            i = math.floor(np.mean(i[0]))
-        else:
-            i = i[0][0]
-        M = np.mean(y[i:(i + k + 1)])
-        return M
+        Y = np.sort(X, axis=0)
+        diffs = Y[k:] - Y[:(ny - k)]
+        ties = diffs == diffs.min(axis=0)
+        i = np.floor((ties * np.arange(ny - k)[:, None]).sum(axis=0) / ties.sum(axis=0)).astype(int)
+        window = i[None, :] + np.arange(k + 1)[:, None]
+        return np.take_along_axis(Y, window, axis=0).mean(axis=0)
 
     @staticmethod
-    def bw_nrd0(x): # https://stackoverflow.com/questions/45193294/show-more-significant-figures-of-coefficients
-        if len(x) < 2:
+    def bandwidth_nrd0(X):
+        """
+        Rule-of-thumb bandwidth of a Gaussian kernel (bw.nrd0 of R) for each column of X.
+        """
+        if X.shape[0] < 2:
             raise (Exception("need at least 2 data points"))
 
-        hi = np.std(x, ddof=1)
-        q75, q25 = np.percentile(x, [75, 25])
-        iqr = q75 - q25
-        lo = min(hi, iqr / 1.34)
-        lo = lo or hi or abs(x[0]) or 1
+        hi = np.std(X, axis=0, ddof=1)
+        q75, q25 = np.percentile(X, [75, 25], axis=0)
+        lo = np.minimum(hi, (q75 - q25) / 1.34)
+        lo = np.where(lo != 0, lo, np.where(hi != 0, hi, np.where(X[0] != 0, np.abs(X[0]), 1)))
 
-        return 0.9 * lo * len(x) ** -0.2
+        return 0.9 * lo * X.shape[0] ** -0.2
 
     @staticmethod
-    def default_mean_shift_modeest(x):
-        par = LinDA.default_shorth(x)
-        bw = LinDA.bw_nrd0(x)
+    def mean_shift_modeest(X, bins: int = 0):
+        """
+        Mean-shift mode estimation with a Gaussian kernel for all columns of X at once, starting from the shorth.
+        Converged columns are frozen, the others continue until the tolerance or 1000 iterations are reached.
+
+        With bins > 0 and more values than bins, the iterations run on a histogram of each column (bin centers weighted
+        by counts) instead of all values, as long as the bins are narrower than half the kernel bandwidth. Binning
+        moves every value by at most half a bin width, (max - min) / (2 * bins), each mean-shift step is therefore
+        within that distance of the exact step. For a peaked mode the estimate stays within one bin width of the
+        exact estimate; 4096 bins keep the error below 1/4096 of the range.
+        :param X: array (values x variables) or a single vector
+        :param bins: number of bins for the approximate mode, 0 for the exact estimation
+        :return: the modes and the number of iterations, arrays (variables)
+        """
+        X = np.asarray(X, dtype=float)
+        if X.ndim == 1:
+            X = X[:, None]
+        par = LinDA.shorth(X)
+        bw = LinDA.bandwidth_nrd0(X)
         tolerance = math.sqrt(np.finfo(float).eps)
-        iter = 1000
-        s = 0
-        for j in range(iter):
-            z = (x - par) / bw
-            k = sp.stats.norm.pdf(z)
-            M = np.dot(x, k) / np.sum(k)
-            th = abs(M / par - 1)
-            if th < tolerance:
-                s = j
+        iterations = np.ones(X.shape[1], dtype=int)
+
+        lower, upper = X.min(axis=0), X.max(axis=0)
+        width = np.where(upper > lower, (upper - lower) / max(bins, 1), 1.0)
+        if 0 < bins < X.shape[0] and (width < bw / 2).all():
+            index = np.minimum(((X - lower) / width).astype(int), bins - 1)
+            points = lower + (np.arange(bins)[:, None] + 0.5) * width
+            weights = np.zeros((bins, X.shape[1]))
+            np.add.at(weights, (index, np.broadcast_to(np.arange(X.shape[1]), X.shape)), 1)
+        else:
+            points = X
+            weights = np.ones_like(X)
+
+        active = np.arange(X.shape[1])
+        for j in range(1000):
+            z = (points[:, active] - par[active]) / bw[active]
+            k = weights[:, active] * np.exp(-0.5 * z * z)
+            M = (points[:, active] * k).sum(axis=0) / k.sum(axis=0)
+            converged = np.abs(M / par[active] - 1) < tolerance
+            iterations[active[converged]] = j + 1
+            par[active[~converged]] = M[~converged]
+            active = active[~converged]
+            if not len(active):
                 break
-            par = M
-        return par, s + 1
+        return par, iterations
 
     @staticmethod
     def windsor_dedup(P, Y, quan):
-        cut = P.quantile(q=quan, axis=1)
-        empty_arr = np.empty((len(Y.index.values), len(Y.columns.values)))
-        for row, cutval in zip(empty_arr, cut):
-            row.fill(cutval)
-        ind = P > empty_arr
-        temp = np.where(ind)
-        cols = temp[1]
-        rows = temp[0]
-        for row_i, col_j in zip(rows, cols):
-            P.iloc[row_i, col_j] = empty_arr[row_i, col_j]
-        return P, Y
+        values = P.to_numpy(dtype=float, copy=True)
+        LinDAPrep.winsorize(values, quan, "proportion")
+        return pd.DataFrame(values, index=P.index, columns=P.columns), Y
 
     @staticmethod
     def winsor_fun(Y, quan, feature_dat_type):
+        values = Y.to_numpy(dtype=float, copy=True)
+        LinDAPrep.winsorize(values, quan, feature_dat_type)
         if feature_dat_type == "count":
-            N = Y.sum(axis=0)
-            P = Y.T.divide(N, axis=0).T
-            P, Y = LinDA.windsor_dedup(P, Y, quan)
-            Y = round(P.T.multiply(N, axis=0).T).astype(int)
-        elif feature_dat_type == "proportion":
-            X, Y = LinDA.windsor_dedup(Y, Y, quan)
+            values = values.astype(int)
+        return pd.DataFrame(values, index=Y.index, columns=Y.columns)
 
-        return Y
+    @staticmethod
+    def read_header(path: str) -> list:
+        """
+        Reads only the header of a csv file. Compressed files (.gz, .bz2, .xz) are streamed.
+        """
+        opener = LinDA.compressions.get(os.path.splitext(path)[1].lower(), open)
+        with opener(path, "rt", newline="") as f:
+            return next(csv.reader(f), [])
 
     @staticmethod
-    def read_table(path: str, col: str = "") -> pd.DataFrame:
-        if len(col):
+    def read_csv(path: str, col: str, sparse: bool = False, dtype=None, chunk_rows: int = 1000,
+                 memmap: bool = False) -> pd.DataFrame:
+        """
+        Parses a csv file once, in chunks of chunk_rows rows. Compressed files are decompressed while streaming.
+        :param path: path to the (compressed) csv file
+        :param col: the index column
+        :param sparse: returns a sparse DataFrame (fill value 0), the dense table is never held in memory at once
+        :param dtype: dtype per column, e.g. int32 for counts; None infers the dtypes
+        :param chunk_rows: number of rows per chunk
+        :param memmap: writes the chunks of a dense table to an anonymous temporary file and returns the table
+        memory-mapped, for tables larger than the memory
+        :return: the table
+        """
+        chunks = pd.read_csv(path, index_col=col, dtype=dtype, chunksize=chunk_rows)
+        if memmap and not sparse:
+            # the dtype is fixed before the first chunk, a later chunk may not narrow the values of the earlier ones
+            if dtype is None:
+                value_type = np.dtype(np.float64)
+            elif isinstance(dtype, dict):
+                value_type = np.result_type(*dtype.values())
+            else:
+                value_type = np.dtype(dtype)
+            index, rows, columns, f = [], 0, None, tempfile.TemporaryFile()
+            for chunk in chunks:
+                f.write(np.ascontiguousarray(chunk.to_numpy(), dtype=value_type).tobytes())
+                index.append(chunk.index)
+                rows += len(chunk)
+                columns = chunk.columns
+            if not rows:
+                f.close()
+                raise LindaWrongData("Error: The file %s contains no rows" % path)
+            f.flush()
+            values = np.memmap(f, dtype=value_type, mode="r", shape=(rows, len(columns)))
+            return pd.DataFrame(values, index=index[0].append(index[1:]), columns=columns, copy=False)
+        if not sparse:
+            return pd.concat(chunks)
+        index, blocks = [], []
+        for chunk in chunks:
+            if len(chunk):
+                index.append(chunk.index)
+                blocks.append(sp.sparse.csr_matrix(chunk.to_numpy()))
+                columns = chunk.columns
+        if not len(blocks):
+            raise LindaWrongData("Error: The file %s contains no rows" % path)
+        matrix = sp.sparse.vstack(blocks, format="csr")
+        matrix.eliminate_zeros()
+        return pd.DataFrame.sparse.from_spmatrix(matrix, index=index[0].append(index[1:]), columns=columns)
+
+    @staticmethod
+    def read_table(path: str, col: str = "", sparse: bool = False, dtype=None, cache: TableCache = None,
+                   memmap: bool = False) -> pd.DataFrame:
+        """
+        Reads a table, the index column is identified from the header only.
+        :param path: path to the (compressed) csv file
+        :param col: the index column, empty to use the first of the common sample id columns
+        :param sparse: returns a sparse DataFrame
+        :param dtype: compact dtype of the values, falls back to float64 if the values do not fit
+        :param cache: a TableCache for binary copies of the parsed tables, None to always parse the file
+        :param memmap: parses a dense table into a memory-mapped temporary file
+        :return: the table
+        """
+        options = {"col": col, "sparse": sparse, "dtype": None if dtype is None else np.dtype(dtype).name}
+        if cache is not None:
             try:
-                table: pd.DataFrame = pd.read_csv(path, index_col=col)
-            except ValueError as e:
-                print(e)
+                table = cache.load(path, options)
+            except OSError as e:
+                # a failing cache never fails a run
+                print("Cache: Can not read the cached table of %s: %s" % (path, e))
+                cache, table = None, None
+            if table is not None:
+                return table
+
+        header = LinDA.read_header(path)
+        if len(col):
+            if col not in header:
                 raise LindaWrongData("Error: Probably wrong index, please verify if the column %s exists in the file %s"
                                      % (col, path))
-            return table
         else:
-            for col in ["ID", "id", "SampleID", "Sample", "sample", "sample_name"]:
-                try:
-                    table: pd.DataFrame = pd.read_csv(path, index_col=col)
-                    return table
-                except ValueError:
-                    continue
+            candidates = [c for c in LinDA.index_columns if c in header]
+            if not len(candidates):
+                raise ValueError("Could not identify the index columns for %s" % path)
+            col = candidates[0]
+
+        with LinDAProfiler.stage("read table", columns=len(header) - 1) as stage:
+            try:
+                table = LinDA.read_csv(path, col, sparse, None if dtype is None else
+                                       {c: dtype for c in header if c != col}, memmap=memmap)
+            except (ValueError, OverflowError) as e:
+                if dtype is None or dtype == np.float64:
+                    raise LindaWrongData("Error: Could not parse the file %s: %s" % (path, e))
+                table = LinDA.read_csv(path, col, sparse, {c: np.float64 for c in header if c != col}, memmap=memmap)
+            stage["rows"] = len(table)
+
+        if cache is not None:
+            try:
+                cache.store(path, options, table)
+            except OSError as e:
+                print("Cache: Can not store the table of %s: %s" % (path, e))
+        return table
 
-        raise ValueError("Could not identify the index columns for %s" % path)
+    @staticmethod
+    def is_sparse(table: pd.DataFrame) -> bool:
+        return len(table.columns) > 0 and all(isinstance(dtype, pd.SparseDtype) for dtype in table.dtypes)
+
+    @staticmethod
+    def transpose(table: pd.DataFrame) -> pd.DataFrame:
+        """
+        Transposes a (sparse) table without densifying it.
+        """
+        if LinDA.is_sparse(table):
+            return pd.DataFrame.sparse.from_spmatrix(table.sparse.to_coo().T, index=table.columns, columns=table.index)
+        return table.T
+
+    @staticmethod
+    def load_feature_table(cfg: dict, cache: TableCache = None) -> pd.DataFrame:
+        feature_data = LinDA.read_table(cfg["feature_table"], cfg["feature_index"], cfg["sparse"],
+                                        LinDA.feature_dtypes.get(cfg["feature_type"]), cache, cfg["memory_budget"] > 0)
+        if cfg["feature_transpose"]:
+            feature_data = LinDA.transpose(feature_data)
+        return feature_data
 
     @staticmethod
     def split_formula(formula: str):
@@ -116,17 +262,52 @@ class LinDA:
         return all_var_formula.split()
 
     @staticmethod
-    def correct_bias(n: int, formula: str, coefficients: dict):
-        all_var = LinDA.split_formula(formula)
-
-        for key, df in coefficients.items():
-            pre_bias, iters = LinDA.default_mean_shift_modeest(math.sqrt(float(n)) * df["stat"])
-            bias = pre_bias / math.sqrt(float(n))
-            df["stat"] -= bias
-            df["stat"] /= df["stde"]
+    def parse_formula(formula: str):
+        """
+        Separates the fixed effects from a random intercept term, e.g. "~ grp + age + (1|subject)".
+        :param formula: the right-hand side of the formula
+        :return: the fixed effects formula, the fixed effect variables and the grouping variable (or None)
+        """
+        formula = formula.strip()
+        if formula.startswith("~"):
+            formula = formula[1:]
+        random_terms = re.findall(r"\(([^()|]*)\|([^()]*)\)", formula)
+        fixed_terms = [t.strip() for t in re.sub(r"\([^()|]*\|[^()]*\)", "", formula).split("+") if len(t.strip())]
+
+        groups = None
+        if len(random_terms) > 1:
+            raise LindaWrongData("Error: Only a single random effect term is supported, got %s" % formula)
+        elif len(random_terms) == 1:
+            effect, groups = random_terms[0][0].strip(), random_terms[0][1].strip()
+            if effect != "1":
+                raise LindaWrongData("Error: Only random intercepts (1|group) are supported, got (%s|%s)" %
+                                     (effect, groups))
+
+        fixed_formula = "~ " + (" + ".join(fixed_terms) if len(fixed_terms) else "1")
+        return fixed_formula, LinDA.split_formula(" + ".join(fixed_terms)), groups
 
-        dof = n - (len(all_var) + 1)
-        return coefficients, dof
+    @staticmethod
+    def correct_bias(n: int, formula: str, coefficients: dict, bins: int = 0, cache: StageCache = None):
+        with LinDAProfiler.stage("bias correction", columns=len(coefficients)) as stage:
+            fixed_formula, all_var, groups = LinDA.parse_formula(formula)
+
+            if len(coefficients):
+                key = None if cache is None else StageCache.key("bias", list(coefficients),
+                                                                list(coefficients.values()), n, bins)
+                corrected = None if cache is None else cache.load(key)
+                if corrected is None:
+                    stats = np.column_stack([df["stat"].to_numpy(dtype=float) for df in coefficients.values()])
+                    stde = np.column_stack([df["stde"].to_numpy(dtype=float) for df in coefficients.values()])
+                    stage["rows"] = len(stats)
+                    pre_biases, iters = LinDA.mean_shift_modeest(math.sqrt(float(n)) * stats, bins)
+                    corrected = {"stat": (stats - pre_biases / math.sqrt(float(n))) / stde}
+                    if cache is not None:
+                        cache.store(key, corrected)
+                for j, df in enumerate(coefficients.values()):
+                    df["stat"] = corrected["stat"][:, j]
+
+            dof = n - (len(all_var) + 1)
+            return coefficients, dof
 
     @staticmethod
     def linda_pvalues(stats, dof):
@@ -136,95 +317,78 @@ class LinDA:
 
     @staticmethod
     def linda_output(dof, coefficients):
-        output_frames = {}
-        variables = []
-        for voi in coefficients.keys():
-            pval, reject, padj = LinDA.linda_pvalues(coefficients[voi]["stat"], dof)
-            output = pd.DataFrame({
-                "base_mean": coefficients[voi]["base_mean"],
-                "stat": coefficients[voi]["stat"],
-                "stde": coefficients[voi]["stde"],
-                "pval": pval,
-                "padj": padj,
-                "reject": reject})
-            output.index = coefficients[voi].index
-            output_frames[voi] = output
-            variables.append(voi)
-
-        return output_frames
+        with LinDAProfiler.stage("output", columns=len(coefficients)) as stage:
+            output_frames = {}
+            variables = []
+            for voi in coefficients.keys():
+                pval, reject, padj = LinDA.linda_pvalues(coefficients[voi]["stat"], dof)
+                output = pd.DataFrame({
+                    "base_mean": coefficients[voi]["base_mean"],
+                    "stat": coefficients[voi]["stat"],
+                    "stde": coefficients[voi]["stde"],
+                    "pval": pval,
+                    "padj": padj,
+                    "reject": reject})
+                output.index = coefficients[voi].index
+                output_frames[voi] = output
+                stage["rows"] = len(output)
+                variables.append(voi)
+
+            return output_frames
 
     @staticmethod
     def take_avg_params(all_parameters: dict, union: bool = True):
-        models_list = []
-        weights = []
-        bias_list = []
-        id_list = []
-
-        for id_, linda_params in all_parameters.items():
-            model = linda_params["coefs"]
-            biases = linda_params["biases"]
-            id_list.append(id_)
-            weight = linda_params["size"]
-            models_list.append(model)
-            weights.append(weight)
-            bias_list.append(biases)
-
-        all_taxa = set()
-        if union:
-            for model in models_list:
-                for voi in model:
-                    all_taxa.update(model[voi].index)
-        else:  
-        
-            all_taxa = set(models_list[0][next(iter(models_list[0]))].index)
-
-            for dict in models_list[1:]:
-                indexes = set(dict[next(iter(dict))].index)
-                all_taxa.intersection_update(indexes)
-                     
-        all_taxa_list = list(all_taxa)
-        all_taxa_list = sorted(all_taxa_list)
-
-        covs = list(models_list[0].keys())
-        columns_list = models_list[0][covs[0]].columns
-
-        final_dict = {voi: pd.DataFrame(columns=columns_list, index=all_taxa_list) for voi in covs}
-
-        # checking averages
-        for voi in covs:
-            for taxa in all_taxa_list:
-                total_weighted_sum = 0
-                total_weight = 0
-                weighted_sums = {}
-                for i, model in enumerate(models_list):
-                    if voi in model and taxa in model[voi].index:
-                        taxa_sums = model[voi].loc[taxa]["taxa_sums"]
-                        for col in model[voi].columns:
-                            if col not in weighted_sums:
-                                weighted_sums[col] = 0
-                            if col == "stde" or col == "stde_avg":
-                                weighted_sums[col] += (model[voi].loc[taxa][col] * weights[i]) ** 2
-
-                            else:
-                                weighted_sums[col] += model[voi].loc[taxa][col] * weights[i]
-
-                        total_weight += weights[i]
-                for col in weighted_sums:
-                    if col == "stde" or col == "stde_avg":
-                        final_dict[voi].loc[taxa, col] = np.sqrt(weighted_sums[col]) / total_weight
-                    else:
-                        final_dict[voi].loc[taxa, col] = weighted_sums[col] / total_weight
-
-            final_dict[voi] = final_dict[voi].astype(float)
-
-            # TODO: Arsam, please check this
-            temp = final_dict[voi]
-            if ("stde_avg" in temp.columns):
-                temp["division"] = temp["stat"] / temp["stde_avg"]
+        with LinDAProfiler.stage("averaging", columns=len(all_parameters)) as stage:
+            models_list = []
+            weights = []
+
+            for id_, linda_params in all_parameters.items():
+                models_list.append(linda_params["coefs"])
+                weights.append(float(linda_params["size"]))
+
+            if union:
+                all_taxa = pd.Index([])
+                for model in models_list:
+                    for voi in model:
+                        all_taxa = all_taxa.union(pd.Index(model[voi].index).unique())
             else:
-                temp["division"] = temp["stat"] / temp["stde"]
+                all_taxa = pd.Index(models_list[0][next(iter(models_list[0]))].index).unique()
+                for model in models_list[1:]:
+                    all_taxa = all_taxa.intersection(pd.Index(model[next(iter(model))].index))
+            all_taxa = all_taxa.sort_values()
+            stage["rows"] = len(all_taxa)
+
+            covs = list(models_list[0].keys())
+            columns_list = models_list[0][covs[0]].columns
+            root_sum = columns_list.isin(["stde", "stde_avg"])
+
+            final_dict = {}
+            for voi in covs:
+                # every peer's coefficients aligned onto the common taxa index at once
+                weighted_sums = np.zeros((len(all_taxa), len(columns_list)))
+                total_weight = np.zeros(len(all_taxa))
+                for model, weight in zip(models_list, weights):
+                    if voi not in model:
+                        continue
+                    present = all_taxa.isin(model[voi].index)
+                    values = model[voi].reindex(index=all_taxa, columns=columns_list).to_numpy(dtype=float)
+                    values = np.where(present[:, None], values * weight, 0.0)
+                    values[:, root_sum] **= 2
+                    weighted_sums += values
+                    total_weight += present * weight
+
+                weighted_sums[:, root_sum] = np.sqrt(weighted_sums[:, root_sum])
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    averages = weighted_sums / total_weight[:, None]
+                final_dict[voi] = pd.DataFrame(averages, index=all_taxa, columns=columns_list)
+
+                temp = final_dict[voi]
+                if ("stde_avg" in temp.columns):
+                    temp["division"] = temp["stat"] / temp["stde_avg"]
+                else:
+                    temp["division"] = temp["stat"] / temp["stde"]
 
-        return final_dict
+            return final_dict
 
     @staticmethod
     def linda_coefficients(
@@ -243,16 +407,30 @@ class LinDA:
             pseudo_count: float = 0.5,
             corr_cut: float = 0.1,
             verbose: bool = False,
-            local: bool = True):
+            local: bool = True,
+            engine: str = "batched",
+            n_jobs: int = 1,
+            backend: str = "serial",
+            modeest_bins: int = 0,
+            memory_budget: float = 0,
+            cache: StageCache = None,
+            statistics: bool = False):
 
         return_bucket: dict = {"W": None, "Z": None}
-        if feature_data.isnull().values.any():
+        if LinDA.is_sparse(feature_data):
+            F = feature_data.sparse.to_coo().tocsr()
+            values = F.data
+        else:
+            F = values = feature_data.to_numpy()
+        if values.dtype.kind not in "biuf":
+            F = F.astype(float)
+            values = F.data if sp.sparse.issparse(F) else F
+        if values.dtype.kind == "f" and np.isnan(values).any():
             raise Exception("The feature table contains NAs! Please remove!\n")
-        delims = ["+", "~"]
-        all_var_formula = formula
-        for delim in delims:
-            all_var_formula = " ".join(all_var_formula.split(delim))
-        all_var = all_var_formula.split()
+        fixed_formula, fixed_var, groups = LinDA.parse_formula(formula)
+        all_var = fixed_var + ([groups] if groups is not None else [])
+        if statistics:
+            LinDAFederation.check_formula(fixed_var, groups)
 
         Z = meta_data.loc[:, all_var]
 
@@ -260,174 +438,132 @@ class LinDA:
         keep_sam = Z.notna().all(axis=1)
         Z = Z[keep_sam]
 
-        try:
-            Y = feature_data.T[keep_sam].T
-        except Exception:
+        sample_pos = feature_data.columns.get_indexer(Z.index)
+        if (sample_pos < 0).any():
             raise Exception("Error: Probably you have to transpose the feature table (you can do transpose it in the "
                             "configuration file)")
         Z.columns = all_var
 
-        # Filter features
-        temp = Y.T.divide(Y.sum(axis=0), axis=0).T
-        keep_tax = (((temp != 0).mean(axis=1) >= prev_filter) & (temp.mean(axis=1) >= mean_abund_filter) & (
-                temp.max(axis=1) >= max_abund_filter))
+        # Filter features, winsorization
+        # with a memory budget, the working copy is memory-mapped and all steps stream over blocks of taxa
+        out_of_core = memory_budget > 0
+        winsor_quantile = 1 - outlier_pct if is_winsor else None
+        # stage cache: every stage is keyed by its input and the parameters it depends on
+        prep_key = None if cache is None else StageCache.key(
+            "prep", F, feature_data.index, feature_data.columns, Z.index, prev_filter, mean_abund_filter,
+            max_abund_filter, winsor_quantile, feature_dat_type)
+        prep = None if cache is None else cache.load(prep_key)
+        if prep is None:
+            with LinDAProfiler.stage("preprocessing", F.shape[0], len(sample_pos)):
+                Y, keep_tax, keep_lib = LinDAPrep.prepare(F, sample_pos, prev_filter, mean_abund_filter,
+                                                          max_abund_filter, winsor_quantile, feature_dat_type,
+                                                          out_of_core)
+                prep = {"Y": Y, "keep_tax": keep_tax, "keep_lib": keep_lib, "library": LinDAPrep.column_sums(Y),
+                        "zeros": LinDAPrep.has_zeros(Y), "nonzero": LinDAPrep.nonzero_counts(Y),
+                        "taxa_sums": LinDAPrep.taxa_sums(F)[keep_tax]}
+            if cache is not None:
+                cache.store(prep_key, prep)
+        Y, keep_tax, keep_lib = prep["Y"], prep["keep_tax"], prep["keep_lib"]
 
         if verbose:
-            numfiltered_out = len(Y.index) - sum(keep_tax)
+            numfiltered_out = len(keep_tax) - sum(keep_tax)
             print(f"{numfiltered_out} features are filtered!")
-        Y = Y[keep_tax]
-        n = len(Y.columns.values)
-        m = len(Y.index.values)
-
-        if (Y.sum(axis=0) == 0).any():
-            ind = Y.sum(axis=0) == 0
-            Y = Y[ind]
-            Z = Z[ind]
+        m, n = Y.shape
+
+        if not keep_lib.all():
+            Z = Z[keep_lib]
             Z.columns = all_var
-            keep_sam = keep_sam[ind]
-            n = len(Y.columns)
 
         if verbose:
             print(f"The filtered data has {n} samples and {m} features will be tested")
 
-        if sum((Y != 0).sum(axis=1) <= 2) != 0:
+        if (prep["nonzero"] <= 2).any():
             print("Some features have less than 3 nonzero values!\n They have virtually no statistical power.\n"
                   "You may consider filtering them in the analysis!")
 
-        # scaling numerical variables
-        ind = [i for i in Z.columns.values if np.issubdtype(Z[i].dtype, np.number)]
+        # scaling numerical variables, the exact federation standardizes the pooled variables
+        unscaled = Z.copy() if statistics else None
+        ind = [i for i in Z.columns.values if i != groups and np.issubdtype(Z[i].dtype, np.number)]
         Z[ind] = (Z[ind] - Z[ind].mean()) / Z[ind].std()
 
-        # winsorization
-        if is_winsor:
-            Y = LinDA.winsor_fun(Y, 1 - outlier_pct, feature_dat_type)
-
         # random effects present
-        if "(" in formula:
-            random_effect = True
-        else:
-            random_effect = False
+        random_effect = groups is not None
 
-        if not list(feature_data.index.values):
-            taxa_name = pd.Series([i for i in range(0, int(len(feature_data)))])[keep_tax.values]
-        else:
-            taxa_name = feature_data.index.values[keep_tax.values]
-        if not list(meta_data.index.values):
-            samp_name = [i for i in range(0, int(len(meta_data)))][keep_sam.values]
-        else:
-            samp_name = meta_data.index.values[keep_sam.values]
+        taxa_name = feature_data.index.values[keep_tax]
 
         # zero handling
-        if feature_dat_type == "count":
-            if (Y == 0).any().any():
-                N = Y.sum(axis=0)
-                if adaptive:
-                    logN = np.log(N)
-                    if random_effect:
-                        tmp_model = smf.mixedlm(formula="logN" + formula, data=Z)
-                        tmp = tmp_model.fit()
-                    else:
-                        tmp_model = smf.ols(formula="logN " + formula, data=Z)
-                        tmp = tmp_model.fit()
-                    summary_as_csv = tmp.summary().tables[1].as_html()
-                    tmp_summary = pd.read_html(StringIO(str(summary_as_csv)), header=0, index_col=0)[0]
-                    corr_pval = tmp_summary["P>|t|"][1:]
-                    if (corr_pval <= corr_cut).any():
-                        if verbose:
-                            print("Imputation approach is used.")
-                        zero_handling = "Imputation"
-                    else:
-                        if verbose:
-                            print("Pseudo-count approach is used.")
-                        zero_handling = "Pseudo-count"
-                if zero_handling == "Imputation":
-                    N_mat = np.empty(shape=(len(N.index), m))
-                    for row, N_val in zip(N_mat, N):
-                        row.fill(N_val)
-                    N_mat = N_mat.T
-                    N_mat[Y > 0] = 0
-                    tmp = N[np.argmax(N_mat, axis=1)]
-                    Y = Y + (N_mat.T / tmp.values).T
+        if feature_dat_type == "count" and adaptive and prep["zeros"]:
+            with LinDAProfiler.stage("adaptive test", n, len(all_var)):
+                logN = pd.Series(np.log(prep["library"]), index=Z.index)
+                if random_effect:
+                    tmp_model = smf.mixedlm(formula="logN " + fixed_formula, data=Z, groups=Z[groups])
+                    tmp = tmp_model.fit()
                 else:
-                    Y = Y + pseudo_count
-
-        if feature_dat_type == "proportion":
-            if (Y == 0).any().any():
-                half_min = Y[Y != 0].min().min() * 0.5
-                Y[Y == 0] = half_min
-                Y.columns = samp_name
-                Y.index = taxa_name
-
-        # CLR transform
-        logY = np.log2(Y)
-        W = logY - logY.mean(axis=0)
-        W = W.T
-        W = W.apply(pd.to_numeric)
+                    tmp_model = smf.ols(formula="logN " + fixed_formula, data=Z)
+                    tmp = tmp_model.fit()
+                corr_pval = LinDAFit.extract(tmp)["pval"][1:]
+            if (corr_pval <= corr_cut).any():
+                if verbose:
+                    print("Imputation approach is used.")
+                zero_handling = "Imputation"
+            else:
+                if verbose:
+                    print("Pseudo-count approach is used.")
+                zero_handling = "Pseudo-count"
+
+        # CLR transform, keyed by the resolved zero handling (not by the cutoff that selected it)
+        clr_key = None if cache is None else StageCache.key("clr", prep_key, zero_handling, pseudo_count)
+        clr = None if cache is None else cache.load(clr_key)
+        if clr is None:
+            with LinDAProfiler.stage("transformation", m, n):
+                if isinstance(Y, np.ndarray) and (not Y.flags.writeable or (out_of_core and isinstance(Y, np.memmap)
+                                                                             and Y.mode == "c")):
+                    # a cached working copy, transformed on a copy (on disk, copy-on-write pages would stay in memory)
+                    Y = LinDAPrep.select(Y, np.ones(m, dtype=bool), np.arange(n), out_of_core)
+                Y = LinDAPrep.transform(Y, zero_handling, pseudo_count, feature_dat_type)
+                clr = {"W": Y, "sumsq": LinDAPrep.row_sums_of_squares(Y)}
+            if cache is not None:
+                cache.store(clr_key, clr)
+        W = pd.DataFrame(clr["W"].T, index=Z.index, columns=taxa_name, copy=False)
 
         return_bucket.update({"W": W, "Z": Z})
-        normalized_data = feature_data.div(feature_data.sum(axis=0), axis=1)
-        sums_normalized = normalized_data.sum(axis=1)
-
-        if not random_effect:
-            if verbose:
-                print("Fit linear models ...")
-            frames = []
-            models = {}
-
-            for col in W.columns.values:
-                Wcol = W[col]
-                model = smf.ols(formula="Wcol " + formula, data=Z).fit()
-                model_name = str(col) + "_taxon_model_" + data_name + ".pickle"
-                models[model_name] = model
-                model_summary = model.summary2().tables[1]  # .as_html()
-                frames.append(model_summary)
-
-            res = pd.concat(frames)
-        else:
+        sums_normalized_filtered = prep["taxa_sums"]
+        if statistics:
+            return LinDAFederation.statistics(W, unscaled, fixed_var, sums_normalized_filtered, len(meta_data),
+                                              zero_handling, prep["zeros"])
+
+        fit_key = None if cache is None else StageCache.key("fit", clr_key, Z, fixed_formula, groups, engine)
+        fit = None if cache is None else cache.load(fit_key)
+        if fit is None:
             if verbose:
-                print("Fit linear mixed effect models ...")
-            frames = []
-            models = {}
-            for col in W.columns.values:
-                Wcol = W[col]
-                model = smf.mixedlm(formula="Wcol " + formula, data=Z).fit()
-                model_name = str(col) + "_taxon_model_" + data_name + ".csv"
-                models[model_name] = model
-                summary_as_csv = model.summary().tables[1].as_html()
-                model_summary = pd.read_html(StringIO(str(summary_as_csv)), header=0, index_col=0)[0]
-                frames.append(model_summary)
-
-            res = pd.concat(frames)
-
-        res_intc = res[res.index == "Intercept"]
-        base_mean = 2 ** res_intc["Coef."].values
+                print("Fit linear mixed effect models ..." if random_effect else "Fit linear models ...")
+            max_taxa = max(1, LinDAPrep.block_bytes // (8 * n * LinDAFit.copies)) if out_of_core else 0
+            with LinDAProfiler.stage("fit", m, n):
+                names, coef, stde = LinDAFit.fit(W, Z, fixed_formula, groups, engine, n_jobs, backend, max_taxa,
+                                                 sumsq=clr["sumsq"])
+            fit = {"names": names, "coef": coef, "stde": stde}
+            if cache is not None:
+                cache.store(fit_key, fit)
+        names, coef, stde = fit["names"], fit["coef"], fit["stde"]
+
+        intercept = coef[names.index("Intercept")]
+        base_mean = 2 ** intercept
         base_mean = base_mean / np.sum(base_mean) * 1e6
-        intercept = res_intc["Coef."].values
         output_frames = {}
         biases = {}
         stat_dict = {}
 
-        for voi in list(set(res.index.values)):
-
-            if voi == "Intercept":
-                continue
-
-            res_voi = res[res.index == voi]
-            res_voi.reset_index(inplace=True, drop=True)
-
-            log2FoldChange = res_voi["Coef."]
-            lfcSE = res_voi["Std.Err."]
-
-            highdec_log2FoldChange = []
-            for val in log2FoldChange:
-                val = "{0:.16f}".format(val)
-                highdec_log2FoldChange.append(float(val))
+        variables = [i for i, voi in enumerate(names) if voi != "Intercept"]
+        with LinDAProfiler.stage("mode estimation", m, len(variables)):
+            highdec = np.round(np.asarray(coef)[variables], 16).T
+            if len(variables):
+                pre_biases, iters = LinDA.mean_shift_modeest(math.sqrt(float(n)) * highdec, modeest_bins)
 
-            highdec_log2FoldChange = np.array(highdec_log2FoldChange, dtype="float64")
-            pre_bias, iters = LinDA.default_mean_shift_modeest(math.sqrt(float(n)) * highdec_log2FoldChange)
-            bias = pre_bias / math.sqrt(n)
-
-            sums_normalized_filtered = sums_normalized[sums_normalized.index.isin(taxa_name)].values
+        for j, i in enumerate(variables):
+            voi = names[i]
+            highdec_log2FoldChange = highdec[:, j]
+            lfcSE = stde[i]
+            bias = pre_biases[j] / math.sqrt(n)
 
             output = pd.DataFrame({"base_mean": base_mean,
                                    "intercept": intercept,
@@ -453,26 +589,36 @@ class LinDA:
             }
 
     @staticmethod
-    def run(feature, meta, cfg: dict, local: bool = True):
+    def run(feature, meta, cfg: dict, local: bool = True, cache: StageCache = None, statistics: bool = False):
+        exact = statistics or (not local and cfg["federation"] == "exact")
         try:
-            return LinDA.linda_coefficients(
-                feature_data=feature,
-                meta_data=meta,
-                feature_dat_type=cfg["feature_type"],
-                data_name="name",
-                formula=cfg["formula"],
-                prev_filter=cfg["prevalence"],
-                mean_abund_filter=cfg["mean_abundance"],
-                max_abund_filter=cfg["max_abundance"],
-                is_winsor=cfg["winsor"],
-                outlier_pct=cfg["outlier_percentage"],
-                adaptive=cfg["adaptive"],
-                zero_handling=cfg["zero_handling"],
-                pseudo_count=cfg["pseudo_count"],
-                corr_cut=cfg["correction_cutoff"],
-                verbose=cfg["verbose"],
-                local=local
-            )
+            with LinDAPrep.budget(int(cfg["memory_budget"] * 1024 ** 2)):
+                coefficients = LinDA.linda_coefficients(
+                    feature_data=feature,
+                    meta_data=meta,
+                    feature_dat_type=cfg["feature_type"],
+                    data_name="name",
+                    formula=cfg["formula"],
+                    prev_filter=cfg["prevalence"],
+                    mean_abund_filter=cfg["mean_abundance"],
+                    max_abund_filter=cfg["max_abundance"],
+                    is_winsor=cfg["winsor"],
+                    outlier_pct=cfg["outlier_percentage"],
+                    adaptive=cfg["adaptive"],
+                    zero_handling=cfg["zero_handling"],
+                    pseudo_count=cfg["pseudo_count"],
+                    corr_cut=cfg["correction_cutoff"],
+                    verbose=cfg["verbose"],
+                    local=local,
+                    engine=cfg["engine"],
+                    n_jobs=cfg["n_jobs"],
+                    backend=cfg["backend"],
+                    modeest_bins=cfg["modeest_bins"],
+                    memory_budget=cfg["memory_budget"],
+                    cache=cache,
+                    statistics=exact
+                )
+            return LinDAFederation.encode(coefficients) if exact and not statistics else coefficients
         except Exception as e:
             raise LindaInternalError(e)
 
@@ -480,12 +626,13 @@ class LinDA:
     def run_local(cfg):
         results = {}
         try:
-            feature_data = LinDA.read_table(cfg["feature_table"], cfg["feature_index"])
-            if cfg["feature_transpose"]:
-                feature_data = feature_data.T
-            meta_data = LinDA.read_table(cfg["meta_table"], cfg["meta_index"])
-            coefficients = LinDA.run(feature_data, meta_data, cfg, True)
-            corrected_coefficients, dof = LinDA.correct_bias(len(meta_data), cfg["formula"], coefficients)
+            cache = TableCache.from_config(cfg)
+            stage_cache = StageCache.from_config(cfg)
+            feature_data = LinDA.load_feature_table(cfg, cache)
+            meta_data = LinDA.read_table(cfg["meta_table"], cfg["meta_index"], cache=cache)
+            coefficients = LinDA.run(feature_data, meta_data, cfg, True, stage_cache)
+            corrected_coefficients, dof = LinDA.correct_bias(len(meta_data), cfg["formula"], coefficients,
+                                                             cfg["modeest_bins"], stage_cache)
             results = LinDA.linda_output(dof, corrected_coefficients)
         except LindaWrongData as e:
             print(e)
@@ -498,21 +645,116 @@ class LinDA:
         finally:
             return results
 
+    @staticmethod
+    def run_incremental(cfg: dict) -> tuple:
+        """
+        Incremental LinDA: adds the samples of the tables to the state file cfg["state"] (created by the first run)
+        and solves the models for all samples of the state.
+        :param cfg: the LINDA configuration
+        :return: the results (as run_local) and the staleness report
+        """
+        results, report = {}, []
+        try:
+            cache = TableCache.from_config(cfg)
+            feature_data = LinDA.load_feature_table(cfg, cache)
+            meta_data = LinDA.read_table(cfg["meta_table"], cfg["meta_index"], cache=cache)
+            batch = LinDA.run(feature_data, meta_data, cfg, False, StageCache.from_config(cfg), statistics=True)
+            state, report = LinDAIncremental.update(LinDAIncremental.load(cfg["state"]), batch, cfg)
+            coefficients, size = LinDAFederation.pool(state["groups"])
+            corrected_coefficients, dof = LinDA.correct_bias(size, cfg["formula"], coefficients, cfg["modeest_bins"])
+            output = LinDA.linda_output(dof, corrected_coefficients)
+            # the state is saved only after every stage succeeded
+            LinDAIncremental.save(cfg["state"], state)
+            results = output
+        except LindaWrongData as e:
+            print(e)
+        except LindaInternalError as e:
+            print(e)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(e)
+        return results, report
+
+    @staticmethod
+    def run_batch(cfg: dict, formulas: list) -> dict:
+        """
+        Runs LinDA locally for several formulas. The tables are read once and the stages with identical inputs are
+        shared: the preprocessing for formulas selecting the same samples, the CLR transformation for the same
+        zero handling and the sums of squares for the batched models. Without the on-disk cache, the stages are shared
+        in memory.
+        :param cfg: the LINDA configuration
+        :param formulas: list of formulas
+        :return: dictionary of the results (as run_local) per formula
+        """
+        results = {}
+        try:
+            cache = TableCache.from_config(cfg)
+            stage_cache = StageCache.from_config(cfg) or MemoryStageCache()
+            feature_data = LinDA.load_feature_table(cfg, cache)
+            meta_data = LinDA.read_table(cfg["meta_table"], cfg["meta_index"], cache=cache)
+        except LindaWrongData as e:
+            print(e)
+            return results
+        except LindaInternalError as e:
+            print(e)
+            return results
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(e)
+            return results
+        for formula in formulas:
+            results[formula] = {}
+            try:
+                coefficients = LinDA.run(feature_data, meta_data, dict(cfg, formula=formula), True, stage_cache)
+                corrected_coefficients, dof = LinDA.correct_bias(len(meta_data), formula, coefficients,
+                                                                 cfg["modeest_bins"], stage_cache)
+                results[formula] = LinDA.linda_output(dof, corrected_coefficients)
+            except (LindaWrongData, LindaInternalError) as e:
+                print("%s: %s" % (formula, e))
+        return results
+
+    @staticmethod
+    def run_sl_batch(cfg: dict, formulas: list) -> dict:
+        """
+        Computes the local coefficients of several formulas for the swarm learning, sharing the stages like run_batch.
+        :return: dictionary of the coefficients (as run_sl) per formula, without the formulas that failed
+        """
+        coefficients = {}
+        cache = TableCache.from_config(cfg)
+        stage_cache = StageCache.from_config(cfg) or MemoryStageCache()
+        feature_data = LinDA.load_feature_table(cfg, cache)
+        meta_data = LinDA.read_table(cfg["meta_table"], cfg["meta_index"], cache=cache)
+        for formula in formulas:
+            try:
+                coefficients[formula] = LinDA.run(feature_data, meta_data, dict(cfg, formula=formula), False,
+                                                  stage_cache)
+            except (LindaWrongData, LindaInternalError) as e:
+                print("%s: %s" % (formula, e))
+        return coefficients
+
+    @staticmethod
+    def formula_name(formula: str) -> str:
+        """
+        File system friendly name of a formula, e.g. "grp_age" for "~ grp + age".
+        """
+        return re.sub(r"[^A-Za-z0-9]+", "_", formula).strip("_") or "intercept"
+
     @staticmethod
     def run_sl(cfg):
-        feature_data = LinDA.read_table(cfg["feature_table"], cfg["feature_index"])
-        if cfg["feature_transpose"]:
-            feature_data = feature_data.T
-        meta_data = LinDA.read_table(cfg["meta_table"], cfg["meta_index"])
-        return LinDA.run(feature_data, meta_data, cfg, False)
+        cache = TableCache.from_config(cfg)
+        feature_data = LinDA.load_feature_table(cfg, cache)
+        meta_data = LinDA.read_table(cfg["meta_table"], cfg["meta_index"], cache=cache)
+        return LinDA.run(feature_data, meta_data, cfg, False, StageCache.from_config(cfg))
 
     @staticmethod
-    def run_sl_avg(all_parameters: dict, formula: str, union: bool = True):
+    def run_sl_avg(all_parameters: dict, formula: str, union: bool = True, bins: int = 0):
         results = {}
         try:
             total_data_size = sum([a["size"] for a in all_parameters.values()])
             merged_coefficients = LinDA.take_avg_params(all_parameters, union)
-            corrected_coefficients, dof = LinDA.correct_bias(total_data_size, formula, merged_coefficients)
+            corrected_coefficients, dof = LinDA.correct_bias(total_data_size, formula, merged_coefficients, bins)
             results = LinDA.linda_output(dof, corrected_coefficients)
         except LindaWrongData as e:
             print(e)
@@ -526,6 +768,40 @@ class LinDA:
         finally:
             return results
 
+    @staticmethod
+    def run_sl_exact(all_statistics: dict, formula: str, union: bool = True, bins: int = 0):
+        """
+        Pools the sufficient statistics of all participants (exact federation) and solves the pooled models.
+        :param all_statistics: the encoded statistics of all participants
+        :param formula: the formula
+        :param union: union or intersection of the taxa
+        :param bins: number of bins of the mode estimation
+        :return: dictionary of the results per variable
+        """
+        results = {}
+        try:
+            pooled_coefficients, total_data_size = LinDAFederation.pool(
+                [LinDAFederation.decode(s) for s in all_statistics.values()], union)
+            corrected_coefficients, dof = LinDA.correct_bias(total_data_size, formula, pooled_coefficients, bins)
+            results = LinDA.linda_output(dof, corrected_coefficients)
+        except LindaWrongData as e:
+            print(e)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(e)
+            raise LindaInternalError(e)
+        finally:
+            return results
+
+    @staticmethod
+    def run_sl_merge(all_parameters: dict, cfg: dict, formula: str = None):
+        """
+        Combines the parameters of all participants as configured by the federation (average or exact).
+        """
+        merge = LinDA.run_sl_exact if cfg["federation"] == "exact" else LinDA.run_sl_avg
+        return merge(all_parameters, formula or cfg["formula"], not cfg["intersection"], cfg["modeest_bins"])
+
     @staticmethod
     def display_results(results: dict):
         collector: str = ""
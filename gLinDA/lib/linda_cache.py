@@ -0,0 +1,414 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+"""
+LinDA caches
+
+On-disk caches with a size limit and least-recently-used eviction. Every entry is a directory below the cache
+directory, the manifest (manifest.json) records the size and the last use of all entries. Several processes may
+share a cache: entries are written into a temporary directory and renamed into place (an entry written by another
+process in the meantime is used instead) and the manifest is merged with the manifest on disk before it is replaced.
+Nothing is pickled, a cache directory can not inject objects into a run.
+
+TableCache keeps binary copies of parsed tables: homogeneous numeric tables are stored as .npy matrices (CSR arrays
+for sparse tables) and loaded memory-mapped, other tables (e.g. meta tables) as one .npy per numeric column and JSON
+lists for the other columns. Index and columns are stored as JSON. The entries are keyed by the content hash of the
+file and the read options. The content hash is only recomputed if path, size or mtime of the file changed. The
+table cache is off by default and enabled by cache = True (--cache), it keeps copies of the study data.
+
+StageCache keeps the outputs of the LinDA pipeline stages (preprocessing, CLR transformation, model fits, bias
+correction). Every stage is keyed by the hash of its input and the parameters the stage depends on, so changing a
+late parameter only reruns the later stages. Arrays are stored as .npy files and loaded memory-mapped (copy-on-write),
+sparse matrices as their CSR arrays and all other values as JSON; stages with other values are not cached. The
+stage cache is off by default and enabled by stage_cache = True (--stage-cache), it holds the largest matrices of the
+pipeline.
+MemoryStageCache offers the same interface within one process, e.g. to share the stages
+between the formulas of a batch.
+"""
+
+__version__ = "1.0.0"
+__author__ = "Leon Fehse, Mohammad Tajabadi, Roman Martin"
+__credits__ = "Heinrich Heine University Düsseldorf"
+
+
+class LRUCache:
+
+    manifest_name: str = "manifest.json"
+
+    def __init__(self, directory: str, max_bytes: int):
+        """
+        :param directory: the cache directory, created if missing
+        :param max_bytes: size limit of all entries, least recently used entries are evicted beyond it
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, self.manifest_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"entries": {}}
+
+    def _write_manifest(self):
+        """
+        Merges the manifest with the manifest written by other processes in the meantime and replaces it. Entries
+        whose directory was removed are dropped, of the others the latest use is kept.
+        """
+        path = os.path.join(self.directory, self.manifest_name)
+        stored = self._read_manifest()
+        entries = dict(stored["entries"], **self.manifest["entries"])
+        for key, entry in stored["entries"].items():
+            entries[key]["used"] = max(entries[key]["used"], entry["used"])
+        self.manifest["entries"] = {key: entry for key, entry in entries.items() if os.path.isdir(self.path(key))}
+        if "files" in stored or "files" in self.manifest:
+            self.manifest["files"] = dict(stored.get("files", {}), **self.manifest.get("files", {}))
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=self.directory, prefix=self.manifest_name + ".",
+                                             delete=False) as f:
+                json.dump(self.manifest, f)
+            os.replace(f.name, path)
+        except OSError:
+            # the manifest is rebuilt from the entries of the next runs
+            pass
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def contains(self, key: str) -> bool:
+        return os.path.isdir(self.path(key))
+
+    def touch(self, key: str):
+        """
+        Marks an entry as recently used, an entry written by another process is registered.
+        """
+        if key not in self.manifest["entries"]:
+            self.add(key)
+            return
+        self.manifest["entries"][key]["used"] = time.time()
+        self._write_manifest()
+
+    def commit(self, key: str, write: callable):
+        """
+        Writes an entry into a temporary directory and renames it into place. If another process stored the entry
+        in the meantime, its entry is kept.
+        :param key: the entry key
+        :param write: function writing the entry into the given directory
+        """
+        temporary = None
+        try:
+            temporary = tempfile.mkdtemp(dir=self.directory, prefix=".%s." % key)
+            write(temporary)
+            os.rename(temporary, self.path(key))
+        except (OSError, ValueError, TypeError):
+            if temporary is not None:
+                shutil.rmtree(temporary, ignore_errors=True)
+            if not self.contains(key):
+                return
+        self.add(key)
+
+    def add(self, key: str):
+        """
+        Registers a written entry directory and evicts the least recently used entries beyond the size limit.
+        """
+        try:
+            size = sum(os.path.getsize(os.path.join(root, name))
+                       for root, dirs, files in os.walk(self.path(key)) for name in files)
+        except OSError:
+            # removed by another process
+            return
+        self.manifest["entries"][key] = {"bytes": size, "used": time.time()}
+        self.evict(keep=key)
+        self._write_manifest()
+
+    def evict(self, keep: str = None):
+        entries = self.manifest["entries"]
+        total = sum(entry["bytes"] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= entries[key]["bytes"]
+            self.remove(key)
+
+    def remove(self, key: str):
+        shutil.rmtree(self.path(key), ignore_errors=True)
+        self.manifest["entries"].pop(key, None)
+
+    def clear(self):
+        for key in list(self._read_manifest()["entries"]) + list(self.manifest["entries"]):
+            self.remove(key)
+        self._write_manifest()
+
+    def size(self) -> int:
+        return sum(entry["bytes"] for entry in self.manifest["entries"].values())
+
+
+class TableCache(LRUCache):
+
+    hash_block: int = 1 << 20
+
+    @staticmethod
+    def default_directory() -> str:
+        return os.environ.get("GLINDA_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "glinda"))
+
+    @staticmethod
+    def from_config(cfg: dict):
+        """
+        Creates the table cache defined by the LINDA configuration, None if the cache is disabled.
+        """
+        if not cfg["cache"]:
+            return None
+        try:
+            return TableCache(cfg["cache_dir"] or TableCache.default_directory(), int(cfg["cache_size"] * 1024 ** 2))
+        except OSError as e:
+            print("Cache: Can not use the cache directory: %s" % e)
+            return None
+
+    @staticmethod
+    def content_hash(path: str) -> str:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(TableCache.hash_block), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def file_hash(self, path: str) -> str:
+        """
+        Content hash of a file, recomputed only if its path, size or mtime differ from the last call.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        files = self.manifest.setdefault("files", {})
+        if path not in files or files[path]["signature"] != signature:
+            files[path] = {"signature": signature, "hash": self.content_hash(path)}
+            self._write_manifest()
+        return files[path]["hash"]
+
+    def key(self, path: str, options: dict) -> str:
+        description = json.dumps(options, sort_keys=True, default=str).encode()
+        return "%s-%s" % (self.file_hash(path), hashlib.blake2b(description, digest_size=8).hexdigest())
+
+    def load(self, path: str, options: dict):
+        """
+        Returns the cached table or None.
+        :param path: path of the original file
+        :param options: the read options, part of the key
+        :return: the table or None
+        """
+        key = self.key(path, options)
+        if not self.contains(key):
+            return None
+        try:
+            table = self._read(self.path(key))
+        except (OSError, ValueError, TypeError, KeyError):
+            self.remove(key)
+            self._write_manifest()
+            return None
+        self.touch(key)
+        return table
+
+    def store(self, path: str, options: dict, table: pd.DataFrame):
+        self.commit(self.key(path, options), lambda target: self._write(target, table))
+
+    @staticmethod
+    def _labels(index: pd.Index) -> dict:
+        if isinstance(index, pd.MultiIndex):
+            raise TypeError("Multi indices are not cached")
+        return {"values": index.tolist(), "name": index.name, "dtype": str(index.dtype)}
+
+    @staticmethod
+    def _index(labels: dict) -> pd.Index:
+        return pd.Index(labels["values"], name=labels["name"], dtype=labels["dtype"])
+
+    @staticmethod
+    def _write(target: str, table: pd.DataFrame):
+        labels = {"index": TableCache._labels(table.index), "columns": TableCache._labels(table.columns)}
+        dtypes = set(table.dtypes)
+        if len(dtypes) == 1 and isinstance(next(iter(dtypes)), pd.SparseDtype):
+            labels["layout"] = "sparse"
+            matrix = sparse.csr_matrix(table.sparse.to_coo())
+            np.save(os.path.join(target, "data.npy"), matrix.data)
+            np.save(os.path.join(target, "indices.npy"), matrix.indices)
+            np.save(os.path.join(target, "indptr.npy"), matrix.indptr)
+        elif len(dtypes) == 1 and next(iter(dtypes)).kind in "biuf":
+            labels["layout"] = "dense"
+            np.save(os.path.join(target, "values.npy"), table.to_numpy(), allow_pickle=False)
+        else:
+            # one array per numeric column, the other columns (e.g. strings) as JSON lists
+            labels.update({"layout": "columns", "dtypes": [str(dtype) for dtype in table.dtypes], "values": {}})
+            for i, (name, column) in enumerate(table.items()):
+                if column.dtype.kind in "biuf":
+                    np.save(os.path.join(target, "c%d.npy" % i), column.to_numpy(), allow_pickle=False)
+                else:
+                    labels["values"][str(i)] = column.tolist()
+        with open(os.path.join(target, "labels.json"), "w") as f:
+            json.dump(labels, f)
+
+    @staticmethod
+    def _read(target: str) -> pd.DataFrame:
+        with open(os.path.join(target, "labels.json")) as f:
+            labels = json.load(f)
+        index, columns = TableCache._index(labels["index"]), TableCache._index(labels["columns"])
+        if labels["layout"] == "sparse":
+            arrays = [np.load(os.path.join(target, name + ".npy"), mmap_mode="r")
+                      for name in ["data", "indices", "indptr"]]
+            matrix = sparse.csr_matrix(tuple(arrays), shape=(len(index), len(columns)))
+            return pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=columns)
+        if labels["layout"] == "dense":
+            values = np.load(os.path.join(target, "values.npy"), mmap_mode="r")
+            return pd.DataFrame(values, index=index, columns=columns, copy=False)
+        data = {}
+        for i, dtype in enumerate(labels["dtypes"]):
+            if str(i) in labels["values"]:
+                data[i] = pd.Series(labels["values"][str(i)], index=index, dtype=object).astype(dtype)
+            else:
+                data[i] = pd.Series(np.load(os.path.join(target, "c%d.npy" % i)), index=index)
+        table = pd.DataFrame(data, index=index)
+        table.columns = columns
+        return table
+
+
+class StageCache(LRUCache):
+
+    @staticmethod
+    def from_config(cfg: dict):
+        """
+        Creates the stage cache defined by the LINDA configuration, None if the stage cache is disabled.
+        """
+        if not cfg["stage_cache"]:
+            return None
+        directory = os.path.join(cfg["cache_dir"] or TableCache.default_directory(), "stages")
+        try:
+            return StageCache(directory, int(cfg["cache_size"] * 1024 ** 2))
+        except OSError as e:
+            print("Cache: Can not use the cache directory: %s" % e)
+            return None
+
+    @staticmethod
+    def update(digest, value):
+        """
+        Feeds a value into a hash: arrays (blockwise, without copying the whole array), sparse matrices, pandas
+        objects, sequences and scalars.
+        """
+        if isinstance(value, np.ndarray):
+            digest.update(("%s%s" % (value.dtype.str, value.shape)).encode())
+            if value.dtype == object:
+                digest.update(pd.util.hash_array(value.ravel()).data)
+            elif value.ndim < 2:
+                digest.update(np.ascontiguousarray(value).data)
+            else:
+                rows = max(1, TableCache.hash_block // max(1, value[0].nbytes))
+                for start in range(0, len(value), rows):
+                    digest.update(np.ascontiguousarray(value[start:start + rows]).data)
+        elif sparse.issparse(value):
+            value = sparse.csr_matrix(value)
+            for part in [np.asarray(value.shape), value.data, value.indices, value.indptr]:
+                StageCache.update(digest, part)
+        elif isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+            StageCache.update(digest, pd.util.hash_pandas_object(value, index=not isinstance(value, pd.Index)).values)
+            if isinstance(value, pd.DataFrame):
+                StageCache.update(digest, [list(value.columns), [str(t) for t in value.dtypes]])
+        elif isinstance(value, (list, tuple)):
+            digest.update(b"[")
+            for item in value:
+                StageCache.update(digest, item)
+            digest.update(b"]")
+        else:
+            digest.update(repr(value).encode())
+
+    @staticmethod
+    def key(stage: str, *parts) -> str:
+        """
+        Key of a stage output, the hash of all inputs and parameters of the stage.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        StageCache.update(digest, list(parts))
+        return "%s-%s" % (stage, digest.hexdigest())
+
+    def load(self, key: str):
+        """
+        Returns the stored outputs of a stage as dictionary or None.
+        """
+        if not self.contains(key):
+            return None
+        target = self.path(key)
+        try:
+            with open(os.path.join(target, "values.json")) as f:
+                values = json.load(f)
+            for name in values.pop("__arrays__"):
+                values[name] = np.load(os.path.join(target, name + ".npy"), mmap_mode="c")
+            for name, shape in values.pop("__sparse__").items():
+                arrays = [np.load(os.path.join(target, "%s.%s.npy" % (name, part)))
+                          for part in ["data", "indices", "indptr"]]
+                values[name] = sparse.csr_matrix(tuple(arrays), shape=tuple(shape))
+        except (OSError, ValueError, TypeError, KeyError):
+            self.remove(key)
+            self._write_manifest()
+            return None
+        self.touch(key)
+        return values
+
+    def store(self, key: str, values: dict):
+        """
+        Stores the outputs of a stage.
+        :param key: the stage key
+        :param values: dictionary of arrays, sparse matrices and JSON serializable values
+        """
+        self.commit(key, lambda target: self._write(target, values))
+
+    @staticmethod
+    def _write(target: str, values: dict):
+        arrays = [name for name, value in values.items() if isinstance(value, np.ndarray) and value.dtype != object]
+        matrices = [name for name, value in values.items() if sparse.issparse(value)]
+        for name in arrays:
+            np.save(os.path.join(target, name + ".npy"), values[name], allow_pickle=False)
+        for name in matrices:
+            matrix = sparse.csr_matrix(values[name])
+            for part in ["data", "indices", "indptr"]:
+                np.save(os.path.join(target, "%s.%s.npy" % (name, part)), getattr(matrix, part), allow_pickle=False)
+        rest = {name: value for name, value in values.items() if name not in arrays and name not in matrices}
+        rest.update({"__arrays__": arrays, "__sparse__": {name: list(values[name].shape) for name in matrices}})
+        with open(os.path.join(target, "values.json"), "w") as f:
+            json.dump(rest, f, default=StageCache._plain)
+
+    @staticmethod
+    def _plain(value):
+        """
+        JSON representation of NumPy scalars, other objects are not cached.
+        """
+        if isinstance(value, np.generic):
+            return value.item()
+        raise TypeError("%s is not cached" % type(value).__name__)
+
+
+class MemoryStageCache:
+    """
+    In-memory stage cache. Stored arrays are frozen (read-only) instead of copied, a stage that modifies its input
+    in place has to work on a copy.
+    """
+
+    def __init__(self):
+        self.entries: dict = {}
+
+    def load(self, key: str):
+        values = self.entries.get(key)
+        return None if values is None else dict(values)
+
+    def store(self, key: str, values: dict):
+        for value in values.values():
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+        self.entries[key] = dict(values)
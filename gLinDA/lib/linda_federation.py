@@ -0,0 +1,256 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+
+from gLinDA.lib.errors import LindaWrongData
+
+"""
+LinDA exact federation
+
+Instead of averaging the coefficients of the local fits, every participant shares the sufficient statistics of its
+ordinary least squares fits: the cross products XᵀX and XᵀW of the full (one-hot) design X and the CLR transformed
+taxa W and the sums of squares wᵀw per taxon. The statistics are sums over samples, so summing them over all
+participants gives the statistics of the concatenated data and every participant solves the pooled model exactly.
+
+The payload is a NumPy archive of O(p² + p·m) floats (p design columns, m taxa) and a JSON header with the labels,
+nothing is pickled. The full design keeps one indicator column per level of each categorical variable and the raw
+numerical variables, so the treatment coding (reference level) and the standardization of the numerical variables are
+derived from the pooled levels, means and variances.
+
+The pooled fit equals the fit of the concatenated data if the preprocessing of a sample does not depend on the other
+samples: no winsorization, no prevalence or abundance filters and a fixed zero handling (no adaptive choice). Only
+fixed main effects are supported, random effects, interactions and transformations are rejected.
+"""
+
+__version__ = "1.0.0"
+__author__ = "Leon Fehse, Mohammad Tajabadi, Roman Martin"
+__credits__ = "Heinrich Heine University Düsseldorf"
+
+
+class LinDAFederation:
+
+    arrays: list = ["xtx", "xtw", "wtw", "taxa_sums"]
+    private: list = ["samples"]
+
+    @staticmethod
+    def check_formula(variables: list, groups: str = None):
+        if groups is not None:
+            raise LindaWrongData("Error: The exact federation does not support random effects")
+        for variable in variables:
+            if not variable.isidentifier():
+                raise LindaWrongData("Error: The exact federation only supports main effects, got %s" % variable)
+
+    @staticmethod
+    def design(Z: pd.DataFrame, variables: list) -> tuple:
+        """
+        Full design of the local samples: intercept, one indicator per level of the categorical variables and the
+        raw numerical variables.
+        :param Z: the meta data of the samples
+        :param variables: the fixed effect variables
+        :return: the design matrix and its columns as [variable, level] pairs (level None for numerical variables)
+        """
+        columns = [["Intercept", None]]
+        blocks = [np.ones((len(Z), 1))]
+        for variable in variables:
+            values = Z[variable]
+            if np.issubdtype(values.dtype, np.number):
+                columns.append([variable, None])
+                blocks.append(values.to_numpy(dtype=float)[:, None])
+            else:
+                levels = sorted(set(values.astype(str)))
+                columns += [[variable, level] for level in levels]
+                blocks.append((values.astype(str).to_numpy()[:, None] == np.array(levels)[None, :]).astype(float))
+        return np.hstack(blocks), columns
+
+    @staticmethod
+    def statistics(W: pd.DataFrame, Z: pd.DataFrame, variables: list, taxa_sums: np.ndarray, size: int,
+                   zero_handling: str = None, zeros: bool = False) -> dict:
+        """
+        Sufficient statistics of the local ordinary least squares fits.
+        :param W: CLR transformed taxa (samples x taxa)
+        :param Z: the unscaled meta data of the samples
+        :param variables: the fixed effect variables
+        :param taxa_sums: sum of the relative abundances per taxon
+        :param size: number of samples of the meta table
+        :param zero_handling: the zero handling used for the samples
+        :param zeros: True if the samples contained zeros
+        :return: dictionary of the statistics
+        """
+        X, columns = LinDAFederation.design(Z, variables)
+        values = W.to_numpy(dtype=float)
+        return {
+            "xtx": X.T @ X,
+            "xtw": X.T @ values,
+            "wtw": np.einsum("ij,ij->j", values, values),
+            "taxa_sums": np.asarray(taxa_sums, dtype=float),
+            "columns": columns,
+            "taxa": W.columns.tolist(),
+            "variables": list(variables),
+            "n": len(X),
+            "size": int(size),
+            "samples": W.index.tolist(),
+            "zero_handling": zero_handling,
+            "zeros": bool(zeros),
+        }
+
+    @staticmethod
+    def encode(statistics: dict) -> bytes:
+        """
+        Serializes the statistics into a NumPy archive without pickled objects. The sample names are not shared.
+        """
+        header = {k: v for k, v in statistics.items()
+                  if k not in LinDAFederation.arrays and k not in LinDAFederation.private}
+        buffer = io.BytesIO()
+        np.savez(buffer, header=np.frombuffer(json.dumps(header, default=str).encode(), dtype=np.uint8),
+                 **{k: statistics[k] for k in LinDAFederation.arrays})
+        return buffer.getvalue()
+
+    @staticmethod
+    def decode(payload: bytes) -> dict:
+        with np.load(io.BytesIO(payload), allow_pickle=False) as archive:
+            statistics = json.loads(archive["header"].tobytes().decode())
+            statistics.update({k: archive[k] for k in LinDAFederation.arrays})
+        return statistics
+
+    @staticmethod
+    def encode_batch(batch: dict) -> bytes:
+        """
+        Packs the encoded statistics of a formula batch into one NumPy archive, the formulas are listed in its header.
+        :param batch: the encoded statistics per formula
+        """
+        buffer = io.BytesIO()
+        np.savez(buffer, header=np.frombuffer(json.dumps(list(batch)).encode(), dtype=np.uint8),
+                 **{"formula%d" % k: np.frombuffer(payload, dtype=np.uint8)
+                    for k, payload in enumerate(batch.values())})
+        return buffer.getvalue()
+
+    @staticmethod
+    def decode_batch(payload: bytes) -> dict:
+        """
+        :return: the encoded statistics per formula
+        """
+        with np.load(io.BytesIO(payload), allow_pickle=False) as archive:
+            formulas = json.loads(archive["header"].tobytes().decode())
+            return {formula: archive["formula%d" % k].tobytes() for k, formula in enumerate(formulas)}
+
+    @staticmethod
+    def coding(columns: list, variables: list, xtx: np.ndarray, n: int) -> tuple:
+        """
+        Maps the full design onto the model design: treatment coding with the first level as reference and
+        standardized numerical variables (as in the local fits).
+        :param columns: the full design columns
+        :param variables: the fixed effect variables
+        :param xtx: the pooled XᵀX of the full design
+        :param n: the pooled number of samples
+        :return: the transformation T (model design = full design @ T) and the model design column names
+        """
+        position = {tuple(c): i for i, c in enumerate(columns)}
+        categorical = [v for v in variables if (v, None) not in position]
+        numerical = [v for v in variables if (v, None) in position]
+        names = ["Intercept"]
+        vectors = [np.eye(len(columns))[0]]
+        for variable in categorical:
+            levels = sorted(level for name, level in columns if name == variable)
+            for level in levels[1:]:
+                names.append("%s[T.%s]" % (variable, level))
+                vectors.append(np.eye(len(columns))[position[(variable, level)]])
+        for variable in numerical:
+            i = position[(variable, None)]
+            mean = xtx[0, i] / n
+            std = np.sqrt((xtx[i, i] - n * mean ** 2) / (n - 1))
+            vector = -mean / std * np.eye(len(columns))[0]
+            vector[i] = 1 / std
+            names.append(variable)
+            vectors.append(vector)
+        return np.column_stack(vectors), names
+
+    @staticmethod
+    def columns(all_statistics: list) -> list:
+        """
+        Union of the full design columns: intercept first, then the variables with their sorted levels.
+        """
+        columns = []
+        for statistics in all_statistics:
+            columns += [c for c in statistics["columns"] if c not in columns]
+        return [columns[0]] + sorted(columns[1:], key=lambda c: (c[0], c[1] is not None, c[1] or ""))
+
+    @staticmethod
+    def merge(a: dict, b: dict) -> dict:
+        """
+        Sums the statistics of two sample sets with the same taxa.
+        :return: the statistics of the union of both sample sets
+        """
+        if a["taxa"] != b["taxa"]:
+            raise LindaWrongData("Error: Only statistics of the same taxa can be merged")
+        columns = LinDAFederation.columns([a, b])
+        merged = dict(a, columns=columns, xtx=np.zeros((len(columns), len(columns))),
+                      xtw=np.zeros((len(columns), len(a["taxa"]))), wtw=a["wtw"] + b["wtw"],
+                      taxa_sums=a["taxa_sums"] + b["taxa_sums"], n=a["n"] + b["n"], size=a["size"] + b["size"],
+                      samples=a["samples"] + b["samples"])
+        for statistics in [a, b]:
+            rows = [columns.index(c) for c in statistics["columns"]]
+            merged["xtx"][np.ix_(rows, rows)] += statistics["xtx"]
+            merged["xtw"][rows] += statistics["xtw"]
+        return merged
+
+    @staticmethod
+    def pool(all_statistics: list, union: bool = True) -> tuple:
+        """
+        Solves the pooled ordinary least squares fits. Taxa missing at some participants (union) are fitted on the
+        samples of the participants having them.
+        :param all_statistics: the statistics of all participants
+        :param union: union or intersection of the taxa
+        :return: dictionary of the coefficients (as LinDA.linda_coefficients) and the pooled number of meta samples
+        """
+        variables = all_statistics[0]["variables"]
+        if any(s["variables"] != variables for s in all_statistics):
+            raise LindaWrongData("Error: The participants used different formulas")
+
+        columns = LinDAFederation.columns(all_statistics)
+        taxa = list(dict.fromkeys(t for s in all_statistics for t in s["taxa"]))
+        if not union:
+            common = set.intersection(*[set(s["taxa"]) for s in all_statistics])
+            taxa = [t for t in taxa if t in common]
+
+        # align the statistics of all participants to the pooled columns and taxa
+        p, m = len(columns), len(taxa)
+        xtx = np.zeros((len(all_statistics), p, p))
+        xtw, wtw, taxa_sums = np.zeros((len(all_statistics), p, m)), np.zeros((len(all_statistics), m)), np.zeros(m)
+        present = np.zeros((len(all_statistics), m), dtype=bool)
+        for k, statistics in enumerate(all_statistics):
+            rows = [columns.index(c) for c in statistics["columns"]]
+            xtx[k][np.ix_(rows, rows)] = statistics["xtx"]
+            position = pd.Index(statistics["taxa"]).get_indexer(taxa)
+            present[k] = position >= 0
+            xtw[k][np.ix_(rows, np.flatnonzero(present[k]))] = statistics["xtw"][:, position[present[k]]]
+            wtw[k, present[k]] = statistics["wtw"][position[present[k]]]
+            taxa_sums[present[k]] += statistics["taxa_sums"][position[present[k]]]
+
+        n = sum(s["n"] for s in all_statistics)
+        T, names = LinDAFederation.coding(columns, variables, xtx.sum(axis=0), n)
+        coef, stde = np.zeros((len(names), m)), np.zeros((len(names), m))
+        for pattern in np.unique(present, axis=1).T:
+            taxa_index = np.flatnonzero((present == pattern[:, None]).all(axis=0))
+            G = T.T @ xtx[pattern].sum(axis=0) @ T
+            B = T.T @ xtw[pattern][:, :, taxa_index].sum(axis=0)
+            inverse = np.linalg.pinv(G)
+            coef[:, taxa_index] = inverse @ B
+            rss = np.maximum(wtw[pattern][:, taxa_index].sum(axis=0) - np.einsum("ij,ij->j", coef[:, taxa_index], B),
+                             0)
+            dof = sum(s["n"] for s, p in zip(all_statistics, pattern) if p) - np.linalg.matrix_rank(G)
+            stde[:, taxa_index] = np.sqrt(np.outer(np.diag(inverse), rss / dof))
+
+        intercept = coef[0]
+        base_mean = 2 ** intercept
+        base_mean = base_mean / np.sum(base_mean) * 1e6
+        coefficients = {}
+        for i, voi in enumerate(names[1:], 1):
+            coefficients[voi] = pd.DataFrame({"base_mean": base_mean,
+                                              "intercept": intercept,
+                                              "stat": np.round(coef[i], 16),
+                                              "stde": stde[i],
+                                              "taxa_sums": taxa_sums,
+                                              }, index=taxa)
+        return coefficients, sum(s["size"] for s in all_statistics)
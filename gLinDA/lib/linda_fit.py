@@ -0,0 +1,310 @@
+import functools
+import os
+import pandas as pd
+import numpy as np
+import scipy.sparse as sparse
+import statsmodels.formula.api as smf
+from concurrent.futures import ProcessPoolExecutor
+
+"""
+LinDA model fitting
+
+Per-taxon regression engines for LinDA. Every engine fits the same model "Wcol <formula>" for each column (taxon) of
+the CLR transformed matrix W and returns the names of the model terms together with the coefficients and standard
+errors as (terms x taxa) arrays.
+"""
+
+__version__ = "1.0.0"
+__author__ = "Leon Fehse, Mohammad Tajabadi, Roman Martin"
+__credits__ = "Heinrich Heine University Düsseldorf"
+
+
+class LinDAFit:
+
+    engines: list = ["batched", "statsmodels"]
+    backends: list = ["serial", "process"]
+    blocks_per_job: int = 4
+    # samples x taxa sized arrays an engine holds at once (data, residuals, temporaries)
+    copies: int = 4
+    # relative residual sum of squares below which the shortcut over the sums of squares loses too many digits
+    cancellation: float = 1e-6
+
+    # variance ratio search of the batched random intercept engine
+    gamma_range: tuple = (1e-5, 1e5)
+    gamma_grid: int = 50
+    gamma_iterations: int = 40
+
+    @staticmethod
+    def fit(W: pd.DataFrame, Z: pd.DataFrame, formula: str, groups: str = None, engine: str = "batched",
+            n_jobs: int = 1, backend: str = "serial", max_taxa: int = 0, design: tuple = None,
+            sumsq: np.ndarray = None) -> tuple:
+        """
+        Selects the engine and the execution backend for the per-taxon models.
+        :param W: the CLR transformed data, samples x taxa
+        :param Z: the meta data
+        :param formula: the right-hand side of the formula (fixed effects only)
+        :param groups: the grouping variable of a random intercept, None for fixed effect models
+        :param engine: "batched" solves all taxa at once, "statsmodels" fits one model per taxon
+        :param n_jobs: number of worker processes, values below 1 use all available cores
+        :param backend: "serial" or "process"
+        :param max_taxa: fits blocks of at most max_taxa taxa one after another (bounds the memory), 0 fits all at once
+        :param design: the precomputed design (term names, matrix) for the batched engines, None builds it
+        :param sumsq: the precomputed sums of squares of the taxa (columns of W) for the batched OLS engine
+        :return: term names, coefficients and standard errors (terms x taxa)
+        """
+        if 0 < max_taxa < W.shape[1]:
+            design = LinDAFit.design(W, Z, formula) if engine == "batched" else None
+            results = [LinDAFit.fit(W.iloc[:, start:start + max_taxa], Z, formula, groups, engine, n_jobs, backend,
+                                    design=design, sumsq=None if sumsq is None else sumsq[start:start + max_taxa])
+                       for start in range(0, W.shape[1], max_taxa)]
+            return results[0][0], np.hstack([r[1] for r in results]), np.hstack([r[2] for r in results])
+
+        if groups is not None:
+            if engine == "statsmodels":
+                func = LinDAFit.mixed_statsmodels
+            else:
+                func = functools.partial(LinDAFit.mixed_batched, design=design)
+        elif engine == "statsmodels":
+            func = LinDAFit.ols_statsmodels
+        else:
+            # already a single matrix product, BLAS takes care of the cores
+            return LinDAFit.ols_batched(W, Z, formula, design=design, sumsq=sumsq)
+
+        if n_jobs < 1:
+            n_jobs = os.cpu_count() or 1
+
+        if backend == "process" and n_jobs > 1 and W.shape[1] > 1:
+            return LinDAFit.fit_parallel(func, W, Z, formula, groups, n_jobs)
+        return func(W, Z, formula, groups)
+
+    @staticmethod
+    def fit_parallel(func, W: pd.DataFrame, Z: pd.DataFrame, formula: str, groups: str, n_jobs: int) -> tuple:
+        """
+        Splits the taxa into blocks and fits them in a process pool. Blocks are merged in submission order, the taxa
+        order of the result is therefore identical to the serial execution.
+        :param func: the engine function, has to be importable (picklable) by the worker processes
+        :param W: the CLR transformed data, samples x taxa
+        :param Z: the meta data
+        :param formula: the right-hand side of the formula
+        :param groups: the grouping variable of a random intercept or None
+        :param n_jobs: number of worker processes
+        :return: term names, coefficients and standard errors (terms x taxa)
+        """
+        n_blocks = min(W.shape[1], n_jobs * LinDAFit.blocks_per_job)
+        blocks = [b for b in np.array_split(np.arange(W.shape[1]), n_blocks) if len(b)]
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(func, W.iloc[:, block], Z, formula, groups) for block in blocks]
+            results = [future.result() for future in futures]
+
+        names = results[0][0]
+        coef = np.hstack([result[1] for result in results])
+        stde = np.hstack([result[2] for result in results])
+        return names, coef, stde
+
+    @staticmethod
+    def extract(result) -> pd.DataFrame:
+        """
+        Reads the fixed effect estimates directly from a fitted statsmodels result (OLS or MixedLM), without rendering
+        and parsing a summary table.
+        :param result: the fitted results object
+        :return: a data frame with the columns coef, stde and pval, indexed by the fixed effect terms
+        """
+        names = result.model.exog_names
+        return pd.DataFrame({"coef": np.asarray(result.params[names], dtype=float),
+                             "stde": np.asarray(result.bse[names], dtype=float),
+                             "pval": np.asarray(result.pvalues[names], dtype=float)}, index=names)
+
+    @staticmethod
+    def design(W: pd.DataFrame, Z: pd.DataFrame, formula: str) -> tuple:
+        """
+        Builds the design matrix once, with the same formula machinery statsmodels uses for the per-taxon fits.
+        :param W: the CLR transformed data, samples x taxa
+        :param Z: the meta data
+        :param formula: the right-hand side of the formula, e.g. "~ grp"
+        :return: the term names and the design matrix (samples x terms)
+        """
+        Wcol = W.iloc[:, 0] if W.shape[1] else pd.Series(np.zeros(len(Z)), index=Z.index)
+        model = smf.ols(formula="Wcol " + formula, data=Z)
+        return list(model.exog_names), np.asarray(model.exog, dtype=float)
+
+    @staticmethod
+    def ols_batched(W: pd.DataFrame, Z: pd.DataFrame, formula: str, groups: str = None, design: tuple = None,
+                    sumsq: np.ndarray = None) -> tuple:
+        """
+        Fits the ordinary least squares model for all taxa at once. The pseudo-inverse of the design matrix is
+        computed a single time (like statsmodels' default "pinv" method), all taxa are solved by one matrix product.
+        With the sums of squares of the taxa (shared by all formulas on the same W), the residual sums of squares are
+        computed from the small (terms x terms) cross products instead of the residual matrix.
+        :param W: the CLR transformed data, samples x taxa
+        :param Z: the meta data
+        :param formula: the right-hand side of the formula
+        :param design: the precomputed design (term names, matrix), None builds it
+        :param sumsq: sums of squares of the columns of W, None computes the residuals
+        :return: term names, coefficients and standard errors (terms x taxa)
+        """
+        names, X = LinDAFit.design(W, Z, formula) if design is None else design
+        Y = np.asarray(W, dtype=float)
+
+        pinv_x = np.linalg.pinv(X, rcond=1e-15)
+        normalized_cov = pinv_x @ pinv_x.T
+        df_resid = X.shape[0] - np.linalg.matrix_rank(X)
+
+        coef = pinv_x @ Y
+        if sumsq is None:
+            rss = LinDAFit.residual_sums(X, Y, coef)
+        else:
+            rss = sumsq - np.einsum("ij,ij->j", coef, (X.T @ X) @ coef)
+            # cancellation for (nearly) perfect fits, these taxa get the explicit residuals
+            unstable = np.flatnonzero(rss <= LinDAFit.cancellation * sumsq)
+            rss[unstable] = LinDAFit.residual_sums(X, Y[:, unstable], coef[:, unstable])
+        scale = rss / df_resid
+        stde = np.sqrt(np.outer(np.diag(normalized_cov), scale))
+
+        return names, coef, stde
+
+    @staticmethod
+    def residual_sums(X: np.ndarray, Y: np.ndarray, coef: np.ndarray) -> np.ndarray:
+        resid = Y - X @ coef
+        return np.einsum("ij,ij->j", resid, resid)
+
+    @staticmethod
+    def ols_statsmodels(W: pd.DataFrame, Z: pd.DataFrame, formula: str, groups: str = None) -> tuple:
+        """
+        Reference engine: one statsmodels OLS fit per taxon.
+        :param W: the CLR transformed data, samples x taxa
+        :param Z: the meta data
+        :param formula: the right-hand side of the formula
+        :return: term names, coefficients and standard errors (terms x taxa)
+        """
+        frames = []
+        for col in W.columns.values:
+            Wcol = W[col]
+            frames.append(LinDAFit.extract(smf.ols(formula="Wcol " + formula, data=Z).fit()))
+
+        return LinDAFit.stack(frames)
+
+    @staticmethod
+    def mixed_statsmodels(W: pd.DataFrame, Z: pd.DataFrame, formula: str, groups: str = None) -> tuple:
+        """
+        Reference engine: one statsmodels linear mixed effect model (REML) per taxon.
+        :param W: the CLR transformed data, samples x taxa
+        :param Z: the meta data
+        :param formula: the right-hand side of the formula (fixed effects only)
+        :param groups: the grouping variable of the random intercept
+        :return: term names, coefficients and standard errors (terms x taxa)
+        """
+        frames = []
+        for col in W.columns.values:
+            Wcol = W[col]
+            frames.append(LinDAFit.extract(smf.mixedlm(formula="Wcol " + formula, data=Z, groups=Z[groups]).fit()))
+
+        return LinDAFit.stack(frames)
+
+    @staticmethod
+    def stack(frames: list) -> tuple:
+        """
+        Combines the per-taxon estimates of the reference engines.
+        :param frames: one data frame per taxon, as returned by extract
+        :return: term names, coefficients and standard errors (terms x taxa)
+        """
+        if not len(frames):
+            return [], np.empty((0, 0)), np.empty((0, 0))
+        names = list(frames[0].index)
+        coef = np.array([frame["coef"].values for frame in frames]).T
+        stde = np.array([frame["stde"].values for frame in frames]).T
+        return names, coef, stde
+
+    @staticmethod
+    def mixed_batched(W: pd.DataFrame, Z: pd.DataFrame, formula: str, groups: str = None,
+                      design: tuple = None) -> tuple:
+        """
+        Random intercept models for all taxa at once. The group structure and the fixed effect design are shared by
+        all taxa, therefore the group sums are computed once and the REML criterion is profiled over the variance
+        ratio gamma = var(group) / var(residual): first on a shared logarithmic grid, then refined per taxon by a
+        vectorized golden-section search.
+        :param W: the CLR transformed data, samples x taxa
+        :param Z: the meta data
+        :param formula: the right-hand side of the formula (fixed effects only)
+        :param groups: the grouping variable of the random intercept
+        :param design: the precomputed design (term names, matrix), None builds it
+        :return: term names, coefficients and standard errors (terms x taxa)
+        """
+        names, X = LinDAFit.design(W, Z, formula) if design is None else design
+        Y = np.asarray(W, dtype=float)
+        stats = RandomIntercept(X, Y, pd.factorize(Z[groups])[0])
+
+        grid = np.concatenate([[0.0], np.exp(np.linspace(np.log(LinDAFit.gamma_range[0]),
+                                                         np.log(LinDAFit.gamma_range[1]), LinDAFit.gamma_grid))])
+        profile = np.array([stats.reml(np.full(Y.shape[1], gamma))[0] for gamma in grid])
+        best = np.argmax(profile, axis=0)
+
+        # golden-section search between the neighbours of the best grid point, on the log scale
+        log_grid = np.log(grid[1:])
+        lower = log_grid[np.clip(best - 2, 0, len(log_grid) - 1)]
+        upper = log_grid[np.clip(best, 0, len(log_grid) - 1)]
+        ratio = (np.sqrt(5) - 1) / 2
+        a, b = upper - ratio * (upper - lower), lower + ratio * (upper - lower)
+        fa, fb = stats.reml(np.exp(a))[0], stats.reml(np.exp(b))[0]
+        for i in range(LinDAFit.gamma_iterations):
+            left = fa >= fb
+            upper = np.where(left, b, upper)
+            lower = np.where(left, lower, a)
+            a, b = (np.where(left, upper - ratio * (upper - lower), b),
+                    np.where(left, a, lower + ratio * (upper - lower)))
+            value = stats.reml(np.exp(np.where(left, a, b)))[0]
+            fa, fb = np.where(left, value, fb), np.where(left, fa, value)
+
+        gamma = np.exp((lower + upper) / 2)
+        value, coef, stde = stats.reml(gamma)
+
+        # the variance ratio lies on the boundary
+        boundary = stats.reml(np.zeros(Y.shape[1]))
+        at_zero = boundary[0] >= value
+        coef = np.where(at_zero, boundary[1], coef)
+        stde = np.where(at_zero, boundary[2], stde)
+
+        return names, coef, stde
+
+
+class RandomIntercept:
+    """
+    Sufficient statistics of the random intercept model y = X b + u[group] + e for many responses y with a shared
+    design X. With V = I + gamma * J (block diagonal per group), V^-1 follows from Sherman-Morrison, all products
+    with V^-1 reduce to the pooled cross products and the per-group sums.
+    """
+
+    def __init__(self, X: np.ndarray, Y: np.ndarray, codes: np.ndarray):
+        self.n, self.p = X.shape
+        self.sizes = np.bincount(codes).astype(float)
+        # sparse indicator of the groups, O(n) also for many small groups
+        group_sum = sparse.csr_matrix((np.ones(self.n), (codes, np.arange(self.n))), shape=(len(self.sizes), self.n))
+
+        self.xtx = X.T @ X
+        self.xty = (X.T @ Y).T
+        self.yty = np.einsum("ij,ij->j", Y, Y)
+        self.sx = np.asarray(group_sum @ X)
+        self.sy = np.asarray(group_sum @ Y).T
+        self.sxsx = np.einsum("gi,gj->gij", self.sx, self.sx).reshape(len(self.sizes), -1)
+
+    def reml(self, gamma: np.ndarray) -> tuple:
+        """
+        Evaluates the profiled REML log-likelihood and the generalized least squares estimates per response.
+        :param gamma: variance ratio per response
+        :return: log-likelihood (up to a constant), coefficients and standard errors (terms x responses)
+        """
+        c = gamma[:, None] / (1 + gamma[:, None] * self.sizes[None, :])
+        xvx = self.xtx[None, :, :] - (c @ self.sxsx).reshape(-1, self.p, self.p)
+        xvy = self.xty - (c * self.sy) @ self.sx
+        yvy = self.yty - np.einsum("mg,mg->m", c, self.sy ** 2)
+
+        coef = np.linalg.solve(xvx, xvy[:, :, None])[:, :, 0]
+        rss = np.maximum(yvy - np.einsum("mi,mi->m", xvy, coef), np.finfo(float).tiny)
+        df = self.n - self.p
+        logdet_v = np.log1p(gamma[:, None] * self.sizes[None, :]).sum(axis=1)
+        logdet_xvx = np.linalg.slogdet(xvx)[1]
+
+        value = -0.5 * (df * np.log(rss / df) + logdet_v + logdet_xvx)
+        cov_diag = np.diagonal(np.linalg.inv(xvx), axis1=1, axis2=2)
+        stde = np.sqrt(cov_diag * (rss / df)[:, None])
+        return value, coef.T, stde.T
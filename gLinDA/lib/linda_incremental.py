@@ -0,0 +1,154 @@
+import io
+import json
+import os
+
+import numpy as np
+
+from gLinDA.lib.errors import LindaWrongData
+from gLinDA.lib.linda_federation import LinDAFederation
+
+"""
+Incremental LinDA
+
+The state file keeps the sufficient statistics of all samples analysed so far (see linda_federation) and the
+preprocessing state of every batch: sample names, the resolved zero handling and whether the batch contained zeros.
+A new batch of samples is preprocessed and reduced to its statistics, O(new samples x taxa), and summed into the
+state; the results are solved from the pooled statistics. Batches with the same taxa are merged into one group, taxa
+missing in some batches are fitted on the batches containing them.
+
+Stages depending on all samples (winsorization quantiles, abundance filters, the adaptive zero handling test, the
+imputation and the half minimum of proportions) are computed per batch. They are not updated but reported as stale,
+the results then differ from a run on all samples.
+"""
+
+__version__ = "1.0.0"
+__author__ = "Leon Fehse, Mohammad Tajabadi, Roman Martin"
+__credits__ = "Heinrich Heine University Düsseldorf"
+
+
+class LinDAIncremental:
+
+    version: int = 1
+    settings: list = ["formula", "feature_type", "zero_handling", "pseudo_count", "winsor", "outlier_percentage",
+                      "prevalence", "mean_abundance", "max_abundance", "adaptive", "correction_cutoff"]
+
+    @staticmethod
+    def load(path: str):
+        """
+        Reads a state file.
+        :param path: path of the state file
+        :return: the state or None if the file does not exist
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as archive:
+            state = json.loads(archive["header"].tobytes().decode())
+            if state["version"] != LinDAIncremental.version:
+                raise LindaWrongData("Error: Unsupported version %s of the state file %s" % (state["version"], path))
+            for k, group in enumerate(state["groups"]):
+                group.update({name: archive["%d_%s" % (k, name)] for name in LinDAFederation.arrays})
+        return state
+
+    @staticmethod
+    def save(path: str, state: dict):
+        """
+        Writes a state file, the previous state is replaced only if writing succeeded.
+        """
+        arrays = {"%d_%s" % (k, name): group[name]
+                  for k, group in enumerate(state["groups"]) for name in LinDAFederation.arrays}
+        header = dict(state, groups=[{k: v for k, v in group.items() if k not in LinDAFederation.arrays}
+                                     for group in state["groups"]])
+        buffer = io.BytesIO()
+        np.savez(buffer, header=np.frombuffer(json.dumps(header, default=str).encode(), dtype=np.uint8), **arrays)
+        with open(path + ".tmp", "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def stale_stages(cfg: dict, batch: dict) -> list:
+        """
+        Stages of a batch that were computed from the batch only.
+        :param cfg: the LINDA configuration
+        :param batch: the statistics of the batch
+        :return: list of stage descriptions
+        """
+        stages = []
+        if cfg["winsor"]:
+            stages.append({"stage": "winsorization",
+                           "message": "outlier quantiles computed from the %d samples of the batch" % batch["n"]})
+        filters = [name for name in ["prevalence", "mean_abundance", "max_abundance"] if cfg[name] > 0]
+        if len(filters):
+            stages.append({"stage": "filtering",
+                           "message": "taxa filtered by the %s of the batch" % ", ".join(filters)})
+        if cfg["feature_type"] == "count" and batch["zeros"]:
+            if cfg["adaptive"]:
+                stages.append({"stage": "zero handling",
+                               "message": "adaptive test on the batch selected %s" % batch["zero_handling"]})
+            if batch["zero_handling"] == "Imputation":
+                stages.append({"stage": "zero handling",
+                               "message": "zeros imputed from the library sizes of the batch"})
+        elif cfg["feature_type"] == "proportion" and batch["zeros"]:
+            stages.append({"stage": "zero handling", "message": "zeros replaced by the half minimum of the batch"})
+        return stages
+
+    @staticmethod
+    def report(state: dict) -> list:
+        """
+        Staleness report: the stages computed per batch and the differences between the batches. Empty for a
+        single batch, whose results equal a run on its samples.
+        """
+        batches = state["batches"]
+        if len(batches) < 2:
+            return []
+        report = [dict(stage, batch=k) for k, batch in enumerate(batches) for stage in batch["stale"]]
+        if len(set(batch["zero_handling"] for batch in batches if batch["zeros"])) > 1:
+            report.append({"stage": "zero handling", "batch": None,
+                           "message": "the batches used different zero handlings"})
+        if state["settings"]["feature_type"] == "count" and len(set(batch["zeros"] for batch in batches)) > 1:
+            report.append({"stage": "zero handling", "batch": None,
+                           "message": "zeros were only handled in the batches containing zeros"})
+        if len(state["groups"]) > 1:
+            common = set.intersection(*[set(group["taxa"]) for group in state["groups"]])
+            missing = len(set().union(*[group["taxa"] for group in state["groups"]]) - common)
+            report.append({"stage": "taxa", "batch": None,
+                           "message": "%d taxa are missing in some batches, fitted on the batches containing them" %
+                                      missing})
+        return report
+
+    @staticmethod
+    def update(state, batch: dict, cfg: dict) -> tuple:
+        """
+        Adds the statistics of a new batch of samples to the state.
+        :param state: the state or None for the first batch
+        :param batch: the statistics of the batch (LinDA.run with statistics)
+        :param cfg: the LINDA configuration
+        :return: the updated state and the staleness report
+        """
+        settings = {name: cfg[name] for name in LinDAIncremental.settings}
+        if state is None:
+            state = {"version": LinDAIncremental.version, "settings": settings, "batches": [], "groups": []}
+        changed = [name for name in LinDAIncremental.settings if state["settings"][name] != settings[name]]
+        if len(changed):
+            raise LindaWrongData("Error: The state was created with different settings: %s" % ", ".join(changed))
+        duplicates = set(batch["samples"]) & set(s for group in state["groups"] for s in group["samples"])
+        if len(duplicates):
+            raise LindaWrongData("Error: %d samples are already part of the state, e.g. %s" %
+                                 (len(duplicates), sorted(map(str, duplicates))[0]))
+
+        state["batches"].append({"n": batch["n"], "size": batch["size"], "zero_handling": batch["zero_handling"],
+                                 "zeros": batch["zeros"], "stale": LinDAIncremental.stale_stages(cfg, batch)})
+        for k, group in enumerate(state["groups"]):
+            if group["taxa"] == batch["taxa"]:
+                state["groups"][k] = LinDAFederation.merge(group, batch)
+                break
+        else:
+            state["groups"].append(batch)
+        return state, LinDAIncremental.report(state)
+
+    @staticmethod
+    def describe(report: list) -> str:
+        collector = ""
+        for entry in report:
+            collector += "Stale %s%s: %s\r\n" % (entry["stage"], "" if entry["batch"] is None else
+                                                 " (batch %d)" % entry["batch"], entry["message"])
+        return collector
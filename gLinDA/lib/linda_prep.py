@@ -0,0 +1,367 @@
+import contextlib
+import math
+import tempfile
+import numpy as np
+import scipy.sparse as sparse
+
+from gLinDA.lib.linda_profile import LinDAProfiler
+
+"""
+LinDA preprocessing
+
+NumPy kernels for the preprocessing of the feature table: feature filtering, winsorization, zero handling and the
+CLR transformation. All kernels work on a single contiguous float64 matrix (taxa x samples), either in place or on
+bounded row blocks.
+
+Memory bound: besides the input matrix, prepare and transform together allocate one working copy of the selected
+features and samples (at most the size of the input matrix as float64) plus row blocks of at most block_bytes.
+The peak of additional memory therefore stays below 2x the input matrix (float64) for matrices larger than a few
+blocks.
+
+Out-of-core: with out_of_core, the working copy is a memory map of an anonymous temporary file instead of an array in
+memory. All kernels read and write it in row blocks, so the resident memory is bounded by a few blocks. Per-sample
+quantities (library sizes, CLR means) are accumulated in a first pass over the blocks. The block size is set by the
+budget context.
+
+Sparse input: F may also be a scipy.sparse matrix. Filtering, library sizes and winsorization then work on the stored
+(non-zero) values only and the working copy stays sparse; transform densifies it right before the zero handling,
+i.e. only for the selected features and samples.
+"""
+
+__version__ = "1.0.0"
+__author__ = "Leon Fehse, Mohammad Tajabadi, Roman Martin"
+__credits__ = "Heinrich Heine University Düsseldorf"
+
+
+class LinDAPrep:
+
+    block_bytes: int = 8 * 1024 * 1024
+
+    # number of block-sized temporaries a kernel allocates at most
+    budget_blocks: int = 8
+
+    @staticmethod
+    @contextlib.contextmanager
+    def budget(memory_bytes: int):
+        """
+        Derives the block size from a memory budget for the duration of the context, 0 keeps the default.
+        """
+        default = LinDAPrep.block_bytes
+        if memory_bytes > 0:
+            LinDAPrep.block_bytes = max(1, memory_bytes // LinDAPrep.budget_blocks)
+        try:
+            yield
+        finally:
+            LinDAPrep.block_bytes = default
+
+    @staticmethod
+    def row_blocks(rows: int, columns: int) -> list:
+        """
+        Splits the rows into blocks of at most block_bytes (as float64).
+        :param rows: number of rows
+        :param columns: number of columns
+        :return: a list of slices
+        """
+        step = max(1, LinDAPrep.block_bytes // (8 * max(columns, 1)))
+        return [slice(i, min(i + step, rows)) for i in range(0, rows, step)]
+
+    @staticmethod
+    def blocks(F: np.ndarray, columns: np.ndarray = None):
+        """
+        Iterates over row blocks of F as float64, optionally restricted to a subset of columns.
+        :param F: the feature matrix, taxa x samples
+        :param columns: column positions or None for all columns
+        :return: generator of (slice, block)
+        """
+        # the rows are read with all columns before the columns are selected
+        for rows in LinDAPrep.row_blocks(*F.shape):
+            block = F[rows] if columns is None else F[rows][:, columns]
+            yield rows, np.asarray(block, dtype=float)
+
+    @staticmethod
+    def column_sums(F: np.ndarray, columns: np.ndarray = None, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Library sizes, i.e. the column sums of F, optionally restricted to a boolean mask of rows.
+        """
+        if sparse.issparse(F):
+            F = F if rows is None else sparse.csr_matrix(F)[np.flatnonzero(rows)]
+            return np.asarray((F if columns is None else F[:, columns]).sum(axis=0), dtype=float).ravel()
+        total = np.zeros(F.shape[1] if columns is None else len(columns))
+        for block_rows, block in LinDAPrep.blocks(F, columns):
+            total += (block if rows is None else block[rows[block_rows]]).sum(axis=0)
+        return total
+
+    @staticmethod
+    def taxa_sums(F: np.ndarray) -> np.ndarray:
+        """
+        Sum of the relative abundances of each taxon over all samples.
+        """
+        library = LinDAPrep.column_sums(F)
+        if sparse.issparse(F):
+            # as for the dense matrix, an empty sample makes all relative abundances undefined
+            if (library == 0).any():
+                return np.full(F.shape[0], np.nan)
+            return LinDAPrep.relative_rows(sparse.csr_matrix(F), library).sum(axis=1).A1
+        sums = np.empty(F.shape[0])
+        for rows, block in LinDAPrep.blocks(F):
+            sums[rows] = (block / library).sum(axis=1)
+        return sums
+
+    @staticmethod
+    def row_sums_of_squares(Y: np.ndarray) -> np.ndarray:
+        """
+        Sum of squares of each feature (row), e.g. of the CLR values for the residual sums of squares.
+        """
+        sums = np.empty(Y.shape[0])
+        for rows in LinDAPrep.row_blocks(*Y.shape):
+            sums[rows] = np.einsum("ij,ij->i", Y[rows], Y[rows])
+        return sums
+
+    @staticmethod
+    def filter_features(F: np.ndarray, columns: np.ndarray, prevalence: float = 0.0, mean_abundance: float = 0.0,
+                        max_abundance: float = 0.0) -> np.ndarray:
+        """
+        Prevalence and abundance filter on the relative abundances of the selected samples.
+        :param F: the feature matrix, taxa x samples
+        :param columns: positions of the selected samples
+        :param prevalence: minimal fraction of samples with a non-zero value
+        :param mean_abundance: minimal mean relative abundance
+        :param max_abundance: minimal maximal relative abundance
+        :return: boolean mask of the features to keep
+        """
+        library = LinDAPrep.column_sums(F, columns)
+        if sparse.issparse(F):
+            if (library == 0).any():
+                return np.zeros(F.shape[0], dtype=bool)
+            R = LinDAPrep.relative_rows(sparse.csr_matrix(F[:, columns]), library)
+            return ((R.getnnz(axis=1) / R.shape[1] >= prevalence) & (R.sum(axis=1).A1 / R.shape[1] >= mean_abundance)
+                    & (R.max(axis=1).toarray().ravel() >= max_abundance))
+        keep = np.empty(F.shape[0], dtype=bool)
+        for rows, block in LinDAPrep.blocks(F, columns):
+            block /= library
+            keep[rows] = (((block != 0).mean(axis=1) >= prevalence) & (block.mean(axis=1) >= mean_abundance)
+                          & (block.max(axis=1) >= max_abundance))
+        return keep
+
+    @staticmethod
+    def select(F: np.ndarray, rows: np.ndarray, columns: np.ndarray, out_of_core: bool = False) -> np.ndarray:
+        """
+        Creates the working copy: the selected features and samples as a contiguous float64 matrix.
+        :param F: the feature matrix, taxa x samples
+        :param rows: boolean mask of the features
+        :param columns: positions of the samples
+        :param out_of_core: memory-maps the working copy to a temporary file
+        :return: the working matrix, a CSR matrix for sparse input
+        """
+        positions = np.flatnonzero(rows)
+        if sparse.issparse(F):
+            Y = sparse.csr_matrix(F)[positions][:, columns].astype(float)
+            Y.eliminate_zeros()
+            return Y
+        if out_of_core:
+            Y = np.memmap(tempfile.TemporaryFile(), dtype=float, mode="w+", shape=(len(positions), len(columns)))
+        else:
+            Y = np.empty((len(positions), len(columns)))
+        for block in LinDAPrep.row_blocks(len(positions), len(columns)):
+            Y[block] = F[positions[block]][:, columns]
+        return Y
+
+    @staticmethod
+    def winsorize(Y: np.ndarray, quan: float, feature_dat_type: str = "count") -> np.ndarray:
+        """
+        In-place winsorization: values above the per-taxon quantile are clipped to that quantile. Counts are clipped on
+        the relative scale and scaled back to (rounded) counts.
+        :param Y: the working matrix, taxa x samples
+        :param quan: the quantile, e.g. 0.97
+        :param feature_dat_type: "count" or "proportion"
+        :return: Y
+        """
+        if sparse.issparse(Y):
+            return LinDAPrep.winsorize_sparse(Y, quan, feature_dat_type)
+        library = LinDAPrep.column_sums(Y) if feature_dat_type == "count" else None
+        for rows in LinDAPrep.row_blocks(*Y.shape):
+            block = Y[rows]
+            if library is not None:
+                block /= library
+            cut = np.quantile(block, quan, axis=1)
+            np.minimum(block, cut[:, None], out=block)
+            if library is not None:
+                block *= library
+                np.round(block, out=block)
+        return Y
+
+    @staticmethod
+    def winsorize_sparse(Y: sparse.csr_matrix, quan: float, feature_dat_type: str = "count") -> sparse.csr_matrix:
+        """
+        In-place winsorization of a CSR matrix with non-negative values, same result as winsorize on the dense matrix.
+        """
+        library = LinDAPrep.column_sums(Y) if feature_dat_type == "count" else None
+        if library is not None:
+            Y.data /= library[Y.indices]
+        Y.data = np.minimum(Y.data, np.repeat(LinDAPrep.row_quantiles(Y, quan), np.diff(Y.indptr)))
+        if library is not None:
+            Y.data *= library[Y.indices]
+            np.round(Y.data, out=Y.data)
+        Y.eliminate_zeros()
+        return Y
+
+    @staticmethod
+    def row_quantiles(Y: sparse.csr_matrix, quan: float) -> np.ndarray:
+        """
+        Per-row quantiles of a CSR matrix with non-negative values, the implicit zeros included. Follows the linear
+        interpolation of np.quantile.
+        :param Y: the matrix
+        :param quan: the quantile
+        :return: one quantile per row
+        """
+        n = Y.shape[1]
+        counts = np.diff(Y.indptr)
+        rows = np.repeat(np.arange(Y.shape[0]), counts)
+        values = Y.data[np.lexsort((Y.data, rows))]
+
+        virtual = (n - 1) * quan
+        previous = min(math.floor(virtual), n - 1)
+        following = min(previous + 1, n - 1)
+        gamma = virtual - math.floor(virtual) if virtual < n - 1 else 0.0
+
+        def order_statistic(k):
+            # the first n - nnz order statistics of a row are its implicit zeros
+            position = k - (n - counts)
+            stored = position >= 0
+            result = np.zeros(Y.shape[0])
+            result[stored] = values[Y.indptr[:-1][stored] + position[stored]]
+            return result
+
+        a, b = order_statistic(previous), order_statistic(following)
+        difference = b - a
+        return b - difference * (1 - gamma) if gamma >= 0.5 else a + difference * gamma
+
+    @staticmethod
+    def relative_rows(F: sparse.csr_matrix, library: np.ndarray) -> sparse.csr_matrix:
+        """
+        Relative abundances of a CSR matrix, scaled by the library sizes.
+        """
+        with np.errstate(divide="ignore"):
+            return F.multiply(1 / library).tocsr()
+
+    @staticmethod
+    def nonzero_counts(Y) -> np.ndarray:
+        """
+        Number of non-zero values of each feature (row).
+        """
+        if sparse.issparse(Y):
+            return sparse.csr_matrix(Y).getnnz(axis=1)
+        counts = np.empty(Y.shape[0], dtype=int)
+        for rows in LinDAPrep.row_blocks(*Y.shape):
+            counts[rows] = (Y[rows] != 0).sum(axis=1)
+        return counts
+
+    @staticmethod
+    def has_zeros(Y: np.ndarray) -> bool:
+        if sparse.issparse(Y):
+            return Y.count_nonzero() < Y.shape[0] * Y.shape[1]
+        for rows in LinDAPrep.row_blocks(*Y.shape):
+            if (Y[rows] == 0).any():
+                return True
+        return False
+
+    @staticmethod
+    def impute(Y: np.ndarray, library: np.ndarray) -> np.ndarray:
+        """
+        In-place imputation of zero counts: a zero in sample j becomes N_j / max(N over the zero samples of the taxon).
+        :param Y: the working matrix, taxa x samples
+        :param library: the library sizes N
+        :return: Y
+        """
+        for rows in LinDAPrep.row_blocks(*Y.shape):
+            block = Y[rows]
+            zeros = block <= 0
+            maximum = np.where(zeros, library, 0).max(axis=1)
+            maximum[maximum == 0] = 1
+            block += zeros * (library[None, :] / maximum[:, None])
+        return Y
+
+    @staticmethod
+    def half_minimum(Y: np.ndarray) -> np.ndarray:
+        """
+        In-place replacement of zero proportions by half of the smallest non-zero proportion.
+        """
+        minimum = np.inf
+        for rows in LinDAPrep.row_blocks(*Y.shape):
+            block = Y[rows]
+            if (block != 0).any():
+                minimum = min(minimum, block[block != 0].min())
+        for rows in LinDAPrep.row_blocks(*Y.shape):
+            block = Y[rows]
+            block[block == 0] = minimum * 0.5
+        return Y
+
+    @staticmethod
+    def clr(Y: np.ndarray) -> np.ndarray:
+        """
+        In-place centered log-ratio transformation (log2), centered per sample. The sample means are accumulated in a
+        first pass over the blocks.
+        """
+        means = np.zeros(Y.shape[1])
+        for rows in LinDAPrep.row_blocks(*Y.shape):
+            block = Y[rows]
+            np.log2(block, out=block)
+            means += block.sum(axis=0)
+        means /= Y.shape[0]
+        for rows in LinDAPrep.row_blocks(*Y.shape):
+            Y[rows] -= means
+        return Y
+
+    @staticmethod
+    def prepare(F: np.ndarray, columns: np.ndarray, prevalence: float = 0.0, mean_abundance: float = 0.0,
+                max_abundance: float = 0.0, winsor_quantile: float = None, feature_dat_type: str = "count",
+                out_of_core: bool = False) -> tuple:
+        """
+        First part of the pipeline: feature filter, working copy, removal of empty samples and winsorization.
+        :param F: the feature matrix, taxa x samples
+        :param columns: positions of the selected samples
+        :param prevalence: prevalence filter
+        :param mean_abundance: mean abundance filter
+        :param max_abundance: max abundance filter
+        :param winsor_quantile: quantile for the winsorization, None disables it
+        :param feature_dat_type: "count" or "proportion"
+        :param out_of_core: memory-maps the working copy to a temporary file
+        :return: working matrix, mask of the kept features, mask of the kept (non-empty) samples
+        """
+        with LinDAProfiler.stage("filtering", F.shape[0], len(columns)):
+            keep_tax = LinDAPrep.filter_features(F, columns, prevalence, mean_abundance, max_abundance)
+            keep_lib = LinDAPrep.column_sums(F, columns, keep_tax) > 0
+            Y = LinDAPrep.select(F, keep_tax, np.asarray(columns)[keep_lib], out_of_core)
+
+        if winsor_quantile is not None:
+            with LinDAProfiler.stage("winsorization", *Y.shape):
+                LinDAPrep.winsorize(Y, winsor_quantile, feature_dat_type)
+
+        return Y, keep_tax, keep_lib
+
+    @staticmethod
+    def transform(Y: np.ndarray, zero_handling: str = "pseudo_count", pseudo_count: float = 0.5,
+                  feature_dat_type: str = "count") -> np.ndarray:
+        """
+        Second part of the pipeline, in place: zero handling and CLR transformation. A sparse working matrix is
+        densified first.
+        :param Y: the working matrix, taxa x samples
+        :param zero_handling: "Imputation" or a pseudo-count method, only used for counts
+        :param pseudo_count: the pseudo-count
+        :param feature_dat_type: "count" or "proportion"
+        :return: Y, holding the CLR transformed values
+        """
+        if sparse.issparse(Y):
+            Y = Y.toarray()
+        with LinDAProfiler.stage("zero handling", *Y.shape):
+            if feature_dat_type == "count" and LinDAPrep.has_zeros(Y):
+                if zero_handling == "Imputation":
+                    LinDAPrep.impute(Y, LinDAPrep.column_sums(Y))
+                else:
+                    for rows in LinDAPrep.row_blocks(*Y.shape):
+                        Y[rows] += pseudo_count
+            elif feature_dat_type == "proportion" and LinDAPrep.has_zeros(Y):
+                LinDAPrep.half_minimum(Y)
+
+        with LinDAProfiler.stage("clr", *Y.shape):
+            return LinDAPrep.clr(Y)
@@ -0,0 +1,131 @@
+import contextlib
+import json
+import time
+import tracemalloc
+
+"""
+LinDA profiling
+
+Per-stage instrumentation of the LinDA pipeline. Every stage records its wall time, CPU time (of the process), the
+number of rows and columns it processed and the peak of the memory allocated during the stage (tracemalloc, relative
+to the allocations at the start of the stage). Stages may be nested, e.g. the winsorization within the
+preprocessing.
+
+Disabled (the default), LinDAProfiler.stage returns a no-op context manager yielding a throwaway record, so the
+instrumentation costs a function call per stage.
+"""
+
+__version__ = "1.0.0"
+__author__ = "Leon Fehse, Mohammad Tajabadi, Roman Martin"
+__credits__ = "Heinrich Heine University Düsseldorf"
+
+
+class LinDAProfiler:
+
+    # the enabled profiler, None if profiling is disabled
+    active = None
+
+    def __init__(self, memory: bool = True):
+        """
+        :param memory: traces the peak allocations per stage (tracemalloc slows down allocations)
+        """
+        self.memory = memory
+        self.records: list = []
+        self.stack: list = []
+        self.started_tracing = False
+
+    @staticmethod
+    def enable(memory: bool = True):
+        """
+        Enables the profiling of all following stages.
+        :return: the profiler
+        """
+        profiler = LinDAProfiler(memory)
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            profiler.started_tracing = True
+        LinDAProfiler.active = profiler
+        return profiler
+
+    @staticmethod
+    def disable():
+        """
+        Disables the profiling.
+        :return: the profiler that was enabled or None
+        """
+        profiler = LinDAProfiler.active
+        LinDAProfiler.active = None
+        if profiler is not None and profiler.started_tracing:
+            tracemalloc.stop()
+        return profiler
+
+    @staticmethod
+    def stage(name: str, rows: int = 0, columns: int = 0):
+        """
+        Context manager measuring a stage. It yields the record of the stage, rows and columns may be set within the
+        stage if they are not known before.
+        :param name: name of the stage
+        :param rows: number of rows processed
+        :param columns: number of columns processed
+        """
+        if LinDAProfiler.active is None:
+            # a new record per stage, the stages write into it
+            return contextlib.nullcontext({})
+        return LinDAProfiler.active.measure(name, rows, columns)
+
+    @contextlib.contextmanager
+    def measure(self, name: str, rows: int = 0, columns: int = 0):
+        record = {"stage": name, "parent": self.stack[-1]["stage"] if len(self.stack) else None,
+                  "rows": int(rows), "columns": int(columns)}
+        self.records.append(record)
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if len(self.stack):
+                self.stack[-1]["_peak"] = max(self.stack[-1]["_peak"], peak)
+            self._reset_peak()
+            record["_start"] = record["_peak"] = current
+        self.stack.append(record)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter() - wall
+            record["cpu"] = time.process_time() - cpu
+            self.stack.pop()
+            if self.memory:
+                record["_peak"] = max(record["_peak"], tracemalloc.get_traced_memory()[1])
+                if len(self.stack):
+                    self.stack[-1]["_peak"] = max(self.stack[-1]["_peak"], record["_peak"])
+                self._reset_peak()
+                record["peak_bytes"] = record.pop("_peak") - record.pop("_start")
+
+    @staticmethod
+    def _reset_peak():
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    def summary(self) -> dict:
+        """
+        Totals per stage name: calls, wall and CPU time, rows and columns, maximal peak allocations.
+        """
+        summary = {}
+        for record in self.records:
+            total = summary.setdefault(record["stage"], {"calls": 0, "wall": 0.0, "cpu": 0.0, "rows": 0,
+                                                         "columns": 0, "peak_bytes": 0})
+            total["calls"] += 1
+            total["wall"] += record.get("wall", 0.0)
+            total["cpu"] += record.get("cpu", 0.0)
+            total["rows"] = max(total["rows"], record["rows"])
+            total["columns"] = max(total["columns"], record["columns"])
+            total["peak_bytes"] = max(total["peak_bytes"], record.get("peak_bytes", 0))
+        return summary
+
+    def report(self) -> dict:
+        return {"stages": self.records, "summary": self.summary()}
+
+    def write(self, path: str):
+        """
+        Writes the report as JSON.
+        """
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
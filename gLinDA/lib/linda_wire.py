@@ -0,0 +1,171 @@
+import json
+import struct
+
+import numpy as np
+import pandas as pd
+
+from gLinDA.lib.errors import LindaWrongData
+
+"""
+LinDA wire format
+
+Binary serialization of the swarm learning parameters (LinDA.run_sl: the coefficient frames per variable, the biases,
+the formula and the sample size) and of formula batches (LinDA.run_sl_batch), replacing the pickled DataFrames.
+
+Layout (little-endian): a fixed header (magic, version, bytes per value, length of the schema), the JSON schema and
+the data section, aligned to 8 bytes. The schema holds the formulas, sizes and biases, the names of the variables and
+columns, the offsets of their data and the taxa dictionary: every taxon name is stored once for all variables and
+formulas. A variable whose taxa differ from the dictionary stores the uint32 dictionary codes of its rows. Every
+column is one contiguous float64 (or float32) array.
+
+Decoding reads the schema only and maps the columns with np.frombuffer onto the payload, the frames are read-only
+views without copies. Single variables or formulas can be decoded without touching the data of the others.
+"""
+
+__version__ = "1.0.0"
+__author__ = "Leon Fehse, Mohammad Tajabadi, Roman Martin"
+__credits__ = "Heinrich Heine University Düsseldorf"
+
+
+class LinDAWire:
+
+    magic: bytes = b"GLWF"
+    version: int = 1
+    # magic, version, bytes per value, reserved, length of the schema
+    header = struct.Struct("<4sBBHI")
+    precisions: dict = {"float64": np.dtype("<f8"), "float32": np.dtype("<f4")}
+    codes = np.dtype("<u4")
+    alignment: int = 8
+
+    @staticmethod
+    def encode(parameters: dict, precision: str = "float64") -> bytes:
+        """
+        Serializes the parameters of LinDA.run_sl.
+        :param parameters: dictionary of coefs, biases, formula and size
+        :param precision: float64 or float32 (halves the payload, about 7 significant digits)
+        :return: the payload
+        """
+        return LinDAWire.__encode([parameters], precision, False)
+
+    @staticmethod
+    def encode_batch(batch: dict, precision: str = "float64") -> bytes:
+        """
+        Serializes the parameters of a formula batch (LinDA.run_sl_batch), the taxa are shared by all formulas.
+        """
+        return LinDAWire.__encode([dict(parameters, formula=formula) for formula, parameters in batch.items()],
+                                  precision, True)
+
+    @staticmethod
+    def schema(payload) -> dict:
+        """
+        Reads the header and the schema of a payload.
+        :return: the schema, with the offset of the data section as "data"
+        """
+        view = memoryview(payload)
+        if len(view) < LinDAWire.header.size:
+            raise LindaWrongData("Error: The payload is too short for the LinDA wire format")
+        magic, version, itemsize, _, length = LinDAWire.header.unpack_from(view)
+        if magic != LinDAWire.magic:
+            raise LindaWrongData("Error: The payload is not in the LinDA wire format")
+        if version != LinDAWire.version:
+            raise LindaWrongData("Error: Unsupported version %d of the LinDA wire format" % version)
+        start = LinDAWire.header.size
+        if start + length > len(view):
+            raise LindaWrongData("Error: The schema exceeds the payload")
+        schema = json.loads(bytes(view[start:start + length]).decode("utf8"))
+        schema["data"] = LinDAWire.__align(start + length)
+        schema["itemsize"] = itemsize
+        return schema
+
+    @staticmethod
+    def decode(payload, variables: list = None) -> dict:
+        """
+        Deserializes a payload, the frames are read-only views of the payload.
+        :param payload: the payload (bytes, bytearray or memoryview)
+        :param variables: decodes only these variables, all if None
+        :return: the parameters (as LinDA.run_sl) or the parameters per formula of a batch
+        """
+        view = memoryview(payload)
+        schema = LinDAWire.schema(view)
+        dtype = {d.itemsize: d for d in LinDAWire.precisions.values()}.get(schema["itemsize"])
+        if dtype is None:
+            raise LindaWrongData("Error: Unsupported value size %d of the LinDA wire format" % schema["itemsize"])
+        taxa = pd.Index(schema["taxa"])
+
+        models = []
+        for model in schema["models"]:
+            coefs = {}
+            for variable in model["variables"]:
+                if variables is not None and variable["name"] not in variables:
+                    continue
+                offset = schema["data"] + variable["offset"]
+                rows, columns = variable["rows"], variable["columns"]
+                if variable["coded"]:
+                    codes = LinDAWire.__array(view, LinDAWire.codes, offset, rows)
+                    if len(codes) and codes.max() >= len(taxa):
+                        raise LindaWrongData("Error: Unknown taxon in the payload")
+                    index = taxa.take(codes)
+                    offset += LinDAWire.__align(rows * LinDAWire.codes.itemsize)
+                else:
+                    index = taxa
+                values = LinDAWire.__array(view, dtype, offset, rows * len(columns)).reshape(len(columns), rows)
+                # the column-major block is the layout of a single pandas block, no copy
+                coefs[variable["name"]] = pd.DataFrame(values.T, index=index, columns=columns, copy=False)
+            models.append({"coefs": coefs, "biases": model["biases"], "formula": model["formula"],
+                           "size": model["size"]})
+
+        if schema["batch"]:
+            return {model["formula"]: model for model in models}
+        return models[0]
+
+    @staticmethod
+    def __encode(models: list, precision: str, batch: bool) -> bytes:
+        if precision not in LinDAWire.precisions:
+            raise LindaWrongData("Error: Unknown precision %s, expecting one of %s" %
+                                 (precision, list(LinDAWire.precisions)))
+        dtype = LinDAWire.precisions[precision]
+
+        # the taxa dictionary: the taxa of the first variable, extended by the taxa missing in it
+        taxa = None
+        for model in models:
+            for frame in model["coefs"].values():
+                taxa = frame.index if taxa is None else taxa.append(frame.index.difference(taxa, sort=False))
+        taxa = pd.Index([]) if taxa is None else taxa
+
+        blocks, offset, schema_models = [], 0, []
+        for model in models:
+            schema_variables = []
+            for name, frame in model["coefs"].items():
+                coded = not frame.index.equals(taxa)
+                entry = {"name": name, "rows": len(frame), "columns": [str(c) for c in frame.columns],
+                         "coded": coded, "offset": offset}
+                if coded:
+                    codes = taxa.get_indexer(frame.index).astype(LinDAWire.codes)
+                    blocks.append(LinDAWire.__pad(codes.tobytes()))
+                    offset += len(blocks[-1])
+                # one contiguous array per column
+                values = np.ascontiguousarray(frame.to_numpy(dtype=float).T, dtype=dtype)
+                blocks.append(LinDAWire.__pad(values.tobytes()))
+                offset += len(blocks[-1])
+                schema_variables.append(entry)
+            schema_models.append({"formula": model["formula"], "size": int(model["size"]),
+                                  "biases": {k: float(v) for k, v in model["biases"].items()},
+                                  "variables": schema_variables})
+
+        schema = json.dumps({"batch": batch, "taxa": taxa.tolist(), "models": schema_models}).encode("utf8")
+        header = LinDAWire.header.pack(LinDAWire.magic, LinDAWire.version, dtype.itemsize, 0, len(schema))
+        return LinDAWire.__pad(header + schema) + b"".join(blocks)
+
+    @staticmethod
+    def __array(view: memoryview, dtype: np.dtype, offset: int, count: int) -> np.ndarray:
+        if offset + count * dtype.itemsize > len(view):
+            raise LindaWrongData("Error: The data exceeds the payload")
+        return np.frombuffer(view, dtype=dtype, count=count, offset=offset)
+
+    @staticmethod
+    def __align(length: int) -> int:
+        return -(-length // LinDAWire.alignment) * LinDAWire.alignment
+
+    @staticmethod
+    def __pad(data: bytes) -> bytes:
+        return data + bytes(LinDAWire.__align(len(data)) - len(data))
@@ -1,13 +1,22 @@
+import importlib
+import random
+import socket
+import time
+import zlib
 from pickle import loads, dumps
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from copy import deepcopy
 from natsort import natsorted
 
 from Crypto.Hash import MD5, SHA256, SHA512
 from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad, unpad
 
+from gLinDA.lib.errors import GlindaP2PProtocolError
+from gLinDA.lib.p2p_pkg import P2PPackage, P2PFrameReader
+
 """
 P2P
 
@@ -37,12 +46,41 @@ class Keyring:
     # only required for AES encryption
     _iv = None
 
+    # negotiated chunk sizes of the peers for submitting data
+    _chunk_sizes: dict = {}
+
+    # bitmasks of the compression codecs the peers can decode
+    _codecs: dict = {}
+
+    # initial keys derived from the passwords
+    _init_keys: dict = {}
+
+    # the current broadcast round, every peer counts its broadcasts
+    _round: int = 0
+
+    # the server and the client of a participant share the keyring, its keys are created only once
+    lock = Lock()
+
     def __init__(self):
         pass
 
     def __len__(self):
         return len(self._peers["R"].keys()) + len(self._peers["S"].keys())
 
+    @staticmethod
+    def reset():
+        """
+        Forgets all keys, e.g. before a new handshake.
+        """
+        Keyring._peers["R"].clear()
+        Keyring._peers["S"].clear()
+        Keyring._keys.update({"S": (), "C": ()})
+        Keyring._chunk_sizes.clear()
+        Keyring._codecs.clear()
+        Keyring._init_keys.clear()
+        Keyring._iv = None
+        Keyring._round = 0
+
     def add_peer(self, identifier, aes_key: bytes, receiver: bool = True):
         self._peers["R" if receiver else "S"].update({identifier: aes_key})
 
@@ -58,9 +96,38 @@ class Keyring:
     def get_iv(self):
         return self._iv
 
+    def set_chunk_size(self, host: str, chunk_size: int):
+        self._chunk_sizes.update({host: chunk_size})
+
+    def chunk_size_for(self, host: str) -> int:
+        return self._chunk_sizes[host]
+
+    def set_codecs(self, host: str, codecs: int):
+        self._codecs.update({host: codecs})
+
+    def get_codecs(self) -> dict:
+        return self._codecs
+
+    def set_init_key(self, password: str, init_key: bytes):
+        self._init_keys.update({password: init_key})
+
+    def get_init_key(self, password: str):
+        return self._init_keys.get(password)
+
     def set_iv(self, init_vector: bytes):
         self._iv = init_vector
 
+    def get_round(self) -> int:
+        return self._round
+
+    def next_round(self) -> int:
+        """
+        Starts the next broadcast round.
+        :return: the round
+        """
+        self._round += 1
+        return self._round
+
     def set_keys(self, keys: tuple, server: bool = True):
         self._keys["S" if server else "C"] = keys
 
@@ -74,37 +141,234 @@ class P2P:
     max_rand: int = 9999999
     bytes_len: int = 3
     waiting_time: int = 1
-    chunk_size: int = 4096
+    chunk_size: int = 1048576
+    min_chunk_size: int = 65536
+    max_chunk_size: int = 4194304
+    chunk_bytes: int = 4
+    codec_bytes: int = 1
+    retry_delay: float = 0.05
+    send_retries: int = 3
+    accept_interval: float = 0.05
     symmetric = False
 
+    # acknowledgement of a completely received payload, refusal of a peer not ready for payloads
+    ack: bytes = b"\x06"
+    nak: bytes = b"\x15"
+
     def __init__(self, config: dict, keyring: Keyring = None):
         self.keyring = keyring
         self.config: dict = config
         self.verbose: int = self.config["verbose"]
         self.host: str = self.config["host"]
         self.peers: list = self.config["peers"]
-        self.encryption = EncryptionAsymmetric() if self.config["asymmetric"] else EncryptionSymmetric(self.config)
-        self.init_key = None
+        # the handshake is encrypted symmetrically, the payloads are sealed in envelopes
+        self.encryption = EncryptionSymmetric(self.config)
+        self.chunk_size: int = self.clamp_chunk_size(self.config["chunk_size"])
 
-        if not len(keyring):
+        with Keyring.lock:
             # Create asymmetric keys
-            if self.config["asymmetric"]:
+            if self.config["asymmetric"] and not len(self.keyring.get_keys(True)):
                 self.keyring.set_keys(EncryptionAsymmetric().get_key(verbose=self.verbose >= 1), True)
                 self.keyring.set_keys(EncryptionAsymmetric().get_key(verbose=self.verbose >= 1), False)
 
-            # initially symmetric encryption
-            self.encryption = EncryptionSymmetric(self.config)
-            self.init_key = self.encryption.get_key(self.config["password"])
-            initialization_vector: bytes = self.encryption.get_iv()
-            self.encryption.set_init_vector(initialization_vector)
-            self.keyring.set_iv(initialization_vector)
+            if self.keyring.get_init_key(self.config["password"]) is None:
+                self.keyring.set_init_key(self.config["password"], self.encryption.get_key(self.config["password"]))
+            if not len(keyring):
+                self.keyring.set_iv(self.encryption.get_iv())
+        self.init_key = self.keyring.get_init_key(self.config["password"])
+        self.encryption.set_init_vector(self.keyring.get_iv())
 
     def set_waiting_time(self, waiting_time: int):
         self.waiting_time = waiting_time
 
+    def connect(self, peer: str) -> socket.socket:
+        """
+        Connects to a peer, retrying with a growing delay (up to waiting_time) while the peer is not listening yet.
+        :param peer: the peer address, host:port
+        :return: the connected socket
+        """
+        host, port = peer.split(":")
+        delay = self.retry_delay
+        while True:
+            try:
+                return socket.create_connection((host, int(port)))
+            except ConnectionRefusedError:
+                if self.verbose >= 1:
+                    print("P2P #1: Are you sure the peer %s is reachable? Retry in %.2f s" % (peer, delay))
+                time.sleep(delay)
+                delay = min(2 * delay, self.waiting_time)
+
+    @staticmethod
+    def clamp_chunk_size(chunk_size: int) -> int:
+        """
+        Limits a chunk size to the range supported by the protocol.
+        """
+        return min(max(int(chunk_size), P2P.min_chunk_size), P2P.max_chunk_size)
+
+    def control_frame(self, payload: bytes) -> bytes:
+        """
+        Builds a single control frame, e.g. of the handshake.
+        """
+        pkg = P2PPackage(self.bytes_len, self.verbose)
+        pkg.set_payload(payload)
+        pkg.set_stop(True)
+        return pkg.build_binary_package()
+
+    def send_frame(self, conn: socket.socket, payload: bytes):
+        conn.sendall(self.control_frame(payload))
+
+    def receive_frame(self, conn: socket.socket):
+        """
+        Receives a single control frame, e.g. of the handshake.
+        :return: the payload or None if the connection was closed before
+        """
+        pkg = P2PFrameReader(self.min_chunk_size, self.bytes_len, self.verbose).read(conn)
+        return None if pkg is None else pkg.get_payload()
+
     def get_init_key(self):
         return self.init_key
 
+    def handshake_request(self) -> tuple:
+        """
+        Client side of the handshake: a random number, the proposed chunk size and (RSA) the own public key,
+        encrypted with the initial key derived from the password.
+        :return: the random number and the encrypted message
+        """
+        random_number = random.randint(self.min_rand, self.max_rand)
+        msg = random_number.to_bytes(self.bytes_len, "big") + self.chunk_size.to_bytes(self.chunk_bytes, "big")
+        if self.config["asymmetric"]:
+            msg += self.keyring.get_keys(False)[1]  # public key
+
+        enc_msg = self.encryption.encrypt(msg, self.get_init_key())
+        if self.verbose >= 2:
+            print("ClientHandshake #2: Send raw msg %s" % enc_msg)
+        return random_number, enc_msg
+
+    def handshake_reply(self, data: bytes):
+        """
+        Server side of the handshake: registers the key of the client and answers with the confirmation number
+        (random number + 1), the agreed chunk size, the compression codecs this peer can decode and the key for
+        sending data to this peer.
+        :param data: the encrypted message of the client
+        :return: the encrypted answer or None if the message could not be decrypted
+        """
+        init_aes_key = self.get_init_key()
+
+        if self.verbose >= 3:
+            print("ServerHandshake #3: Data received %s" % data)
+            print("ServerHandshake #3: Use decryption key %s" % init_aes_key)
+
+        data_decrypted = self.encryption.decrypt(data, init_aes_key)
+
+        if data_decrypted is None:
+            if self.verbose >= 1:
+                print("ServerHandshake #1: Received data which can not decrypted")
+            return None
+
+        # the chunk size proposed by the client, agreed is the smaller one of both peers
+        header_length = self.bytes_len + self.chunk_bytes
+        chunk_size = self.clamp_chunk_size(min(int.from_bytes(data_decrypted[self.bytes_len:header_length], "big"),
+                                               self.chunk_size))
+        rsa_key: bytes = bytes()
+        if self.config["asymmetric"] and len(data_decrypted) > header_length:
+            rsa_key = data_decrypted[header_length:]
+        data_decrypted = data_decrypted[:self.bytes_len]
+
+        decrypted_number = int.from_bytes(data_decrypted, "big")
+
+        if not (self.min_rand <= decrypted_number <= self.max_rand):
+            if self.verbose >= 1:
+                print("ServerHandshake #1: Received data which can not decrypted")
+            return None
+
+        if self.verbose >= 2:
+            print("ServerHandshake #2: Data decrypted received %s" % data_decrypted)
+            print("ServerHandshake #2: Decrypted number %d, chunk size %d" % (decrypted_number, chunk_size))
+
+        confirmation_number = decrypted_number + 1
+
+        # RSA
+        if self.config["asymmetric"] and len(rsa_key):
+            new_key = self.keyring.get_keys(True)[1]
+            self.keyring.add_peer(confirmation_number, rsa_key)
+        # AES, a random key needs no key derivation
+        else:
+            new_key = get_random_bytes(Envelope.key_bytes)
+            self.keyring.add_peer(confirmation_number, new_key, True)
+
+        return self.encryption.encrypt(
+            confirmation_number.to_bytes(self.bytes_len, "big") + chunk_size.to_bytes(self.chunk_bytes, "big")
+            + Compression.mask().to_bytes(self.codec_bytes, "big") + new_key, init_aes_key)
+
+    def handshake_confirm(self, peer: str, random_number: int, data: bytes) -> bool:
+        """
+        Client side of the handshake: checks the answer of the peer and registers its key.
+        :param peer: the peer address
+        :param random_number: the random number sent to the peer
+        :param data: the encrypted answer of the peer
+        :return: True if the peer confirmed the random number
+        """
+        init_aes_key = self.get_init_key()
+        if self.verbose >= 2:
+            print("ClientHandshake #2: Received answer encrypted %s" % data)
+            print("ClientHandshake #2: Will use decryption key %s" % init_aes_key)
+
+        answer = self.encryption.decrypt(data, init_aes_key)
+        if answer is None:
+            print("Client #1: Confirmation with %s failed, ignore peer" % peer)
+            return False
+
+        confirmation_number = int.from_bytes(answer[:self.bytes_len], "big")
+        chunk_end = self.bytes_len + self.chunk_bytes
+        chunk_size = int.from_bytes(answer[self.bytes_len:chunk_end], "big")
+        codecs = int.from_bytes(answer[chunk_end:chunk_end + self.codec_bytes], "big")
+
+        if confirmation_number != (random_number + 1):
+            print("Client #1: Confirmation with %s failed, ignore peer" % peer)
+            return False
+
+        if self.verbose >= 1:
+            print("Client #1: Encrypted communication was successful")
+        self.keyring.add_peer(peer, (confirmation_number, answer[chunk_end + self.codec_bytes:]), False)
+        self.keyring.set_chunk_size(peer, self.clamp_chunk_size(chunk_size))
+        self.keyring.set_codecs(peer, codecs)
+        return True
+
+    def encrypt_payload(self, peer: str, sealed: tuple) -> tuple:
+        """
+        Addresses a sealed payload to a peer: only the session key is encrypted for the peer.
+        :param peer: the peer address
+        :param sealed: the session key and the sealed payload (Envelope.seal)
+        :return: the identifier of this participant at the peer and the envelope
+        """
+        identifier, encrypt_key = self.keyring.for_submission(peer)
+        if self.verbose >= 3:
+            print("Client #3: target id %d, key %s" % (identifier, encrypt_key))
+        session_key, body = sealed
+        return identifier, Envelope.wrap(session_key, encrypt_key, self.config["asymmetric"]) + body
+
+    def decrypt_payload(self, identifier: int, envelope: bytes) -> bytes:
+        """
+        Opens the envelope received from a peer.
+        :param identifier: the identifier of the peer
+        :param envelope: the reassembled envelope
+        :return: the raw payload
+        """
+        if self.config["asymmetric"]:
+            decrypt_key = self.keyring.get_keys(True)[0]
+        else:
+            decrypt_key = self.keyring.for_reception(identifier)
+
+        if self.verbose >= 2:
+            print("Server #2: Use decryption key %s" % decrypt_key)
+
+        payload = Envelope.open(envelope, decrypt_key, self.config["asymmetric"])
+        if payload is None:
+            print("Crypto: Authentication failed, probably wrong key?")
+            if not self.config["ignore_keys"]:
+                exit(201)
+        return payload
+
 class EncryptionSymmetric:
 
     _init_vector: bytes = bytes
@@ -222,6 +486,166 @@ class EncryptionAsymmetric:
         return key.export_key(), key.public_key().export_key()
 
 
+class Envelope:
+    """
+    Envelope encryption of the payloads: the payload is encrypted once with a random session key (AES-GCM,
+    authenticated), only the session key is encrypted for every peer, with its RSA public key (PKCS1 OAEP) or its AES
+    key (AES-GCM). The envelope is the length of the wrapped session key (2 bytes), the wrapped session key, the nonce,
+    the tag and the encrypted payload.
+    """
+
+    key_bytes: int = 32
+    nonce_bytes: int = 12
+    tag_bytes: int = 16
+    length_bytes: int = 2
+
+    @staticmethod
+    def seal(data: bytes) -> tuple:
+        """
+        Encrypts a payload with a new session key.
+        :return: the session key and the sealed payload (nonce, tag and cipher)
+        """
+        session_key = get_random_bytes(Envelope.key_bytes)
+        body, nonce, tag = Envelope.__encrypt(data, session_key)
+        return session_key, nonce + tag + body
+
+    @staticmethod
+    def wrap(session_key: bytes, key: bytes, asymmetric: bool = False) -> bytes:
+        """
+        Encrypts the session key for a peer.
+        :param session_key: the session key of the sealed payload
+        :param key: the RSA public key or the AES key of the peer
+        :param asymmetric: RSA instead of AES
+        :return: the length of the wrapped session key and the wrapped session key
+        """
+        if asymmetric:
+            wrapped = EncryptionAsymmetric.encrypt(session_key, key)
+        else:
+            cipher, nonce, tag = Envelope.__encrypt(session_key, key)
+            wrapped = nonce + tag + cipher
+        return len(wrapped).to_bytes(Envelope.length_bytes, "big") + wrapped
+
+    @staticmethod
+    def open(envelope: bytes, key: bytes, asymmetric: bool = False):
+        """
+        Decrypts the session key and the payload of an envelope.
+        :param envelope: the envelope
+        :param key: the own RSA private key or the AES key of the peer
+        :param asymmetric: RSA instead of AES
+        :return: the payload or None if the envelope is not authentic or not for this key
+        """
+        envelope = memoryview(envelope)
+        length = int.from_bytes(envelope[:Envelope.length_bytes], "big")
+        wrapped = envelope[Envelope.length_bytes:Envelope.length_bytes + length]
+        body = envelope[Envelope.length_bytes + length:]
+        if asymmetric:
+            session_key = EncryptionAsymmetric.decrypt(bytes(wrapped), key)
+        else:
+            session_key = Envelope.__decrypt(wrapped, key)
+        if session_key is None or len(session_key) != Envelope.key_bytes:
+            return None
+        return Envelope.__decrypt(body, session_key)
+
+    @staticmethod
+    def __encrypt(data: bytes, key: bytes) -> tuple:
+        cipher = AES.new(key, AES.MODE_GCM, nonce=get_random_bytes(Envelope.nonce_bytes))
+        encrypted, tag = cipher.encrypt_and_digest(data)
+        return encrypted, cipher.nonce, tag
+
+    @staticmethod
+    def __decrypt(data, key: bytes):
+        header = Envelope.nonce_bytes + Envelope.tag_bytes
+        if len(data) < header:
+            return None
+        cipher = AES.new(key, AES.MODE_GCM, nonce=bytes(data[:Envelope.nonce_bytes]))
+        try:
+            return cipher.decrypt_and_verify(data[header:], data[Envelope.nonce_bytes:header])
+        except ValueError:
+            return None
+
+
+class Compression:
+    """
+    Compression of the payloads before their encryption. A compressed payload starts with the byte of its codec, so
+    every peer decodes the payloads of the others, independent of its own settings.
+    """
+
+    # codec byte of the payload, bit of the codec in the handshake bitmask
+    codecs: dict = {"none": 0, "zlib": 1, "lzma": 2, "bz2": 3}
+    modules: dict = {"none": None, "zlib": "zlib", "lzma": "lzma", "bz2": "bz2"}
+
+    @staticmethod
+    def available() -> list:
+        """
+        Codecs of this Python installation (lzma and bz2 are optional modules).
+        """
+        available = []
+        for codec, module in Compression.modules.items():
+            if module is None:
+                available.append(codec)
+                continue
+            try:
+                importlib.import_module(module)
+                available.append(codec)
+            except ImportError:
+                pass
+        return available
+
+    @staticmethod
+    def mask() -> int:
+        """
+        Bitmask of the available codecs, sent in the handshake.
+        """
+        return sum(1 << Compression.codecs[codec] for codec in Compression.available())
+
+    @staticmethod
+    def choose(preferred: str, masks: list) -> str:
+        """
+        The preferred codec if every peer decodes it, otherwise zlib or no compression.
+        :param preferred: the configured codec
+        :param masks: the bitmasks of the peers
+        :return: the codec
+        """
+        for codec in [preferred, "zlib"]:
+            if codec in Compression.available() and all(mask & (1 << Compression.codecs[codec]) for mask in masks):
+                return codec
+        return "none"
+
+    @staticmethod
+    def compress(data: bytes, codec: str, level: int = 6) -> bytes:
+        """
+        Compresses data.
+        :param data: the raw data
+        :param codec: one of Compression.codecs
+        :param level: the compression level (0 - 9, bz2 1 - 9)
+        :return: the codec byte and the compressed data
+        """
+        level = min(max(int(level), 0), 9)
+        if codec == "zlib":
+            data = zlib.compress(data, level)
+        elif codec == "lzma":
+            data = importlib.import_module("lzma").compress(data, preset=level)
+        elif codec == "bz2":
+            data = importlib.import_module("bz2").compress(data, max(level, 1))
+        return Compression.codecs[codec].to_bytes(1, "big") + data
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        """
+        Decompresses data of any codec.
+        :param data: the codec byte and the compressed data
+        :return: the raw data
+        """
+        codec = {v: k for k, v in Compression.codecs.items()}.get(data[0]) if len(data) else None
+        if codec is None:
+            raise GlindaP2PProtocolError("Compression: Unknown codec of the payload")
+        elif codec == "none":
+            return data[1:]
+        elif codec == "zlib":
+            return zlib.decompress(data[1:])
+        return importlib.import_module(Compression.modules[codec]).decompress(data[1:])
+
+
 class Runner:
 
     keyring: object = None
@@ -266,11 +690,18 @@ class Runner:
         bytes_coded_data: bytes = encode(data)
         if self.verbose >= 3:
             print("P2P Broadcast #3: unencrypted payload size: %d bytes" % len(bytes_coded_data))
-        reception = self.broadcast_raw(bytes_coded_data)
+
+        # the codec is chosen from the codecs all peers decode, compressed once for all peers
+        codec = Compression.choose(self.config["compression"], list(self.keyring.get_codecs().values()))
+        compressed: bytes = Compression.compress(bytes_coded_data, codec, self.config["compression_level"])
+        if self.verbose >= 1:
+            print("P2P Broadcast #1: payload %d bytes, %s compressed %d bytes (%.1f%%)" % (
+                len(bytes_coded_data), codec, len(compressed), 100 * len(compressed) / max(len(bytes_coded_data), 1)))
+        reception = self.broadcast_raw(compressed)
 
         for submitter in reception.keys():
-            bucket.append(decode(reception[submitter])) if as_list else (
-                bucket.update({submitter: decode(reception[submitter])}))
+            raw = Compression.decompress(reception[submitter])
+            bucket.append(decode(raw)) if as_list else bucket.update({submitter: decode(raw)})
 
         return bucket
 
@@ -280,6 +711,8 @@ class Runner:
         :param payload: the data to broadcast
         :return: a dictionary with all participants results
         """
+        # the frames carry the round, payloads sent again after a lost acknowledgement are told apart
+        self.keyring.next_round()
         if "test" in self.config and self.config["test"] == "r2client":
             client = self.run_client()
             client.send_payload(payload)
@@ -287,6 +720,12 @@ class Runner:
         elif "test" in self.config and self.config["test"] == "r2server":
             server = self.run_server()
             return server.get_answers()
+        elif self.config["transport"] == "asyncio":
+            from gLinDA.lib.p2p_async import AsyncP2P
+            results = AsyncP2P(self.config, self.keyring).broadcast(payload)
+            if self.verbose >= 1:
+                print("P2P Broadcast #1: Broadcasting finished")
+            return results
         else:
             if self.verbose >= 1:
                 print("P2P Broadcast #1: Starting server in a separate thread for broadcasting")
@@ -331,6 +770,10 @@ class Runner:
         Runs the multi-thread initialization, handshaking.
         :return: return a full keyring
         """
+        if self.config["transport"] == "asyncio":
+            from gLinDA.lib.p2p_async import AsyncP2P
+            return AsyncP2P(self.config, Keyring()).handshake()
+
         if self.verbose >= 1:
             print("Starting server in a separate thread for handshaking")
         server_ready: Event = Event()
@@ -0,0 +1,264 @@
+import asyncio
+
+from gLinDA.lib.errors import GlindaP2PProtocolError
+from gLinDA.lib.p2p import P2P, Envelope, Keyring
+from gLinDA.lib.p2p_pkg import P2PCollector, P2PFrameReader, P2PPackage
+
+"""
+P2P asyncio transport
+
+Runs the listener and the connections to all peers in one event loop instead of a server thread and a blocking
+client: inbound connections are served concurrently and all peers are sent to at the same time, so a broadcast takes
+about the time of the slowest link. Handshake, frames and encryption are the same as in the threaded transport
+(p2p_client, p2p_server). Every network operation (connecting, reading a frame, sending, waiting for an
+acknowledgement) is limited by the timeout of the configuration, 0 waits without a limit.
+"""
+
+__version__ = "1.0.0"
+__author__ = "Leon Fehse, Mohammad Tajabadi, Roman Martin"
+__credits__ = "Heinrich Heine University Düsseldorf"
+
+
+class AsyncP2P(P2P):
+
+    def __init__(self, config: dict, keyring: Keyring = None):
+        if keyring is None:
+            keyring = Keyring()
+        super().__init__(config, keyring)
+        self.timeout = self.config["timeout"] if self.config["timeout"] else None
+
+    def handshake(self) -> Keyring:
+        """
+        Exchanges the keys with all peers.
+        :return: the keyring
+        """
+        asyncio.run(self.__handshake())
+        return self.keyring
+
+    def broadcast(self, payload: bytes) -> dict:
+        """
+        Sends the payload to all peers and receives their payloads.
+        :param payload: the unencrypted payload
+        :return: the decrypted payloads by identifier of the peers
+        """
+        return asyncio.run(self.__broadcast(payload))
+
+    async def open(self, peer: str) -> tuple:
+        """
+        Connects to a peer, retrying while the peer is not listening yet.
+        :return: the stream reader and writer
+        """
+        host, port = peer.split(":")
+
+        async def attempt():
+            delay = self.retry_delay
+            while True:
+                try:
+                    return await asyncio.open_connection(host, int(port))
+                except ConnectionRefusedError:
+                    if self.verbose >= 1:
+                        print("AsyncP2P #1: Are you sure the peer %s is reachable? Retry in %.2f s" % (peer, delay))
+                    await asyncio.sleep(delay)
+                    delay = min(2 * delay, self.waiting_time)
+
+        return await asyncio.wait_for(attempt(), self.timeout)
+
+    async def read_frame(self, reader: asyncio.StreamReader, frames: P2PFrameReader):
+        """
+        Reads the next frame with exact-length reads.
+        :return: the package or None if the stream ended
+        """
+        try:
+            header = await asyncio.wait_for(reader.readexactly(P2PPackage.header.size), self.timeout)
+            values = frames.parse_header(header)
+            payload = await asyncio.wait_for(reader.readexactly(values[2]), self.timeout)
+        except asyncio.IncompleteReadError:
+            return None
+        return frames.build(values, payload)
+
+    async def write(self, writer: asyncio.StreamWriter, data: bytes):
+        writer.write(data)
+        await asyncio.wait_for(writer.drain(), self.timeout)
+
+    async def listen(self, handle) -> tuple:
+        """
+        Starts the listener, every inbound connection is served by its own task.
+        :param handle: coroutine serving a connection
+        :return: the server and the set of the tasks serving open connections
+        """
+        connections: set = set()
+
+        async def serve(reader, writer):
+            task = asyncio.current_task()
+            connections.add(task)
+            try:
+                await handle(reader, writer)
+            except asyncio.CancelledError:
+                # dropped by the shutdown of the listener
+                await self.close(writer)
+            finally:
+                connections.discard(task)
+
+        host, port = self.host.split(":")
+        return await asyncio.start_server(serve, host, int(port), reuse_address=True), connections
+
+    @staticmethod
+    async def shutdown(server, connections: set):
+        """
+        Stops the listener and drops the open connections, their peers retry at the next listener.
+        """
+        server.close()
+        for task in connections:
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        await server.wait_closed()
+
+    @staticmethod
+    async def close(writer: asyncio.StreamWriter):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def __handshake(self):
+        frames = P2PFrameReader(self.chunk_size, self.bytes_len, self.verbose)
+        complete = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        async def handle(reader, writer):
+            try:
+                while True:
+                    pkg = await self.read_frame(reader, frames)
+                    if pkg is None:
+                        break
+                    if pkg.get_identifier() != 0:
+                        # a peer that completed its handshake already sends its payload, it has to retry
+                        if pkg.get_stop():
+                            await self.write(writer, P2P.nak)
+                            break
+                        continue
+                    # the handshake crypto runs beside the event loop
+                    reply = await loop.run_in_executor(None, self.handshake_reply, pkg.get_payload())
+                    if reply is not None:
+                        await self.write(writer, self.control_frame(reply))
+            except (GlindaP2PProtocolError, asyncio.TimeoutError, OSError) as e:
+                print("AsyncP2P: Handshake failed: %s" % e)
+            finally:
+                await self.close(writer)
+            # the confirmation numbers of the answered peers, like the threaded server
+            if len(self.keyring.get_peers()["R"]) >= len(self.peers):
+                complete.set()
+
+        async def initiate(peer: str):
+            try:
+                reader, writer = await self.open(peer)
+                try:
+                    random_number, enc_msg = self.handshake_request()
+                    if self.verbose >= 1:
+                        print("ClientHandshake #1: Send random number %d to %s" % (random_number, peer))
+                    await self.write(writer, self.control_frame(enc_msg))
+                    pkg = await self.read_frame(reader, frames)
+                    if pkg is None:
+                        print("Client #1: Confirmation with %s failed, ignore peer" % peer)
+                    else:
+                        self.handshake_confirm(peer, random_number, pkg.get_payload())
+                finally:
+                    await self.close(writer)
+            except (GlindaP2PProtocolError, asyncio.TimeoutError, OSError) as e:
+                # the other peers continue, the broadcast reports the peer that is not reachable
+                print("AsyncP2P: Handshake with %s failed: %s" % (peer, e))
+
+        server, connections = await self.listen(handle)
+        try:
+            await asyncio.gather(*[initiate(peer) for peer in self.peers])
+            await asyncio.wait_for(complete.wait(), self.timeout)
+        finally:
+            await self.shutdown(server, connections)
+        if self.verbose >= 1:
+            print("AsyncP2P #1: Handshake complete!")
+
+    async def __broadcast(self, payload: bytes) -> dict:
+        frames = P2PFrameReader(self.chunk_size, self.bytes_len, self.verbose)
+        collector = P2PCollector(self.bytes_len, self.verbose, len(self.peers), self.keyring.get_round())
+        complete = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        async def handle(reader, writer):
+            try:
+                admission = None
+                while True:
+                    pkg = await self.read_frame(reader, frames)
+                    if pkg is None:
+                        break
+                    if admission is None:
+                        admission = collector.admit(pkg)
+                    if admission == P2PCollector.collect:
+                        collector.load(pkg)
+                    if pkg.get_stop():
+                        # the payload of a peer that is already in the next broadcast, it has to retry
+                        await self.write(writer, P2P.nak if admission == P2PCollector.ahead else P2P.ack)
+                        if collector.is_finished():
+                            complete.set()
+                        break
+            except (GlindaP2PProtocolError, asyncio.TimeoutError, OSError) as e:
+                # drops the connection, the peer sends the payload again
+                print("AsyncP2P: Reception failed: %s" % e)
+            finally:
+                await self.close(writer)
+
+        server, connections = await self.listen(handle)
+        try:
+            # encrypted once for all peers, only the session key is encrypted per peer
+            sealed = await loop.run_in_executor(None, Envelope.seal, payload)
+            delivered = await asyncio.gather(*[self.__send(peer, sealed) for peer in self.peers])
+            await asyncio.wait_for(complete.wait(), self.timeout)
+        finally:
+            await self.shutdown(server, connections)
+
+        if not all(delivered):
+            print("AsyncP2P: Could not deliver the payload to %s" %
+                  ", ".join(peer for peer, done in zip(self.peers, delivered) if not done))
+        results: dict = {}
+        for identifier in collector.identifiers.keys():
+            results.update({identifier: await loop.run_in_executor(None, self.decrypt_payload, identifier,
+                                                                   collector.get_payload(identifier))})
+        return results
+
+    async def __send(self, peer: str, sealed: tuple) -> bool:
+        """
+        Addresses, frames and streams the sealed payload to a peer, with up to send_retries retries.
+        :return: True if the peer acknowledged the payload
+        """
+        loop = asyncio.get_running_loop()
+        identifier, cipher = await loop.run_in_executor(None, self.encrypt_payload, peer, sealed)
+        packages = P2PPackage.build_packages(self.bytes_len, self.keyring.chunk_size_for(peer), identifier, cipher,
+                                             self.verbose, self.keyring.get_round())
+        if self.verbose >= 1:
+            print("AsyncP2P #1: Send %d packages to %s" % (len(packages), peer))
+
+        delay, attempt, waited = self.retry_delay, 1, 0.0
+        while attempt <= self.send_retries + 1:
+            try:
+                reader, writer = await self.open(peer)
+                try:
+                    for pkg in packages:
+                        await self.write(writer, pkg.build_binary_package())
+                    answer = await asyncio.wait_for(reader.read(len(P2P.ack)), self.timeout)
+                finally:
+                    await self.close(writer)
+                if answer == P2P.ack:
+                    return True
+                elif answer == P2P.nak and (self.timeout is None or waited < self.timeout):
+                    # the peer is still in the handshake or the previous broadcast, like a peer not listening yet
+                    await asyncio.sleep(delay)
+                    waited += delay
+                    delay = min(2 * delay, self.waiting_time)
+                    continue
+                print("AsyncP2P: Peer %s did not acknowledge the payload" % peer)
+            except (asyncio.TimeoutError, OSError) as e:
+                print("AsyncP2P: Sending to %s failed (attempt %d): %s" % (peer, attempt, e))
+            attempt += 1
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, self.waiting_time)
+        return False
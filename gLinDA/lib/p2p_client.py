@@ -1,8 +1,7 @@
-import random
-import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from gLinDA.lib.p2p import P2P, Keyring
+from gLinDA.lib.p2p import P2P, Envelope, Keyring
 from gLinDA.lib.p2p_pkg import P2PCollector, P2PPackage
 
 
@@ -19,122 +18,100 @@ class Client(P2P):
             if self.verbose >= 1:
                 print("Client #1: I'm done!")
 
-    def send_payload(self, raw_payload: bytes):
-        for peer in self.peers:
-            host, port = peer.split(":")
-            pkg_counter: int = 1
-            not_connected = True
-            identifier, encrypt_key = self.keyring.for_submission(peer)
-
-            if not self.config["asymmetric"]:
-                self.encryption.set_init_vector(self.keyring.get_iv())
-
-            enc_payload = self.encryption.encrypt(raw_payload, encrypt_key)
-            p2p_pkgs: list = P2PPackage.build_packages(self.bytes_len, self.chunk_size, identifier,
-                                                 enc_payload, self.verbose)
-
-            if self.verbose >= 3:
-                print("Client #3: Sending %d packages to %d" % (len(p2p_pkgs), identifier))
-                print("Client #3: Packages %s" % str(p2p_pkgs))
-                #print("Client #3: raw massage: %s" % raw_payload)
-                print("Client #3: target id %d, key %s" % (identifier, encrypt_key))
-                #print("Client #3: ciper (%d) %s" % (len(enc_payload), enc_payload))
-            elif self.verbose >= 2:
-                print("Client #2: Packages %s" % p2p_pkgs)
-            elif self.verbose >= 1:
-                print("Client #1: Send msg to %s:%d" % (host, int(port)))
-
-            for n in p2p_pkgs:
-                n: P2PPackage = n
-                not_connected = True
-                while not_connected:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        try:
-                            s.connect((host, int(port)))
-                            not_connected = False
-
-                            binary_pkg = n.build_binary_package()
-
-                            if self.verbose >= 3:
-                                print("Client #3: Sending package #%d package: %s" % (pkg_counter, n))
-
-                            s.sendall(binary_pkg)
-                            s.close()
-
-                        except ConnectionRefusedError as e:
-                            if self.verbose >= 1:
-                                print("Client #1: Are you sure the peer %s is reachable? Retry in %d s" %
-                                      (peer, super().waiting_time))
-                            time.sleep(super().waiting_time)
-                            super().set_waiting_time(super().waiting_time + 1)
-                        except Exception as e:
-                            print(e)
-
-                pkg_counter += 1
-                time.sleep(super().waiting_time)
-
-        time.sleep(super().waiting_time)  # Test, wait after sending
+    def send_payload(self, raw_payload: bytes) -> dict:
+        """
+        Sends the payload to all peers concurrently, one thread per peer. A peer failing is retried without
+        blocking the deliveries to the other peers.
+        :param raw_payload: the unencrypted payload
+        :return: the progress per peer
+        """
+        self.progress = {peer: {"packages": 0, "sent": 0, "attempts": 0, "state": "pending"} for peer in self.peers}
+        # encrypted once for all peers, only the session key is encrypted per peer
+        sealed = Envelope.seal(raw_payload)
+        with ThreadPoolExecutor(max_workers=max(1, len(self.peers))) as executor:
+            list(executor.map(lambda peer: self.__send_to_peer(peer, sealed), self.peers))
+
+        failed = [peer for peer, progress in self.progress.items() if progress["state"] != "done"]
+        if len(failed):
+            print("Client #1: Could not deliver the payload to %s" % ", ".join(failed))
+        elif self.verbose >= 2:
+            print("Client #2: Progress %s" % self.progress)
+        return self.progress
+
+    def __send_to_peer(self, peer: str, sealed: tuple):
+        """
+        Addresses, packs and streams the sealed payload to a single peer, with up to send_retries retries.
+        """
+        identifier, enc_payload = self.encrypt_payload(peer, sealed)
+        p2p_pkgs: list = P2PPackage.build_packages(self.bytes_len, self.keyring.chunk_size_for(peer),
+                                                   identifier, enc_payload, self.verbose, self.keyring.get_round())
+        self.progress[peer]["packages"] = len(p2p_pkgs)
+
+        if self.verbose >= 3:
+            print("Client #3: Sending %d packages to %d" % (len(p2p_pkgs), identifier))
+            print("Client #3: Packages %s" % str(p2p_pkgs))
+        elif self.verbose >= 2:
+            print("Client #2: Packages %s" % p2p_pkgs)
+        elif self.verbose >= 1:
+            print("Client #1: Send msg to %s" % peer)
+
+        # waiting for a busy peer (NAK) is limited by the timeout, like the asyncio transport, 0 waits without a limit
+        delay, attempt, waited = self.retry_delay, 1, 0.0
+        while attempt <= self.send_retries + 1:
+            self.progress[peer].update({"attempts": attempt, "sent": 0, "state": "sending"})
+            try:
+                answer = self.__stream(peer, p2p_pkgs)
+                if answer == P2P.ack:
+                    self.progress[peer]["state"] = "done"
+                    return
+                elif answer == P2P.nak and (not self.config["timeout"] or waited < self.config["timeout"]):
+                    # the peer is still in the previous broadcast, like a peer not listening yet
+                    self.progress[peer]["state"] = "waiting"
+                    time.sleep(delay)
+                    waited += delay
+                    delay = min(2 * delay, self.waiting_time)
+                    continue
+                print("Client #1: Peer %s did not acknowledge the payload" % peer)
+            except OSError as e:
+                print("Client #1: Sending to %s failed (attempt %d): %s" % (peer, attempt, e))
+            self.progress[peer]["state"] = "failed"
+            attempt += 1
+            time.sleep(delay)
+            delay = min(2 * delay, self.waiting_time)
+
+    def __stream(self, peer: str, packages: list) -> bytes:
+        """
+        Streams all packages to a peer over one connection and waits for its answer.
+        :param peer: the peer address
+        :param packages: the packages of the payload
+        :return: the answer of the peer, P2P.ack if it received the payload
+        """
+        with self.connect(peer) as s:
+            for pkg_counter, n in enumerate(packages, 1):
+                if self.verbose >= 3:
+                    print("Client #3: Sending package #%d package: %s" % (pkg_counter, n))
+                s.sendall(n.build_binary_package())
+                self.progress[peer]["sent"] = pkg_counter
+
+            answer = s.recv(len(P2P.ack))
+            if answer == P2P.ack and self.verbose >= 2:
+                print("Client #2: Peer %s acknowledged %d packages" % (peer, len(packages)))
+            return answer
 
     def __initiate_communication(self, peer: str):
+        """
+        Sends the handshake to a peer, waits until the peer is listening.
+        """
         try:
-            host, port = peer.split(":")
-            not_connected = True
-            while not_connected:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    try:
-                        s.connect((host, int(port)))
-                        not_connected = False
-                        random_number = random.randint(super().min_rand, super().max_rand)
-
-                        msg = random_number.to_bytes(3, "big")
-                        if self.config["asymmetric"]:
-                            msg += self.keyring.get_keys(False)[1]  # public key
-
-                        init_aes_key = self.get_init_key()
-                        enc_msg = self.encryption.encrypt(
-                            msg,
-                            init_aes_key
-                        )
-
-                        if self.verbose >= 1:
-                            print("ClientHandshake #1: Send random number %d to %s:%s" % (random_number, host, port))
-                        if self.verbose >= 2:
-                            print("ClientHandshake #2: Send raw msg %s" % enc_msg)
-
-                        s.sendall(enc_msg)
-                        data = s.recv(self.chunk_size)
-
-                        if self.verbose >= 2:
-                            print("ClientHandshake #2: Received answer encrypted %s" % data )
-                            print("ClientHandshake #2: Will use decryption key %s" % init_aes_key )
-
-                        answer = self.encryption.decrypt(
-                            data,
-                            init_aes_key
-                        )
-
-                        confirmation_number = int.from_bytes(answer[:super().bytes_len], "big")
-
-                        if confirmation_number != (random_number + 1):
-                            s.close()
-                            print("Client #1: Confirmation with %s failed, ignore peer" % peer)
-
-                        else:
-                            if self.verbose >= 1:
-                                print("Client #1: Encrypted communication was successful")
-                            self.keyring.add_peer(peer, (confirmation_number, answer[self.bytes_len:]),
-                                                  False)
+            with self.connect(peer) as s:
+                random_number, enc_msg = self.handshake_request()
 
-                        s.close()
-                    except ConnectionRefusedError as e:
-                        if self.verbose >= 1:
-                            print("Client #1: Are you sure the peer %s is reachable? Retry in %d s" % (
-                                peer, super().waiting_time))
-                        time.sleep(super().waiting_time)
-                        super().set_waiting_time(super().waiting_time + 1)
-                    except Exception as e:
-                        print(e)
+                if self.verbose >= 1:
+                    print("ClientHandshake #1: Send random number %d to %s" % (random_number, peer))
 
+                self.send_frame(s, enc_msg)
+                self.handshake_confirm(peer, random_number, self.receive_frame(s))
         except KeyboardInterrupt as e:
             print("Client #1: Terminated manually")
-        time.sleep(super().waiting_time)  # Test, wait after sending
+        except Exception as e:
+            print(e)
@@ -1,11 +1,26 @@
+import struct
+import zlib
 from math import ceil
-from pickle import dumps, loads
+
+from gLinDA.lib.errors import GlindaP2PProtocolError
 
 
 class P2PPackage:
+    """
+    A frame of the protocol version 3: a fixed binary header followed by the payload.
+
+    Header (24 bytes, network byte order): magic "GL", version, flags (bit 0: last frame of the payload), peer
+    identifier, broadcast round, sequence number, payload length and the CRC32 checksum of the payload.
+    """
 
-    __payload: bytes = 0
+    magic: bytes = b"GL"
+    version: int = 3
+    header: struct.Struct = struct.Struct("!2sBBIIIII")
+    last_flag: int = 1
+
+    __payload: bytes = b""
     __identifier: int = 0
+    __round: int = 0
     __number: int = 0
     __stop: bool = False
     __bytes_length: int = 3
@@ -16,94 +31,64 @@ class P2PPackage:
         self.verbose = verbose
 
     @staticmethod
-    def _get_identifier(data: bytes, verbose: int = 0, number: bool = False) -> int:
-        name = "sequential number" if number else "identifier"
-
-        if verbose >= 3:
-            print("P2PPackage #3: potential binary %s %s" % (name, data))
-
-        try:
-            nr = int.from_bytes(data, "big")
-        except TypeError:
-            return 0
-
-        if verbose >= 2:
-            print("P2PPackage #2: %s %d" % (name, nr))
-
-        return nr
-
-    @staticmethod
-    def _get_break(potential_brake: bytes, verbose: int = 0) -> bool:
-        end = None
-
-        if verbose >= 3:
-            print("P2PPackage #3: potential end %s" % potential_brake)
-
-        try:
-            end = potential_brake.decode("utf8")
-
-            if verbose >= 3:
-                print("P2PPackage #3: end '%s'" % end)
-
-        except UnicodeDecodeError as e:
-            #print(e)
-            return False
-        except Exception as e:
-            print(e)
-            return False
-
-        return end is not None and end == "END:"
-
-    @staticmethod
-    def build_packages(bytes_length: int, chunk_size: int, identifier: int, payload: bytes, verbose: int = 0):
-        total_length: int = len(payload) - (bytes_length * 3 + 4)
-        chunk_size_wo_header = chunk_size - ((bytes_length * 3) + 4)
-
-        packages: int = ceil(total_length / chunk_size_wo_header)
+    def build_packages(bytes_length: int, chunk_size: int, identifier: int, payload: bytes, verbose: int = 0,
+                       round: int = 0):
+        """
+        Splits a payload into frames.
+        :param bytes_length: length of the identifiers (compatibility, the header stores 4 bytes)
+        :param chunk_size: maximal payload size of a frame
+        :param identifier: the peer identifier
+        :param payload: the payload
+        :param round: the broadcast round of the payload
+        :return: list of packages, at least one
+        """
+        packages: int = max(1, ceil(len(payload) / chunk_size))
         buckets: list = []
+        view = memoryview(payload)
 
         for i in range(1, packages + 1):
-            start_pos = (i - 1) * chunk_size_wo_header
-            end_pos = i * chunk_size_wo_header
-            entry: bytes = payload[start_pos:end_pos]
-
-            new_pkg = P2PPackage(bytes_length, 0)
+            new_pkg = P2PPackage(bytes_length, verbose)
             new_pkg.set_identifier(identifier)
+            new_pkg.set_round(round)
             new_pkg.set_number(i)
-            new_pkg.set_payload(entry)
+            new_pkg.set_payload(view[(i - 1) * chunk_size:i * chunk_size])
             new_pkg.set_stop(i == packages)
-
             buckets.append(new_pkg)
 
         return buckets
 
-    def load(self, raw_data: bytes) -> bool:
-
-        # Detect the identifier
-        self.__identifier = self._get_identifier(raw_data[:self.__bytes_length], self.verbose)
-        if self.__identifier == 0:
+    @staticmethod
+    def parse_header(raw_header) -> tuple:
+        """
+        Unpacks and validates a frame header.
+        :return: identifier, sequence number, payload length, flags, checksum and broadcast round
+        """
+        magic, version, flags, identifier, round, number, length, checksum = P2PPackage.header.unpack(raw_header)
+        if magic != P2PPackage.magic:
+            raise GlindaP2PProtocolError("P2PPackage: Not a gLinDA frame (magic %s)" % magic)
+        if version != P2PPackage.version:
+            raise GlindaP2PProtocolError("P2PPackage: Unsupported protocol version %d" % version)
+        return identifier, number, length, flags, checksum, round
+
+    def load(self, raw_data) -> bool:
+        """
+        Loads a complete frame (header and payload).
+        :return: True if the frame is valid
+        """
+        try:
+            self.__identifier, self.__number, length, flags, checksum, self.__round = self.parse_header(
+                raw_data[:self.header.size])
+        except (GlindaP2PProtocolError, struct.error) as e:
+            if self.verbose >= 1:
+                print(e)
             return False
-
-        # Check if complete
-        end_id = self._get_identifier(raw_data[-self.__bytes_length:], self.verbose)
-        if end_id == 0 or self.__identifier != end_id:
-            print("P2PCollector: Incomplete package")
+        payload = bytes(raw_data[self.header.size:])
+        if len(payload) != length or zlib.crc32(payload) != checksum:
+            print("P2PPackage: Incomplete or damaged package")
             return False
-
-        # Detect the sequential number
-        self.__number = self._get_identifier(raw_data[self.__bytes_length:(self.__bytes_length * 2)], self.verbose, True)
-
-        # Detect a potential break
-        payload: bytes = raw_data[self.__bytes_length*2:-self.__bytes_length]
-
-        self.__stop = self._get_break(payload[-4:], self.verbose)
-
-        if self.__stop:
-            self.__payload = payload[:-4]
-        else:
-            self.__payload = payload
-
-        return True
+        self.__payload = payload
+        self.__stop = bool(flags & self.last_flag)
+        return self.__identifier != 0
 
     def get_payload(self) -> bytes:
         return self.__payload
@@ -114,6 +99,9 @@ class P2PPackage:
     def get_number(self) -> int:
         return self.__number
 
+    def get_round(self) -> int:
+        return self.__round
+
     def get_stop(self) -> bool:
         return self.__stop
 
@@ -129,48 +117,143 @@ class P2PPackage:
     def set_number(self, nr: int):
         self.__number = nr
 
+    def set_round(self, round: int):
+        self.__round = round
+
     def get_total_size(self) -> int:
-        size = len(self) + 3 * self.__bytes_length  # 1x identifier, 1x number, 1x identifier
-        if self.__stop:
-            size += 4  # "END:"
-        return size
+        return len(self) + self.header.size
+
+    def build_header(self) -> bytes:
+        return self.header.pack(self.magic, self.version, self.last_flag if self.__stop else 0, self.__identifier,
+                                self.__round, self.__number, len(self.__payload), zlib.crc32(self.__payload))
 
     def build_binary_package(self) -> bytes:
-        raw: bytes = self.__identifier.to_bytes(self.__bytes_length, "big")
-        raw += self.__number.to_bytes(self.__bytes_length, "big")
-        raw += self.__payload
-        if self.__stop:
-            raw += "END:".encode("utf8")
-        raw += self.__identifier.to_bytes(self.__bytes_length, "big")
-        return raw
+        return self.build_header() + self.__payload
 
     def __repr__(self) -> str:
-        return ("P2PPackage (%d): Id: %d; Nr: %d; Last: %d; Payload (%d): %s" %
-                (self.get_total_size(), self.__identifier, self.__number, int(self.__stop), len(self),
-                 str(self.__payload)[:10]+"..."+str(self.__payload)[-10:] if len(self.__payload) else "--EMPTY--"))
+        payload = bytes(self.__payload)
+        return ("P2PPackage (%d): Id: %d; Round: %d; Nr: %d; Last: %d; Payload (%d): %s" %
+                (self.get_total_size(), self.__identifier, self.__round, self.__number, int(self.__stop), len(self),
+                 str(payload[:10]) + "..." + str(payload[-10:]) if len(payload) else "--EMPTY--"))
 
     def __len__(self) -> int:
         return len(self.__payload)
 
 
+class P2PFrameReader:
+    """
+    Reads frames from a stream with exact-length reads into a preallocated buffer, independent of how the stream is
+    segmented.
+    """
+
+    def __init__(self, max_payload: int, identifier_length: int = 3, verbose: int = 0):
+        """
+        :param max_payload: the largest accepted payload of a frame (the negotiated chunk size)
+        """
+        self.max_payload = max_payload
+        self.identifier_length = identifier_length
+        self.verbose = verbose
+        self.buffer = bytearray(P2PPackage.header.size + max_payload)
+        self.view = memoryview(self.buffer)
+
+    @staticmethod
+    def fill(conn, view: memoryview) -> bool:
+        """
+        Fills the view completely from the stream.
+        :return: False if the stream ended before
+        """
+        received = 0
+        while received < len(view):
+            n = conn.recv_into(view[received:])
+            if not n:
+                return False
+            received += n
+        return True
+
+    def read(self, conn):
+        """
+        Reads the next frame.
+        :param conn: a socket (or any object with recv_into)
+        :return: the package or None if the stream ended
+        """
+        header = self.view[:P2PPackage.header.size]
+        if not self.fill(conn, header):
+            return None
+        values = self.parse_header(header)
+        payload = self.view[P2PPackage.header.size:P2PPackage.header.size + values[2]]
+        if not self.fill(conn, payload):
+            return None
+        return self.build(values, payload)
+
+    def parse_header(self, header) -> tuple:
+        """
+        Validates a frame header, including the payload length.
+        :return: identifier, sequence number, payload length, flags, checksum and broadcast round
+        """
+        values = P2PPackage.parse_header(header)
+        if values[2] > self.max_payload:
+            raise GlindaP2PProtocolError("P2PFrameReader: Frame of %d bytes exceeds the chunk size %d" %
+                                         (values[2], self.max_payload))
+        return values
+
+    def build(self, values: tuple, payload) -> P2PPackage:
+        """
+        Validates the payload of a frame against the checksum of its header.
+        :param values: the parsed header
+        :param payload: the payload
+        :return: the package
+        """
+        identifier, number, length, flags, checksum, round = values
+        if zlib.crc32(payload) != checksum:
+            raise GlindaP2PProtocolError("P2PFrameReader: Checksum mismatch in frame %d of %d" % (number, identifier))
+
+        pkg = P2PPackage(self.identifier_length, self.verbose)
+        pkg.set_identifier(identifier)
+        pkg.set_round(round)
+        pkg.set_number(number)
+        pkg.set_payload(bytes(payload))
+        pkg.set_stop(bool(flags & P2PPackage.last_flag))
+        return pkg
+
+
 class P2PCollector:
 
-    def __init__(self, identifier_length: int = 3, verbose: int = 0, expected_peers: int = 0):
+    # admission of a payload, decided on its first frame
+    collect: str = "collect"
+    repeated: str = "repeated"
+    ahead: str = "ahead"
+
+    def __init__(self, identifier_length: int = 3, verbose: int = 0, expected_peers: int = 0, round: int = 0):
         self.identifiers: dict = {}
         self.payloads: dict = {}
         self.states: dict = {}
         self.bytes_length = identifier_length
         self.expected_peers = expected_peers
+        self.round = round
         self.verbose = verbose
 
-    def load(self, packages):
+    def admit(self, pkg: P2PPackage) -> str:
+        """
+        Decides on the first frame of a connection whether its payload is collected.
+        :param pkg: the first frame
+        :return: collect; repeated for a payload of a former round or a payload completed in this round (the peer sends
+                 it again after a lost acknowledgement, it is acknowledged and dropped); ahead for a payload of a later
+                 round (the peer has to retry)
+        """
+        if pkg.get_round() > self.round:
+            return self.ahead
+        if pkg.get_round() < self.round or self.states.get(pkg.get_identifier(), False):
+            return self.repeated
+        return self.collect
 
-        if not len(packages):
-            return False
+    def load(self, packages):
 
         if type(packages) is not list:
             packages = [packages]
 
+        if not len(packages):
+            return False
+
         for pkg in packages:
             pkg: P2PPackage = pkg
 
@@ -180,13 +263,13 @@ class P2PCollector:
                 print("Package without an identifier: %s" % pkg)
                 continue
 
-            # new package
+            # new package, a package sent again (retry of the peer) replaces the former one
             if id not in self.identifiers:
                 self.identifiers.update({id: True})
                 self.states.update({id: pkg.get_stop()})
-                self.payloads.update({id: [pkg]})
+                self.payloads.update({id: {pkg.get_number(): pkg}})
             else:
-                self.payloads[id].append(pkg)
+                self.payloads[id][pkg.get_number()] = pkg
                 if pkg.get_stop():
                     self.states.update({id: True})
 
@@ -195,8 +278,8 @@ class P2PCollector:
             if not self.states[identifier]:
                 print("It looks like this peers does not sent all his messages yet")
 
-            sorted_payloads = sorted(self.payloads[identifier], key=lambda pay: pay.get_number())
-            return b''.join([x.get_payload() for x in sorted_payloads])
+            return b''.join([self.payloads[identifier][nr].get_payload()
+                             for nr in sorted(self.payloads[identifier].keys())])
 
         except KeyError:
             print("Can not find any payload for requested peer %d" % identifier)
@@ -1,9 +1,9 @@
-from threading import Event
+from threading import Event, Lock, Thread
 import socket
-import random
 
+from gLinDA.lib.errors import GlindaP2PProtocolError
 from gLinDA.lib.p2p import P2P, Keyring
-from gLinDA.lib.p2p_pkg import P2PCollector, P2PPackage
+from gLinDA.lib.p2p_pkg import P2PCollector, P2PFrameReader
 
 
 class Server(P2P):
@@ -16,7 +16,10 @@ class Server(P2P):
         self.__answers: dict = {}
         self.nr_clients: int = len(self.peers)
         self.event = event
-        self.cache = P2PCollector(self.bytes_len, self.verbose, len(self.config["peers"]))
+        self.cache = P2PCollector(self.bytes_len, self.verbose, len(self.config["peers"]), self.keyring.get_round())
+        # connections are served concurrently, the lock guards the collector and the bucket
+        self.lock = Lock()
+        self.complete = Event()
 
         if self.nr_clients == 0:
             print("No clients awaiting, terminating server")
@@ -27,19 +30,7 @@ class Server(P2P):
         elif not self.cache.is_finished():
             self.__await_responses(self.host, self.__answers, self.__reception, initial)
             for peer in self.cache.identifiers.keys():
-                raw_msg = self.cache.get_payload(peer)
-
-                if self.config["asymmetric"]:
-                    decrypt_key = self.keyring.get_keys(True)[0]
-                else:
-                    self.encryption.set_init_vector(self.keyring.get_iv())
-                    decrypt_key = self.keyring.for_reception(peer)
-
-                if self.verbose >= 2:
-                    print("Server #2: Use decryption key %s" % decrypt_key)
-
-                msg = self.encryption.decrypt(raw_msg, decrypt_key)
-                results.update({peer: msg})
+                results.update({peer: self.decrypt_payload(peer, self.cache.get_payload(peer))})
 
     def get_answers(self) -> dict:
         """
@@ -69,9 +60,18 @@ class Server(P2P):
             if self.event is not None:  # only for multithreaded call
                 self.event.set()
 
+            # accepting polls whether the workers completed the bucket
+            s.settimeout(self.accept_interval)
+            workers: list = []
             try:
-                while self.__inner_loop(s, bucket, func, initial):
-                    pass
+                while not self.complete.is_set():
+                    try:
+                        conn, addr = s.accept()
+                    except socket.timeout:
+                        continue
+                    worker = Thread(target=self.__inner_loop, args=(conn, addr, bucket, func, initial), daemon=True)
+                    worker.start()
+                    workers.append(worker)
             except KeyboardInterrupt as e:
                 s.close()
                 print("Server: Closed server by manual interruption.")
@@ -82,30 +82,43 @@ class Server(P2P):
                     print(traceback.print_exc())
                 print(e)
 
-    def __inner_loop(self, s: socket.socket, bucket, func, initial: bool = False):
+            # the last connections finish their answers (acknowledgement, handshake reply)
+            for worker in workers:
+                worker.join(self.waiting_time)
+
+    def __is_complete(self, bucket, initial: bool) -> bool:
+        with self.lock:
+            return (initial and len(bucket) >= self.nr_clients) or (not initial and self.cache.is_finished())
+
+    def __inner_loop(self, conn: socket.socket, addr, bucket, func, initial: bool = False):
         """
-        The inner function to execute in the outer loop.
-        :param s: the socket connection
+        Serves a connection, in a thread of its own.
+        :param conn: the socket connection
+        :param addr: the address of the peer
         :param bucket: a bucket functions as a cache
         :param func: an object function, that will be executed inside as a first outer loop
         :return:
         """
-        conn, addr = s.accept()
         with conn:
+            conn.settimeout(None)
             if self.verbose >= 1:
                 print("Server: Client connected by %s" % str(addr))
-            while True:
+            try:
+                while True:
 
-                if self.verbose >= 3 and initial:
-                    print("Server: Current bucket size %d" % len(bucket))
+                    if self.verbose >= 3 and initial:
+                        print("Server: Current bucket size %d" % len(bucket))
 
-                if (initial and len(bucket) >= self.nr_clients) or (not initial and self.cache.is_finished()):
-                    return False
+                    if self.__is_complete(bucket, initial):
+                        break
 
-                if not func(conn, addr, bucket):
-                    break
+                    if not func(conn, addr, bucket):
+                        break
+            except (OSError, GlindaP2PProtocolError) as e:
+                print("Server: Connection to %s failed: %s" % (str(addr), e))
 
-            return True
+        if self.__is_complete(bucket, initial):
+            self.complete.set()
 
     def __reception(self, conn, addr, bucket) -> bool:
         """
@@ -116,72 +129,51 @@ class Server(P2P):
         :return: True after termination
         """
 
-        while not self.cache.is_finished():
-            data = conn.recv(self.chunk_size)
-            if not data:
+        # the peers never send frames larger than the chunk size negotiated with this server
+        reader = P2PFrameReader(self.chunk_size, self.bytes_len, self.verbose)
+        admission = None
+        while True:
+            try:
+                pkg = reader.read(conn)
+            except GlindaP2PProtocolError as e:
+                # drops the connection, the peer sends the payload again
+                print("Server: %s" % e)
+                return False
+            if pkg is None:
                 return False
 
             if self.verbose >= 2:
-                print("Server #2: Got (%d) %s" % (len(data), data))
-
-            pkg = P2PPackage(self.bytes_len, self.verbose)
-
-            if not pkg.load(data):
-                print("Server: Can not load package.")
-                return True
-
-            self.cache.load(pkg)
-
-            if self.cache.is_finished():
-                bucket.update({pkg.get_identifier(): self.cache.get_payload(pkg.get_identifier())})
-
-        return True
+                print("Server #2: Got %s" % pkg)
+
+            with self.lock:
+                if admission is None:
+                    admission = self.cache.admit(pkg)
+                if admission == P2PCollector.collect:
+                    self.cache.load(pkg)
+                finished = self.cache.is_finished()
+                if pkg.get_stop() and finished:
+                    bucket.update({pkg.get_identifier(): self.cache.get_payload(pkg.get_identifier())})
+
+            if pkg.get_stop():
+                # the payload of this peer is complete, the client may close the connection; a peer that is
+                # already in the next broadcast has to retry
+                conn.sendall(P2P.nak if admission == P2PCollector.ahead else P2P.ack)
+                return finished
 
     def __handshake_keyring(self, conn, addr, bucket):
-        data = conn.recv(self.chunk_size)
-        if not data:
+        pkg = P2PFrameReader(self.chunk_size, self.bytes_len, self.verbose).read(conn)
+        if pkg is None:
             return False
 
-        init_aes_key = self.get_init_key()
-
-        if self.verbose >= 3:
-            print("ServerHandshake #3: Data received %s" % data)
-            print("ServerHandshake #3: Use decryption key %s" % init_aes_key)
-
-        data_decrypted = self.encryption.decrypt(
-            data,
-            init_aes_key
-        )
-
-        rsa_key: bytes = bytes()
-        if self.config["asymmetric"] and len(data_decrypted) > self.bytes_len:
-            rsa_key = data_decrypted[3:]
-            data_decrypted = data_decrypted[:3]
-
-        decrypted_number = int.from_bytes(data_decrypted, "big")
-
-        if data_decrypted is None or not (super().min_rand <= decrypted_number <= super().max_rand):
-            if self.verbose >= 1:
-                print("ServerHandshake #1: Received data which can not decrypted")
+        if pkg.get_identifier() != 0:
+            # a peer that completed its handshake already sends its payload, it has to retry
+            if pkg.get_stop():
+                conn.sendall(P2P.nak)
+                return False
             return True
 
-        if self.verbose >= 2:
-            print("ServerHandshake #2: Data decrypted received %s" % data_decrypted)
-            print("ServerHandshake #2: Decrypted number %d" % decrypted_number)
-
-        confirmation_number = decrypted_number + 1
-
-        # RSA
-        if self.config["asymmetric"] and len(rsa_key):
-            new_key = self.keyring.get_keys(True)[1]
-            self.keyring.add_peer(confirmation_number, rsa_key)
-        # AES
-        else:
-            key_str = str(confirmation_number + random.randint(super().min_rand, super().max_rand))
-            new_key = self.encryption.get_key(key_str, self.verbose >= 2)
-            self.keyring.add_peer(confirmation_number, new_key, True)
-
-        conn.sendall(self.encryption.encrypt(
-            confirmation_number.to_bytes(self.bytes_len, "big") + new_key, init_aes_key))
+        reply = self.handshake_reply(pkg.get_payload())
+        if reply is not None:
+            self.send_frame(conn, reply)
 
         return True
@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+"""
+Synthetic microbiome data
+
+Generates count tables with known differentially abundant taxa, e.g. for benchmarks and tests. The base abundances of
+the taxa are log-normal, a binary group variable ("grp") shifts the log2 abundances of the differential taxa by the
+effect size and numerical covariates ("cov1", "cov2", ...) add smaller random effects to all taxa. The counts of a
+sample are drawn from a multinomial with a log-normal library size; structural zeros, preferably of low counts, are
+added until the table reaches the requested sparsity.
+"""
+
+__version__ = "1.0.0"
+__author__ = "Leon Fehse, Mohammad Tajabadi, Roman Martin"
+__credits__ = "Heinrich Heine University Düsseldorf"
+
+
+class SyntheticData:
+
+    @staticmethod
+    def generate(taxa: int = 500, samples: int = 100, sparsity: float = 0.5, covariates: int = 1,
+                 effect_size: float = 2.0, differential: float = 0.1, depth: float = 10000, seed: int = 0) -> tuple:
+        """
+        Generates a count table and a meta table.
+        :param taxa: number of taxa
+        :param samples: number of samples
+        :param sparsity: fraction of zero counts (at least the zeros of the multinomial sampling)
+        :param covariates: number of numerical covariates besides the group
+        :param effect_size: log2 fold change of the differential taxa between the groups
+        :param differential: fraction of differential taxa
+        :param depth: median library size
+        :param seed: random seed
+        :return: feature table (taxa x samples), meta table (samples x variables) and the names of the differential
+                 taxa
+        """
+        rng = np.random.default_rng(seed)
+        taxa_names = ["taxon%d" % i for i in range(taxa)]
+        sample_names = ["sample%d" % j for j in range(samples)]
+
+        meta = pd.DataFrame({"grp": rng.permutation(np.arange(samples) % 2)}, index=sample_names)
+        meta["grp"] = np.where(meta["grp"] == 1, "case", "control")
+        for k in range(covariates):
+            meta["cov%d" % (k + 1)] = rng.normal(50, 10, samples)
+
+        log_abundance = np.repeat(rng.normal(0, 2, taxa)[:, None], samples, axis=1)
+        n_differential = int(round(differential * taxa))
+        differential_taxa = rng.choice(taxa, n_differential, replace=False)
+        direction = rng.choice([-1, 1], n_differential)
+        case = (meta["grp"] == "case").to_numpy()
+        log_abundance[np.ix_(differential_taxa, case)] += (direction * effect_size * np.log(2))[:, None]
+        for k in range(covariates):
+            values = meta["cov%d" % (k + 1)].to_numpy()
+            log_abundance += rng.normal(0, 0.01, taxa)[:, None] * (values - values.mean())[None, :]
+
+        log_abundance += rng.normal(0, 0.5, log_abundance.shape)
+        proportions = np.exp(log_abundance - log_abundance.max(axis=0))
+        proportions /= proportions.sum(axis=0)
+        library = np.maximum(rng.lognormal(np.log(depth), 0.5, samples).astype(int), 1)
+        counts = np.column_stack([rng.multinomial(library[j], proportions[:, j]) for j in range(samples)])
+
+        # structural zeros, preferably of the low counts
+        missing = int(sparsity * counts.size) - int((counts == 0).sum())
+        if missing > 0:
+            nonzero = np.flatnonzero(counts)
+            weights = 1.0 / counts.flat[nonzero]
+            counts.flat[rng.choice(nonzero, min(missing, len(nonzero)), replace=False, p=weights / weights.sum())] = 0
+
+        feature = pd.DataFrame(counts, index=taxa_names, columns=sample_names)
+        feature.index.name = "ID"
+        meta.index.name = "SampleID"
+        return feature, meta, [taxa_names[i] for i in sorted(differential_taxa)]
+
+    @staticmethod
+    def write(directory: str, feature: pd.DataFrame, meta: pd.DataFrame, name: str = "synthetic") -> dict:
+        """
+        Writes the tables as csv files.
+        :return: the LINDA configuration entries of the tables
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = {"feature_table": os.path.join(directory, "%s_otu.csv" % name),
+                 "meta_table": os.path.join(directory, "%s_meta.csv" % name)}
+        feature.to_csv(paths["feature_table"])
+        meta.to_csv(paths["meta_table"])
+        return dict(paths, feature_index="ID", meta_index="SampleID", feature_transpose=False)
+
+    @staticmethod
+    def split(feature: pd.DataFrame, meta: pd.DataFrame, parts: int, seed: int = 0) -> list:
+        """
+        Splits the samples randomly into parts, e.g. one per peer.
+        :return: list of (feature table, meta table)
+        """
+        order = np.random.default_rng(seed).permutation(len(meta))
+        return [(feature.loc[:, meta.index[np.sort(part)]], meta.iloc[np.sort(part)])
+                for part in np.array_split(order, parts)]
@@ -1,9 +1,15 @@
 #!/bin/env python3
+import json
 import os.path
 
 from gLinDA.lib.config import Config
 from gLinDA.lib.p2p import Runner
 from gLinDA.lib.linda import LinDA
+from gLinDA.lib.linda_cache import StageCache, TableCache
+from gLinDA.lib.linda_federation import LinDAFederation
+from gLinDA.lib.linda_incremental import LinDAIncremental
+from gLinDA.lib.linda_profile import LinDAProfiler
+from gLinDA.lib.linda_wire import LinDAWire
 from gLinDA.lib.argument import Arguments
 
 __version__ = "1.0.0"
@@ -24,41 +30,127 @@ class Wrapper:
             P2PIsolationTester(Config(arguments, check_sanity=False).get(), arguments.test)
 
     def run(self):
-        if ("solo_mode" in self.config["P2P"] and self.config["P2P"]["solo_mode"]) or self.config["P2P"]["host"] is None:
-            return self.run_locally()
+        if self.config["LINDA"]["clear_cache"]:
+            directory = self.config["LINDA"]["cache_dir"] or TableCache.default_directory()
+            TableCache(directory, 0).clear()
+            StageCache(os.path.join(directory, "stages"), 0).clear()
+        if self.config["LINDA"]["profile"]:
+            LinDAProfiler.enable()
+        try:
+            if ("solo_mode" in self.config["P2P"] and self.config["P2P"]["solo_mode"]) or \
+                    self.config["P2P"]["host"] is None:
+                return self.run_locally()
+            else:
+                return self.run_sl()
+        finally:
+            if self.config["LINDA"]["profile"]:
+                self.export_profile(LinDAProfiler.disable())
+
+    def export_profile(self, profiler: LinDAProfiler):
+        """
+        Writes the profile next to the results (profile.json) or prints the totals per stage without an output.
+        """
+        if len(self.config["LINDA"]["output"]):
+            os.makedirs(self.config["LINDA"]["output"], exist_ok=True)
+            profiler.write(os.path.join(self.config["LINDA"]["output"], "profile.json"))
         else:
-            return self.run_sl()
+            for stage, total in profiler.summary().items():
+                print("Profile: %-16s %3d calls %9.3f s wall %9.3f s cpu %10d bytes peak" %
+                      (stage, total["calls"], total["wall"], total["cpu"], total["peak_bytes"]))
 
     def run_locally(self):
+        if len(self.config["LINDA"]["formulas"]):
+            return self.run_batch(LinDA.run_batch(self.config["LINDA"], self.config["LINDA"]["formulas"]))
+
+        if len(self.config["LINDA"]["state"]):
+            return self.run_incremental()
+
         results = LinDA.run_local(self.config["LINDA"])
         self.export_result(results)
         print(LinDA.display_results(results))
 
         return results
 
+    def run_incremental(self):
+        """
+        Adds the samples to the state file, exports the results and the staleness report (staleness.json).
+        """
+        results, report = LinDA.run_incremental(self.config["LINDA"])
+        self.export_result(results)
+        if len(self.config["LINDA"]["output"]) and len(results):
+            with open(os.path.join(self.config["LINDA"]["output"], "staleness.json"), "w") as f:
+                json.dump(report, f, indent=2)
+        print(LinDAIncremental.describe(report))
+        print(LinDA.display_results(results))
+
+        return results
+
+    def run_batch(self, batch: dict):
+        """
+        Exports and displays the results of a formula batch, one sub directory of the output per formula.
+        """
+        for formula, results in batch.items():
+            self.export_result(results, LinDA.formula_name(formula))
+            print("Formula: %s" % formula)
+            print(LinDA.display_results(results))
+
+        return batch
+
     def run_sl(self):
+        if len(self.config["LINDA"]["formulas"]):
+            return self.run_sl_batch(self.config["LINDA"]["formulas"])
 
         # calculate coefficients
         coeffs = LinDA.run_sl(self.config["LINDA"])
 
         # start and broadcast p2p network
-        p2p = Runner(self.config["P2P"])
-        replies = p2p.broadcast_obj(coeffs)
+        replies = self.exchange(coeffs)
 
         # Add own parameters to the replies
         replies.update({0: coeffs})
-        results = LinDA.run_sl_avg(replies, self.config["LINDA"]["formula"], not self.config["LINDA"]["intersection"])
+        results = LinDA.run_sl_merge(replies, self.config["LINDA"])
         self.export_result(results)
         print(LinDA.display_results(results))
 
         return results
 
-    def export_result(self, results):
+    def run_sl_batch(self, formulas: list):
+        """
+        Swarm learning for a formula batch: the coefficients of all formulas are exchanged in one broadcast.
+        """
+        coeffs = LinDA.run_sl_batch(self.config["LINDA"], formulas)
+
+        replies = self.exchange(coeffs, True)
+        replies.update({0: coeffs})
+
+        batch = {}
+        for formula in formulas:
+            formula_replies = {peer: reply[formula] for peer, reply in replies.items() if formula in reply}
+            batch[formula] = LinDA.run_sl_merge(formula_replies, self.config["LINDA"], formula)
+        return self.run_batch(batch)
+
+    def exchange(self, coeffs, batch: bool = False) -> dict:
+        """
+        Broadcasts the coefficients and receives the coefficients of the peers. The averaged coefficients are sent in
+        the LinDA wire format, the statistics of the exact federation are already encoded (NumPy archives).
+        """
+        p2p = Runner(self.config["P2P"])
+        if self.config["LINDA"]["federation"] == "exact":
+            if batch:
+                return p2p.broadcast(coeffs, LinDAFederation.encode_batch, LinDAFederation.decode_batch, False)
+            return p2p.broadcast(coeffs, bytes, bytes, False)
+        precision = self.config["LINDA"]["precision"]
+        encode = LinDAWire.encode_batch if batch else LinDAWire.encode
+        return p2p.broadcast(coeffs, lambda c: encode(c, precision), LinDAWire.decode, False)
+
+    def export_result(self, results, subdirectory: str = ""):
         try:
             if type(self.config["LINDA"]["output"]) is str and len(self.config["LINDA"]["output"]):
                 prefix = os.path.basename(self.config["LINDA"]["feature_table"])
                 prefix = prefix[:prefix.rfind(".")]
-                LinDA.export_results(results, self.config["LINDA"]["output"], prefix )
+                path = os.path.join(self.config["LINDA"]["output"], subdirectory)
+                os.makedirs(path, exist_ok=True)
+                LinDA.export_results(results, path, prefix)
         except:
             print("Can not store results at the given path")
 
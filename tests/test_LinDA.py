@@ -1,10 +1,37 @@
 import unittest
 import sys
+import os
+
+import numpy as np
+import pandas as pd
+import scipy as sp
+import warnings
+import tempfile
 
 sys.path.insert(1, "../")
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 
 from gLinDA.lib.config import Config
+from gLinDA.lib.errors import LindaInternalError, LindaWrongData
 from gLinDA.lib.linda import LinDA
+from gLinDA.lib.linda_cache import StageCache, TableCache
+from gLinDA.lib.linda_federation import LinDAFederation
+from gLinDA.lib.linda_fit import LinDAFit
+from gLinDA.lib.linda_prep import LinDAPrep
+from gLinDA.lib.linda_profile import LinDAProfiler
+from gLinDA.lib.linda_wire import LinDAWire
+from gLinDA.lib.synthetic import SyntheticData
+
+EXAMPLES: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples")
+
+
+def smoke_config(**options) -> dict:
+    """
+    The LinDA configuration of the smoke example with the paths of its tables, updated by the options.
+    """
+    config = Config(None, os.path.join(EXAMPLES, "smoke.ini"), check_sanity=False)
+    return dict(config.get()["LINDA"], feature_table=os.path.join(EXAMPLES, "smokeotu.csv"),
+                meta_table=os.path.join(EXAMPLES, "smokemeta.csv"), **options)
 
 
 class LinDA_s5000(unittest.TestCase):
@@ -25,3 +52,688 @@ class LinDA_s5000(unittest.TestCase):
         reject = res[res["reject"] == True]
         self.assertEqual(74, len(reject), "The number of rejected results is not complete")
 
+
+class LinDA_smoke_engines(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.cfg = smoke_config()
+        self.feature = LinDA.read_table(self.cfg["feature_table"], self.cfg["feature_index"])
+        self.meta = LinDA.read_table(self.cfg["meta_table"], self.cfg["meta_index"])
+
+    def coefficients(self, engine: str, n_jobs: int = 1, backend: str = "serial") -> dict:
+        cfg = dict(self.cfg, engine=engine, n_jobs=n_jobs, backend=backend)
+        return LinDA.run(self.feature, self.meta, cfg, True)
+
+    def test_batched_matches_statsmodels(self):
+        batched = self.coefficients("batched")
+        reference = self.coefficients("statsmodels")
+        self.assertEqual(sorted(batched.keys()), sorted(reference.keys()))
+        for voi in reference.keys():
+            for col in ["stat", "stde", "intercept", "base_mean"]:
+                np.testing.assert_allclose(batched[voi][col].values, reference[voi][col].values,
+                                           rtol=1e-8, atol=1e-12, err_msg="%s %s differs" % (voi, col))
+
+    def test_process_backend_keeps_taxa_order(self):
+        serial = self.coefficients("statsmodels")
+        parallel = self.coefficients("statsmodels", 3, "process")
+        for voi in serial.keys():
+            self.assertListEqual(list(serial[voi].index), list(parallel[voi].index))
+            np.testing.assert_array_equal(serial[voi]["stat"].values, parallel[voi]["stat"].values)
+            np.testing.assert_array_equal(serial[voi]["stde"].values, parallel[voi]["stde"].values)
+
+
+class LinDA_random_intercept(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        rng = np.random.default_rng(7)
+        n, groups, taxa = 120, 30, 12
+        self.Z = pd.DataFrame({"grp": rng.choice(["a", "b"], n), "age": rng.normal(size=n),
+                               "subject": np.repeat(np.arange(groups), n // groups)})
+        subject_effect = rng.normal(scale=rng.uniform(0.5, 1.5, taxa), size=(groups, taxa))
+        self.W = pd.DataFrame(rng.normal(size=(n, taxa)) + subject_effect[self.Z["subject"].values]
+                              + np.outer(self.Z["grp"] == "b", rng.normal(size=taxa)))
+
+    def test_parse_formula(self):
+        self.assertEqual(("~ grp + age", ["grp", "age"], "subject"), LinDA.parse_formula("~ grp + (1|subject) + age"))
+        self.assertEqual(("~ grp", ["grp"], None), LinDA.parse_formula("~ grp"))
+        self.assertRaises(Exception, LinDA.parse_formula, "~ grp + (age|subject)")
+
+    def test_extract(self):
+        import statsmodels.formula.api as smf
+        Wcol = self.W[0]
+        for result in [smf.ols("Wcol ~ grp + age", data=self.Z).fit(),
+                       smf.mixedlm("Wcol ~ grp + age", data=self.Z, groups=self.Z["subject"]).fit()]:
+            extracted = LinDAFit.extract(result)
+            self.assertListEqual(["Intercept", "grp[T.b]", "age"], list(extracted.index))
+            np.testing.assert_array_equal(result.pvalues[extracted.index].values, extracted["pval"].values)
+            np.testing.assert_array_equal(result.bse[extracted.index].values, extracted["stde"].values)
+
+    def test_batched_matches_statsmodels(self):
+        names, coef, stde = LinDAFit.mixed_batched(self.W, self.Z, "~ grp + age", "subject")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            ref_names, ref_coef, ref_stde = LinDAFit.mixed_statsmodels(self.W, self.Z, "~ grp + age", "subject")
+        self.assertListEqual(ref_names, names)
+        np.testing.assert_allclose(coef, ref_coef, rtol=1e-3, atol=1e-4)
+        # statsmodels derives bse from the joint Hessian, the engine uses the GLS covariance (as lme4 does)
+        np.testing.assert_allclose(stde, ref_stde, rtol=3e-2)
+
+
+class LinDA_preprocessing_memory(unittest.TestCase):
+
+    def test_peak_memory_bound(self):
+        """
+        The documented bound of LinDAPrep: prepare and transform allocate at most 2x the input matrix (float64).
+        """
+        import tracemalloc
+
+        rng = np.random.default_rng(3)
+        F = rng.negative_binomial(1, 0.3, size=(6000, 200)) * (rng.random((6000, 200)) < 0.3)
+        columns = np.arange(F.shape[1])
+        input_bytes = F.size * 8
+
+        block_bytes = LinDAPrep.block_bytes
+        LinDAPrep.block_bytes = input_bytes // 32
+        try:
+            tracemalloc.start()
+            Y, keep_tax, keep_lib = LinDAPrep.prepare(F, columns, 0.1, 0, 0, 0.97, "count")
+            LinDAPrep.transform(Y, "Imputation", 0.5, "count")
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            LinDAPrep.block_bytes = block_bytes
+
+        self.assertGreater(keep_tax.sum(), 0)
+        self.assertLessEqual(peak, 2 * input_bytes, "Preprocessing exceeded 2x the input matrix")
+
+
+class LinDA_take_avg_params(unittest.TestCase):
+
+    @staticmethod
+    def peer(taxa: list, stat: list, stde: list, size: int) -> dict:
+        frame = pd.DataFrame({"base_mean": 1.0, "intercept": 0.0, "stat": stat, "stde": stde, "taxa_sums": 1.0},
+                             index=taxa)
+        return {"coefs": {"grp": frame}, "biases": {"grp": 0.0}, "formula": "~ grp", "size": size}
+
+    def setUp(self):
+        self.params = {1: self.peer(["a", "b"], [1.0, 2.0], [0.5, 1.0], 10),
+                       2: self.peer(["b", "c"], [4.0, 3.0], [2.0, 1.5], 30)}
+
+    def test_union(self):
+        avg = LinDA.take_avg_params(self.params, True)["grp"]
+        self.assertListEqual(["a", "b", "c"], list(avg.index))
+        np.testing.assert_allclose(avg["stat"].values, [1.0, (2.0 * 10 + 4.0 * 30) / 40, 3.0])
+        np.testing.assert_allclose(avg["stde"].values, [0.5, np.sqrt((1.0 * 10) ** 2 + (2.0 * 30) ** 2) / 40, 1.5])
+        np.testing.assert_allclose(avg["division"].values, avg["stat"].values / avg["stde"].values)
+
+    def test_intersection(self):
+        avg = LinDA.take_avg_params(self.params, False)["grp"]
+        self.assertListEqual(["b"], list(avg.index))
+        self.assertAlmostEqual(3.5, avg.loc["b", "stat"])
+
+
+class LinDA_mode_estimation(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        rng = np.random.default_rng(11)
+        self.X = np.column_stack([rng.normal(0.3, 1, 5000), np.r_[rng.normal(-1, 0.5, 3500), rng.normal(3, 1, 1500)],
+                                  np.r_[np.zeros(10), rng.normal(2, 1, 4990)]])
+
+    def test_shorth(self):
+        # shortest halves [1, 2, 3] and [2, 3, 4] tie, the mean of their positions selects the first one
+        np.testing.assert_array_equal([2.0], LinDA.shorth(np.array([[1.0], [2.0], [3.0], [4.0], [10.0]])))
+        np.testing.assert_array_equal([5.5, 1.5], LinDA.shorth(np.array([[5.0, 1.0], [6.0, 2.0], [20.0, 9.0]])))
+
+    def test_bandwidth(self):
+        # bw.nrd0 of R: 0.9 * min(sd, IQR / 1.34) * n^(-1/5), a constant column falls back to its absolute value
+        X = np.array([[1.0, 2.0], [2.0, 2.0], [3.0, 2.0], [4.0, 2.0], [10.0, 2.0]])
+        np.testing.assert_allclose([0.9 * 2 / 1.34 * 5 ** -0.2, 0.9 * 2 * 5 ** -0.2], LinDA.bandwidth_nrd0(X))
+
+    def test_matches_reference(self):
+        """
+        The mean-shift iterations of every column, one column after another.
+        """
+        par, iterations = LinDA.mean_shift_modeest(self.X)
+        for j in range(self.X.shape[1]):
+            x = self.X[:, j]
+            mode, bandwidth = LinDA.shorth(x[:, None])[0], LinDA.bandwidth_nrd0(x[:, None])[0]
+            for k in range(1, 1001):
+                kernel = np.exp(-0.5 * ((x - mode) / bandwidth) ** 2)
+                shifted = np.dot(x, kernel) / kernel.sum()
+                if abs(shifted / mode - 1) < np.sqrt(np.finfo(float).eps):
+                    break
+                mode = shifted
+            self.assertAlmostEqual(mode, par[j], places=10)
+            self.assertEqual(k, iterations[j])
+        # the modes of the columns: N(0.3, 1), the larger component N(-1, 0.5) of a mixture and N(2, 1)
+        np.testing.assert_allclose([0.3, -1.0, 2.0], par, atol=0.25)
+
+    def test_binned_tolerance(self):
+        bins = 1024
+        exact, iterations = LinDA.mean_shift_modeest(self.X)
+        approximate, iterations = LinDA.mean_shift_modeest(self.X, bins)
+        width = (self.X.max(axis=0) - self.X.min(axis=0)) / bins
+        self.assertTrue((np.abs(approximate - exact) <= width).all())
+
+
+class LinDA_sparse(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.cfg = smoke_config()
+        self.dense = LinDA.read_table(self.cfg["feature_table"], self.cfg["feature_index"])
+        self.sparse = LinDA.read_table(self.cfg["feature_table"], self.cfg["feature_index"], True)
+        self.meta = LinDA.read_table(self.cfg["meta_table"], self.cfg["meta_index"])
+
+    def test_read_table(self):
+        self.assertTrue(LinDA.is_sparse(self.sparse))
+        self.assertListEqual(list(self.dense.index), list(self.sparse.index))
+        self.assertListEqual(list(self.dense.columns), list(self.sparse.columns))
+        np.testing.assert_array_equal(self.dense.to_numpy(), self.sparse.sparse.to_dense().to_numpy())
+        transposed = LinDA.transpose(self.sparse)
+        self.assertTrue(LinDA.is_sparse(transposed))
+        np.testing.assert_array_equal(self.dense.T.to_numpy(), transposed.sparse.to_dense().to_numpy())
+
+    def test_row_quantiles(self):
+        rng = np.random.default_rng(3)
+        M = rng.poisson(0.3, (200, 57)) * rng.integers(1, 50, (200, 57)).astype(float)
+        for quan in [0.0, 0.5, 0.97, 1.0]:
+            np.testing.assert_array_equal(np.quantile(M, quan, axis=1),
+                                          LinDAPrep.row_quantiles(sp.sparse.csr_matrix(M), quan))
+
+    def test_sparse_matches_dense(self):
+        for options in [{}, {"winsor": False}, {"adaptive": False, "zero_handling": "Imputation"}]:
+            cfg = dict(self.cfg, **options)
+            dense = LinDA.run(self.dense, self.meta, cfg, True)
+            sparse = LinDA.run(self.sparse, self.meta, cfg, True)
+            for voi in dense.keys():
+                self.assertListEqual(list(dense[voi].index), list(sparse[voi].index))
+                for col in ["stat", "stde", "intercept", "base_mean"]:
+                    np.testing.assert_allclose(sparse[voi][col].values, dense[voi][col].values, rtol=1e-10,
+                                               atol=1e-12, err_msg="%s %s differs" % (voi, col))
+
+
+class LinDA_read_table(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(5)
+        self.table = pd.DataFrame(rng.integers(0, 100, (20, 6)), columns=["s%d" % i for i in range(6)],
+                                  index=pd.Index(["t%d" % i for i in range(20)], name="sample_name"))
+
+    @classmethod
+    def tearDownClass(self):
+        self.directory.cleanup()
+
+    def write(self, name: str, table: pd.DataFrame) -> str:
+        path = os.path.join(self.directory.name, name)
+        table.to_csv(path)
+        return path
+
+    def test_index_sniffing(self):
+        path = self.write("table.csv", self.table)
+        table = LinDA.read_table(path, dtype=np.int32)
+        self.assertEqual("sample_name", table.index.name)
+        self.assertTrue((table.dtypes == np.int32).all())
+        pd.testing.assert_frame_equal(self.table, table, check_dtype=False)
+        self.assertRaises(LindaWrongData, LinDA.read_table, path, "SampleID")
+
+    def test_compression(self):
+        for suffix in ["gz", "bz2", "xz"]:
+            path = self.write("table.csv.%s" % suffix, self.table)
+            pd.testing.assert_frame_equal(self.table, LinDA.read_table(path, "sample_name", dtype=np.int32),
+                                          check_dtype=False)
+            sparse = LinDA.read_table(path, "sample_name", True, np.int32)
+            np.testing.assert_array_equal(self.table.to_numpy(), sparse.sparse.to_dense().to_numpy())
+
+    def test_dtype_fallback(self):
+        path = self.write("proportions.csv", self.table / 100)
+        table = LinDA.read_table(path, "sample_name", dtype=np.int32)
+        self.assertTrue((table.dtypes == np.float64).all())
+        pd.testing.assert_frame_equal(self.table / 100, table)
+
+
+class LinDA_table_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = TableCache(os.path.join(self.directory.name, "cache"), 1024 ** 3)
+        rng = np.random.default_rng(9)
+        self.table = pd.DataFrame(rng.poisson(0.5, (30, 8)), columns=["s%d" % i for i in range(8)],
+                                  index=pd.Index(["t%d" % i for i in range(30)], name="ID"))
+        self.path = os.path.join(self.directory.name, "table.csv")
+        self.table.to_csv(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_roundtrip(self):
+        for sparse in [False, True]:
+            parsed = LinDA.read_table(self.path, "", sparse, np.int32, self.cache)
+            cached = LinDA.read_table(self.path, "", sparse, np.int32, self.cache)
+            self.assertEqual(LinDA.is_sparse(parsed), LinDA.is_sparse(cached))
+            pd.testing.assert_frame_equal(parsed, cached)
+        self.assertEqual(2, len(self.cache.manifest["entries"]))
+
+    def test_mixed_table(self):
+        meta = pd.DataFrame({"grp": ["a", None, "b"], "age": [1.5, 2.0, np.nan]},
+                            index=pd.Index(["s1", "s2", "s3"], name="ID"))
+        path = os.path.join(self.directory.name, "meta.csv")
+        meta.to_csv(path)
+        pd.testing.assert_frame_equal(LinDA.read_table(path, cache=self.cache), LinDA.read_table(path, cache=self.cache))
+
+    def test_shared_directory(self):
+        # a second process with an outdated manifest
+        other = TableCache(self.cache.directory, 1024 ** 3)
+        LinDA.read_table(self.path, "ID", cache=self.cache)
+        LinDA.read_table(self.path, "ID", True, cache=other)
+        # the entry written in the meantime by the first process is used
+        pd.testing.assert_frame_equal(self.table, LinDA.read_table(self.path, "ID", cache=other))
+        self.assertEqual(2, len(TableCache(self.cache.directory, 1024 ** 3).manifest["entries"]))
+        files = [name for root, dirs, names in os.walk(self.cache.directory) for name in names]
+        self.assertFalse(any(name.endswith(".pkl") for name in files))
+
+    def test_opt_in(self):
+        cfg = dict(smoke_config(), cache_dir=self.cache.directory)
+        self.assertIsNone(TableCache.from_config(cfg))
+        self.assertIsInstance(TableCache.from_config(dict(cfg, cache=True)), TableCache)
+
+    def test_invalidation(self):
+        LinDA.read_table(self.path, "ID", cache=self.cache)
+        hash_before = self.cache.file_hash(self.path)
+        os.utime(self.path, ns=(0, 0))
+        self.assertEqual(hash_before, self.cache.file_hash(self.path))
+        (self.table + 1).to_csv(self.path)
+        self.assertNotEqual(hash_before, self.cache.file_hash(self.path))
+        pd.testing.assert_frame_equal(self.table + 1, LinDA.read_table(self.path, "ID", cache=self.cache))
+
+    def test_lru_eviction(self):
+        LinDA.read_table(self.path, "ID", cache=self.cache)
+        entry = self.cache.size()
+        self.cache.max_bytes = int(2.5 * entry)
+        for sparse, dtype in [(True, None), (False, np.int32), (False, None)]:
+            LinDA.read_table(self.path, "ID", sparse, dtype, self.cache)
+            LinDA.read_table(self.path, "ID", cache=self.cache)
+        self.assertLessEqual(self.cache.size(), self.cache.max_bytes)
+        self.assertIn(self.cache.key(self.path, {"col": "ID", "sparse": False, "dtype": None}),
+                      self.cache.manifest["entries"])
+        self.cache.clear()
+        self.assertEqual(0, self.cache.size())
+        self.assertListEqual(["manifest.json"], os.listdir(self.cache.directory))
+
+
+class LinDA_out_of_core(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.cfg = smoke_config()
+        path = self.cfg["feature_table"]
+        self.feature = LinDA.read_table(path, self.cfg["feature_index"])
+        self.mapped = LinDA.read_table(path, self.cfg["feature_index"], dtype=np.int32, memmap=True)
+        self.meta = LinDA.read_table(self.cfg["meta_table"], self.cfg["meta_index"])
+
+    def test_memmap_table(self):
+        base = self.mapped.to_numpy()
+        while base.base is not None and not isinstance(base, np.memmap):
+            base = base.base
+        self.assertIsInstance(base, np.memmap)
+        np.testing.assert_array_equal(self.feature.to_numpy(), self.mapped.to_numpy())
+
+    def test_working_copy(self):
+        F = self.mapped.to_numpy()
+        columns = np.arange(F.shape[1])
+        Y, keep_tax, keep_lib = LinDAPrep.prepare(F, columns, 0.1, winsor_quantile=0.97, out_of_core=True)
+        self.assertIsInstance(Y, np.memmap)
+        reference, keep_reference, lib_reference = LinDAPrep.prepare(F, columns, 0.1, winsor_quantile=0.97)
+        np.testing.assert_array_equal(keep_reference, keep_tax)
+        np.testing.assert_array_equal(reference, Y)
+
+    def test_budget_matches_in_memory(self):
+        for options in [{}, {"adaptive": False, "zero_handling": "Imputation"}]:
+            reference = LinDA.run(self.feature, self.meta, dict(self.cfg, **options), True)
+            # 50 kB: blocks of a few taxa, the models are fitted in many blocks
+            result = LinDA.run(self.mapped, self.meta, dict(self.cfg, memory_budget=0.05, **options), True)
+            for voi in reference.keys():
+                self.assertListEqual(list(reference[voi].index), list(result[voi].index))
+                for col in ["stat", "stde", "intercept", "base_mean"]:
+                    np.testing.assert_allclose(result[voi][col].values, reference[voi][col].values, rtol=1e-10,
+                                               atol=1e-12, err_msg="%s %s differs" % (voi, col))
+        self.assertEqual(8 * 1024 * 1024, LinDAPrep.block_bytes)
+
+    def test_memmap_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "table.csv")
+            with open(path, "w") as f:
+                f.write("id,a,b\nr0,1,2\nr1,0.5,3\n")
+            # the first chunk holds integers only, the second one may not be truncated to them
+            table = LinDA.read_csv(path, "id", chunk_rows=1, memmap=True)
+            np.testing.assert_array_equal([[1.0, 2.0], [0.5, 3.0]], table.to_numpy())
+            with open(path, "w") as f:
+                f.write("id,a,b\n")
+            for sparse in [False, True]:
+                with self.assertRaises(LindaWrongData):
+                    LinDA.read_table(path, "id", sparse, dtype=np.int32, memmap=True)
+
+
+class LinDA_stage_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cfg = smoke_config(stage_cache=True, cache_dir=self.directory.name)
+        self.reference = LinDA.run_local(dict(self.cfg, stage_cache=False))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def stages(self) -> list:
+        return sorted(key.split("-")[0] for key in StageCache.from_config(self.cfg).manifest["entries"])
+
+    def assertResults(self, results: dict, reference: dict):
+        self.assertListEqual(sorted(reference.keys()), sorted(results.keys()))
+        for voi in reference.keys():
+            pd.testing.assert_frame_equal(reference[voi], results[voi])
+
+    def test_rerun(self):
+        self.assertResults(LinDA.run_local(dict(self.cfg)), self.reference)
+        self.assertListEqual(["bias", "clr", "fit", "prep"], self.stages())
+        files = [name for root, dirs, names in os.walk(self.directory.name) for name in names]
+        self.assertFalse(any(name.endswith(".pkl") for name in files))
+        self.assertResults(LinDA.run_local(dict(self.cfg)), self.reference)
+        self.assertListEqual(["bias", "clr", "fit", "prep"], self.stages())
+
+    def test_opt_in(self):
+        # the table cache does not enable the stage cache
+        cfg = smoke_config(cache=True, cache_dir=self.directory.name)
+        self.assertIsNone(StageCache.from_config(cfg))
+        LinDA.run_local(cfg)
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "stages")))
+
+    def test_late_parameters(self):
+        LinDA.run_local(dict(self.cfg))
+        # the cutoff only selects the zero handling, which stays the same here
+        self.assertResults(LinDA.run_local(dict(self.cfg, correction_cutoff=0.05)),
+                           LinDA.run_local(dict(self.cfg, correction_cutoff=0.05, stage_cache=False)))
+        self.assertListEqual(["bias", "clr", "fit", "prep"], self.stages())
+        # the pseudo count reruns everything after the preprocessing
+        self.assertResults(LinDA.run_local(dict(self.cfg, pseudo_count=1.0)),
+                           LinDA.run_local(dict(self.cfg, pseudo_count=1.0, stage_cache=False)))
+        self.assertListEqual(["bias", "bias", "clr", "clr", "fit", "fit", "prep"], self.stages())
+
+
+class LinDA_formula_batch(unittest.TestCase):
+
+    formulas: list = ["~ Smoke", "~ Smoke + Sex", "~ Smoke + Sex + Site + numervar"]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cfg = smoke_config(stage_cache=True, cache_dir=self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_batch_matches_single_runs(self):
+        for cache in [False, True]:
+            batch = LinDA.run_batch(dict(self.cfg, cache=cache, stage_cache=cache), self.formulas)
+            self.assertListEqual(self.formulas, list(batch.keys()))
+            for formula in self.formulas:
+                reference = LinDA.run_local(dict(self.cfg, formula=formula, stage_cache=False))
+                self.assertListEqual(sorted(reference.keys()), sorted(batch[formula].keys()))
+                for voi in reference.keys():
+                    pd.testing.assert_frame_equal(reference[voi], batch[formula][voi])
+
+    def test_shared_stages(self):
+        LinDA.run_batch(self.cfg, self.formulas)
+        stages = sorted(key.split("-")[0] for key in StageCache.from_config(self.cfg).manifest["entries"])
+        self.assertListEqual(["bias"] * 3 + ["clr"] + ["fit"] * 3 + ["prep"], stages)
+
+    def test_sums_of_squares(self):
+        rng = np.random.default_rng(2)
+        Z = pd.DataFrame({"grp": rng.choice(["a", "b"], 40), "age": rng.normal(size=40)})
+        W = pd.DataFrame(rng.normal(size=(40, 6)))
+        # a perfect fit, the shortcut would lose all digits
+        W[5] = 2 * Z["age"] + 1
+        reference = LinDAFit.ols_batched(W, Z, "~ grp + age")
+        shortcut = LinDAFit.ols_batched(W, Z, "~ grp + age", sumsq=(W.to_numpy() ** 2).sum(axis=0))
+        np.testing.assert_allclose(shortcut[2][:, :5], reference[2][:, :5], rtol=1e-10)
+        np.testing.assert_array_equal(shortcut[2][:, 5], reference[2][:, 5])
+
+    def test_failures(self):
+        self.assertDictEqual({}, LinDA.run_batch(dict(self.cfg, feature_table="missing.csv"), self.formulas))
+        # a formula with an unknown variable is skipped, the others are computed
+        batch = LinDA.run_sl_batch(self.cfg, ["~ unknown", self.formulas[0]])
+        self.assertListEqual([self.formulas[0]], list(batch.keys()))
+
+
+def split_tables(cfg: dict, directory: str, parts: int) -> list:
+    """
+    Splits the samples of the feature and meta table into parts, returns a configuration per part.
+    """
+    feature = pd.read_csv(cfg["feature_table"], index_col=0)
+    meta = pd.read_csv(cfg["meta_table"], index_col=0)
+    configurations = []
+    for k, samples in enumerate(np.array_split(meta.index.values, parts)):
+        part = {"feature_table": os.path.join(directory, "otu%d.csv" % k),
+                "meta_table": os.path.join(directory, "meta%d.csv" % k)}
+        feature.loc[:, samples].to_csv(part["feature_table"])
+        meta.loc[samples].to_csv(part["meta_table"])
+        configurations.append(dict(cfg, **part))
+    return configurations
+
+
+class LinDA_exact_federation(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        # sample-separable preprocessing, so the pooled fits equal the fits of the concatenated data
+        self.cfg = smoke_config(cache=False, federation="exact", winsor=False, prevalence=0, adaptive=False)
+        self.peers = split_tables(self.cfg, self.directory.name, 3)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_matches_concatenated_data(self):
+        for formula in ["~ Smoke", "~ Smoke + Sex + Site + numervar"]:
+            reference = LinDA.run_local(dict(self.cfg, formula=formula))
+            statistics = {k: LinDA.run_sl(dict(peer, formula=formula)) for k, peer in enumerate(self.peers)}
+            self.assertTrue(all(type(s) is bytes for s in statistics.values()))
+            results = LinDA.run_sl_exact(statistics, formula)
+            self.assertListEqual(list(reference.keys()), list(results.keys()))
+            for voi in reference.keys():
+                pd.testing.assert_frame_equal(reference[voi], results[voi], check_index_type=False, rtol=1e-8)
+
+    def test_payload(self):
+        payload = LinDA.run_sl(self.peers[0])
+        statistics = LinDAFederation.decode(payload)
+        p, m = statistics["xtw"].shape
+        self.assertEqual((p, p), statistics["xtx"].shape)
+        self.assertEqual(m, len(statistics["taxa"]))
+        self.assertNotIn(b"pandas", payload)
+
+    def test_batch_payload(self):
+        formulas = ["~ Smoke", "~ Smoke + Sex"]
+        batch = LinDA.run_sl_batch(self.peers[0], formulas)
+        payload = LinDAFederation.encode_batch(batch)
+        self.assertNotIn(b"pandas", payload)
+        self.assertEqual(batch, LinDAFederation.decode_batch(payload))
+
+    def test_random_effects_rejected(self):
+        self.assertRaises(LindaInternalError, LinDA.run_sl, dict(self.peers[0], formula="~ Smoke + (1|SubjectID)"))
+
+
+class LinDA_incremental(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cfg = smoke_config(cache=False, winsor=False, prevalence=0, adaptive=False,
+                                state=os.path.join(self.directory.name, "state.npz"))
+        self.batches = split_tables(self.cfg, self.directory.name, 2)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_matches_run_on_all_samples(self):
+        first, report = LinDA.run_incremental(self.batches[0])
+        reference = LinDA.run_local(self.batches[0])
+        for voi in reference.keys():
+            pd.testing.assert_frame_equal(reference[voi], first[voi], check_index_type=False, rtol=1e-8)
+        results, report = LinDA.run_incremental(self.batches[1])
+        self.assertListEqual([], report)
+        reference = LinDA.run_local(self.cfg)
+        self.assertListEqual(list(reference.keys()), list(results.keys()))
+        for voi in reference.keys():
+            pd.testing.assert_frame_equal(reference[voi], results[voi], check_index_type=False, rtol=1e-8)
+
+    def test_staleness_report(self):
+        batches = [dict(cfg, winsor=True, adaptive=True) for cfg in self.batches]
+        results, report = LinDA.run_incremental(batches[0])
+        self.assertListEqual([], report)
+        results, report = LinDA.run_incremental(batches[1])
+        self.assertTrue(len(results))
+        stages = set((entry["stage"], entry["batch"]) for entry in report)
+        self.assertIn(("winsorization", 0), stages)
+        self.assertIn(("winsorization", 1), stages)
+        self.assertIn(("zero handling", 1), stages)
+
+    def test_rejects_known_samples_and_changed_settings(self):
+        LinDA.run_incremental(self.batches[0])
+        state = open(self.cfg["state"], "rb").read()
+        self.assertDictEqual({}, LinDA.run_incremental(self.batches[0])[0])
+        self.assertDictEqual({}, LinDA.run_incremental(dict(self.batches[1], pseudo_count=1.0))[0])
+        self.assertEqual(state, open(self.cfg["state"], "rb").read())
+
+    def test_failure_keeps_state(self):
+        LinDA.run_incremental(self.batches[0])
+        state = open(self.cfg["state"], "rb").read()
+        # the mode estimation fails after the statistics of the batch were added to the state
+        self.assertDictEqual({}, LinDA.run_incremental(dict(self.batches[1], modeest_bins="x"))[0])
+        self.assertEqual(state, open(self.cfg["state"], "rb").read())
+        results, report = LinDA.run_incremental(self.batches[1])
+        self.assertTrue(len(results))
+
+
+class LinDA_profile(unittest.TestCase):
+
+    def setUp(self):
+        self.cfg = smoke_config(cache=False)
+
+    def tearDown(self):
+        LinDAProfiler.disable()
+
+    def test_stages(self):
+        LinDAProfiler.enable()
+        results = LinDA.run_local(self.cfg)
+        profiler = LinDAProfiler.disable()
+        self.assertTrue(len(results))
+        summary = profiler.summary()
+        for stage in ["read table", "preprocessing", "filtering", "winsorization", "adaptive test", "zero handling",
+                      "clr", "fit", "bias correction", "output"]:
+            self.assertIn(stage, summary)
+            self.assertGreaterEqual(summary[stage]["wall"], 0)
+            self.assertGreaterEqual(summary[stage]["peak_bytes"], 0)
+        self.assertEqual((2156, 145), (summary["preprocessing"]["rows"], summary["preprocessing"]["columns"]))
+        nested = [r for r in profiler.records if r["stage"] == "winsorization"]
+        self.assertEqual("preprocessing", nested[0]["parent"])
+        self.assertGreaterEqual(summary["preprocessing"]["peak_bytes"], summary["filtering"]["peak_bytes"])
+
+    def test_disabled(self):
+        with LinDAProfiler.stage("fit") as stage:
+            stage["rows"] = 5
+        with LinDAProfiler.stage("output") as stage:
+            self.assertDictEqual({}, stage)
+        self.assertIsNone(LinDAProfiler.disable())
+
+    def test_averaging(self):
+        LinDAProfiler.enable(memory=False)
+        params = {"coefs": {"x": pd.DataFrame({"stat": [1.0, 2.0], "stde": [1.0, 1.0]}, index=["a", "b"])},
+                  "size": 10}
+        LinDA.take_avg_params({0: params, 1: params})
+        record = LinDAProfiler.disable().records[0]
+        self.assertEqual(("averaging", 2, 2), (record["stage"], record["rows"], record["columns"]))
+        self.assertNotIn("peak_bytes", record)
+
+
+class LinDA_synthetic(unittest.TestCase):
+
+    def test_generator(self):
+        feature, meta, differential = SyntheticData.generate(300, 80, sparsity=0.6, covariates=2, seed=1)
+        self.assertEqual((300, 80), feature.shape)
+        self.assertListEqual(["grp", "cov1", "cov2"], list(meta.columns))
+        self.assertListEqual(list(feature.columns), list(meta.index))
+        self.assertAlmostEqual(0.6, (feature.to_numpy() == 0).mean(), places=3)
+        self.assertEqual(30, len(differential))
+        again = SyntheticData.generate(300, 80, sparsity=0.6, covariates=2, seed=1)
+        pd.testing.assert_frame_equal(feature, again[0])
+
+    def test_recovers_differential_taxa(self):
+        feature, meta, differential = SyntheticData.generate(300, 80, sparsity=0.3, covariates=1, seed=1)
+        with tempfile.TemporaryDirectory() as directory:
+            cfg = dict(Config(None, None, check_sanity=False).get()["LINDA"], formula="~ grp + cov1", cache=False,
+                       **SyntheticData.write(directory, feature, meta))
+            results = LinDA.run_local(cfg)["grp[T.control]"]
+        rejects = set(results.index[results["reject"]])
+        self.assertGreaterEqual(len(rejects & set(differential)), 0.8 * len(differential))
+        self.assertLessEqual(len(rejects - set(differential)), 0.1 * len(rejects))
+
+    def test_split(self):
+        feature, meta, differential = SyntheticData.generate(50, 30, seed=2)
+        parts = SyntheticData.split(feature, meta, 3)
+        self.assertEqual(30, sum(len(m) for f, m in parts))
+        for f, m in parts:
+            self.assertListEqual(list(f.columns), list(m.index))
+
+
+class LinDA_wire(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {1: LinDA_take_avg_params.peer(["a", "b"], [1.0, 2.0], [0.5, 1.0], 10),
+                       2: LinDA_take_avg_params.peer(["b", "c"], [4.0, 3.0], [2.0, 1.5], 30)}
+        self.params[1]["coefs"]["age"] = self.params[1]["coefs"]["grp"].iloc[::-1] * 3
+        self.params[1]["biases"]["age"] = 0.25
+
+    def test_round_trip(self):
+        reference = LinDA.take_avg_params(self.params)
+        for precision, rtol in [("float64", 0), ("float32", 1e-7)]:
+            decoded = {k: LinDAWire.decode(LinDAWire.encode(p, precision)) for k, p in self.params.items()}
+            for k in self.params.keys():
+                self.assertDictEqual(self.params[k]["biases"], decoded[k]["biases"])
+                self.assertEqual(self.params[k]["formula"], decoded[k]["formula"])
+                self.assertEqual(self.params[k]["size"], decoded[k]["size"])
+                for voi, frame in self.params[k]["coefs"].items():
+                    pd.testing.assert_frame_equal(frame, decoded[k]["coefs"][voi], check_dtype=False, rtol=rtol)
+            averaged = LinDA.take_avg_params(decoded)
+            for voi in reference.keys():
+                pd.testing.assert_frame_equal(reference[voi], averaged[voi], check_dtype=False, rtol=rtol)
+
+    def test_layout(self):
+        payload = LinDAWire.encode(self.params[1])
+        schema = LinDAWire.schema(payload)
+        self.assertListEqual(["a", "b"], schema["taxa"])
+        variables = schema["models"][0]["variables"]
+        # the reversed taxa of age are stored as codes of the dictionary
+        self.assertListEqual([False, True], [v["coded"] for v in variables])
+        self.assertNotIn(b"pandas", payload)
+        self.assertEqual(8, schema["itemsize"])
+        self.assertEqual(4, LinDAWire.schema(LinDAWire.encode(self.params[1], "float32"))["itemsize"])
+
+        decoded = LinDAWire.decode(payload)
+        self.assertTrue(np.shares_memory(decoded["coefs"]["grp"].to_numpy(), np.frombuffer(payload, np.uint8)))
+        self.assertListEqual(["grp"], list(LinDAWire.decode(payload, ["grp"])["coefs"].keys()))
+
+    def test_batch(self):
+        batch = {"~ grp": self.params[1], "~ grp + age": self.params[2]}
+        decoded = LinDAWire.decode(LinDAWire.encode_batch(batch))
+        self.assertListEqual(list(batch.keys()), list(decoded.keys()))
+        for formula in batch.keys():
+            self.assertEqual(formula, decoded[formula]["formula"])
+            for voi, frame in batch[formula]["coefs"].items():
+                pd.testing.assert_frame_equal(frame, decoded[formula]["coefs"][voi])
+
+    def test_malformed(self):
+        payload = LinDAWire.encode(self.params[1])
+        self.assertRaises(LindaWrongData, LinDAWire.decode, b"GLWX" + payload[4:])
+        self.assertRaises(LindaWrongData, LinDAWire.decode, payload[:len(payload) - 8])
+        self.assertRaises(LindaWrongData, LinDAWire.encode, self.params[1], "float16")
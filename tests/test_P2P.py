@@ -1,23 +1,34 @@
 import timeout_decorator
 import unittest
+import socket
+import struct
 import sys
+import zlib
 
 from multiprocessing import Process, Manager
 from pickle import dumps, loads
-from random import randint
+from random import randint, Random
+from threading import Event, Thread
 
 sys.path.insert(1, "../")
 
-from gLinDA.lib.p2p import P2P, Runner, EncryptionAsymmetric, EncryptionSymmetric, Keyring
-from gLinDA.lib.p2p_pkg import P2PPackage, P2PCollector
+from gLinDA.lib.p2p_client import Client
+from gLinDA.lib.p2p_server import Server
+from gLinDA.lib.p2p import P2P, Runner, Compression, EncryptionAsymmetric, EncryptionSymmetric, Envelope, Keyring
+from gLinDA.lib.errors import GlindaP2PProtocolError
+from gLinDA.lib.p2p_pkg import P2PPackage, P2PCollector, P2PFrameReader
 from gLinDA.lib.p2p_test import P2PTester
 
 
 class SimulatePeers(unittest.TestCase):
 
+    def setUp(self):
+        # the keyring is shared by all instances, the simulated peers must not inherit keys of previous tests
+        Keyring.reset()
+
     @timeout_decorator.timeout(300)
-    def simulate_peers(self, peers: int, rsa: bool = False):
-        general_param: dict = {"password": "Test", "verbose": 3, "asymmetric": rsa}
+    def simulate_peers(self, peers: int, rsa: bool = False, transport: str = "threads"):
+        general_param: dict = {"password": "Test", "verbose": 3, "asymmetric": rsa, "transport": transport}
         configs = P2PTester.configuration_generator(peers, general_param)
         manager: Manager = Manager()
         bucket_list = manager.list()
@@ -38,13 +49,14 @@ class SimulatePeers(unittest.TestCase):
         Test whether binaries were correctly loaded.
         :return:
         """
-        blen: int = 3
-        full_package: bytes = (int(9199).to_bytes(blen, "big") + int(1).to_bytes(blen, "big")
-                               + "Hello World!".encode("utf8") + "END:".encode("utf8")
-                               + int(9199).to_bytes(blen, "big"))
-        full_pkg = P2PPackage(blen, 0)
-        full_pkg.load(full_package)
+        payload: bytes = "Hello World!".encode("utf8")
+        full_package: bytes = struct.pack("!2sBBIIIII", b"GL", 3, 1, 9199, 1, 1, len(payload),
+                                          zlib.crc32(payload)) + payload
+        full_pkg = P2PPackage(3, 0)
+        self.assertTrue(full_pkg.load(full_package))
         self.assertEqual(full_pkg.get_payload().decode("utf8"), "Hello World!", "Single P2PPackage payload is wrong")
+        self.assertTrue(full_pkg.get_stop())
+        self.assertFalse(P2PPackage(3, 0).load(full_package[:-1]), "Truncated P2PPackage was loaded")
 
     def test_manual_build_multi_packages(self):
         """
@@ -53,11 +65,11 @@ class SimulatePeers(unittest.TestCase):
         """
         blen: int = 3
         ident = 45423
-        partial_package_1: bytes = (int(ident).to_bytes(blen, "big") + int(1).to_bytes(blen, "big")
-                                    + "Hello".encode("utf8") + int(ident).to_bytes(blen, "big"))
-        partial_package_2: bytes = (int(ident).to_bytes(blen, "big") + int(2).to_bytes(blen, "big")
-                                    + " World!".encode("utf8") + "END:".encode("utf8")
-                                    + int(ident).to_bytes(blen, "big"))
+        part_1, part_2 = "Hello".encode("utf8"), " World!".encode("utf8")
+        partial_package_1: bytes = struct.pack("!2sBBIIIII", b"GL", 3, 0, ident, 1, 1, len(part_1),
+                                               zlib.crc32(part_1)) + part_1
+        partial_package_2: bytes = struct.pack("!2sBBIIIII", b"GL", 3, 1, ident, 1, 2, len(part_2),
+                                               zlib.crc32(part_2)) + part_2
         pkg1 = P2PPackage(blen, 2)
         pkg1.load(partial_package_1)
         pkg2 = P2PPackage(blen, 2)
@@ -69,6 +81,11 @@ class SimulatePeers(unittest.TestCase):
         self.assertEqual(collector.get_payload(ident).decode("utf8"),
                          "Hello World!", "The combined packages are not matching")
 
+    def test_build_empty_payload(self):
+        packages = P2PPackage.build_packages(3, 1024, 42, b"")
+        self.assertEqual(len(packages), 1)
+        self.assertTrue(packages[0].get_stop())
+
     def test_build_and_read(self):
         raw_bucket: dict = {randint(100,499): b'', randint(500, 999): b''}
         pkg_bucket: dict = {}
@@ -124,6 +141,284 @@ class SimulatePeers(unittest.TestCase):
 
         self.assertTrue(similar, "After creating, encrypting and reassembling packages, the bytes differs")
 
+    def test_stream_packages(self):
+        """
+        Test whether frames streamed over one connection are reassembled, independent of the segmentation of the
+        stream.
+        """
+        ident = 4711
+        payload = dumps(P2PTester.get_dump_data(2000))
+        stream = b"".join(p.build_binary_package() for p in P2PPackage.build_packages(3, 1024, ident, payload))
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            thread = Thread(target=lambda: [sender.sendall(stream[i:i + 777]) for i in range(0, len(stream), 777)])
+            thread.start()
+            collection = P2PCollector(3, 0, 1)
+            reader = P2PFrameReader(1024)
+            while not collection.is_finished():
+                collection.load(reader.read(receiver))
+            thread.join()
+        self.assertEqual(payload, collection.get_payload(ident))
+
+    def test_fuzz_frame_reader(self):
+        """
+        Fuzzes the frame reader with randomly fragmented and coalesced reads of several interleaved payloads.
+        """
+        class Stream:
+            def __init__(self, data: bytes, seed: int):
+                self.data = memoryview(data)
+                self.position = 0
+                self.random = Random(seed)
+
+            def recv_into(self, view, nbytes: int = 0):
+                # fragments (single bytes) as well as reads spanning several frames of the sender
+                n = min(len(view), len(self.data) - self.position, self.random.choice([1, 7, 20, 500, 5000, 1 << 20]))
+                view[:n] = self.data[self.position:self.position + n]
+                self.position += n
+                return n
+
+        for seed in range(20):
+            generator = Random(seed)
+            payloads = {ident: generator.randbytes(generator.randint(0, 5000)) for ident in [11, 222, 3333]}
+            queues = [P2PPackage.build_packages(3, generator.randint(1, 700), ident, payload)
+                      for ident, payload in payloads.items()]
+            # interleaves the payloads, the frames of a payload keep their order (as on a connection)
+            frames = []
+            while any(queues):
+                frames.append(generator.choice([q for q in queues if len(q)]).pop(0))
+            stream = Stream(b"".join(p.build_binary_package() for p in frames), seed)
+            reader = P2PFrameReader(700)
+            collection = P2PCollector(3, 0, len(payloads))
+            while not collection.is_finished():
+                collection.load(reader.read(stream))
+            self.assertIsNone(reader.read(stream), "Frames after the end of the stream")
+            for ident, payload in payloads.items():
+                self.assertEqual(payload, collection.get_payload(ident), "Seed %d: payload %d differs" % (seed, ident))
+
+    def test_damaged_frames(self):
+        frame = bytearray(P2PPackage.build_packages(3, 1024, 42, b"Hello World!")[0].build_binary_package())
+        reader = P2PFrameReader(1024)
+        a, b = socket.socketpair()
+        with a, b:
+            corrupted = bytearray(frame)
+            corrupted[-1] ^= 0xFF
+            a.sendall(corrupted)
+            with self.assertRaises(GlindaP2PProtocolError):
+                reader.read(b)
+            a.sendall(b"XX" + frame[2:])
+            with self.assertRaises(GlindaP2PProtocolError):
+                reader.read(b)
+        with self.assertRaises(GlindaP2PProtocolError):
+            a, b = socket.socketpair()
+            with a, b:
+                a.sendall(frame)
+                P2PFrameReader(8).read(b)
+
+    def test_concurrent_send_with_retry(self):
+        """
+        Test whether a payload is delivered to all peers, while one of them drops the first connection.
+        """
+        listeners = [socket.create_server(("127.0.0.1", 0)) for _ in range(2)]
+        peers = ["127.0.0.1:%d" % listener.getsockname()[1] for listener in listeners]
+        config = P2PTester.configuration_generator(2, {"password": "T35T", "verbose": 0, "asymmetric": False})[0]
+        config.update({"peers": peers})
+        keyring = Keyring()
+        client = Client(config, keyring)
+        encryption = EncryptionSymmetric(config)
+        aes_key = encryption.get_key("T35T", True)
+        for k, peer in enumerate(peers, 1):
+            keyring.add_peer(peer, (k, aes_key), False)
+            keyring.set_chunk_size(peer, P2P.min_chunk_size)
+
+        def receive(listener, drop: bool, received: list):
+            with listener:
+                while True:
+                    conn, _ = listener.accept()
+                    with conn:
+                        reader, collection = P2PFrameReader(P2P.min_chunk_size), P2PCollector(3, 0, 1)
+                        while not collection.is_finished():
+                            collection.load(reader.read(conn))
+                            if drop:
+                                break
+                        if not drop:
+                            conn.sendall(P2P.ack)
+                            received.append(collection.get_payload(list(collection.identifiers)[0]))
+                            return
+                        drop = False
+
+        received = [[], []]
+        threads = [Thread(target=receive, args=(listeners[k], k == 0, received[k]), daemon=True) for k in range(2)]
+        [t.start() for t in threads]
+        payload = dumps(P2PTester.get_dump_data(20000))
+        progress = client.send_payload(payload)
+        [t.join(10) for t in threads]
+
+        for k in range(2):
+            self.assertEqual(payload, Envelope.open(received[k][0], aes_key))
+            self.assertEqual(progress[peers[k]]["state"], "done")
+        self.assertEqual(progress[peers[0]]["attempts"], 2)
+        self.assertEqual(progress[peers[1]]["attempts"], 1)
+
+    def test_send_to_busy_peer(self):
+        """
+        Test whether waiting for a peer that keeps rejecting the payload (NAK) ends after the timeout.
+        """
+        listener = socket.create_server(("127.0.0.1", 0))
+        peer = "127.0.0.1:%d" % listener.getsockname()[1]
+        config = P2PTester.configuration_generator(2, {"password": "T35T", "verbose": 0, "asymmetric": False})[0]
+        config.update({"peers": [peer], "timeout": 1})
+        keyring = Keyring()
+        client = Client(config, keyring)
+        keyring.add_peer(peer, (1, EncryptionSymmetric(config).get_key("T35T", True)), False)
+        keyring.set_chunk_size(peer, P2P.min_chunk_size)
+        stop = Event()
+
+        def reject():
+            listener.settimeout(0.1)
+            with listener:
+                while not stop.is_set():
+                    try:
+                        conn, _ = listener.accept()
+                    except socket.timeout:
+                        continue
+                    with conn:
+                        reader, collection = P2PFrameReader(P2P.min_chunk_size), P2PCollector(3, 0, 1)
+                        while not collection.is_finished():
+                            collection.load(reader.read(conn))
+                        conn.sendall(P2P.nak)
+
+        thread = Thread(target=reject, daemon=True)
+        thread.start()
+        try:
+            progress = client.send_payload(dumps(P2PTester.get_dump_data(100)))
+        finally:
+            stop.set()
+            thread.join(10)
+        self.assertEqual(progress[peer]["state"], "failed")
+        self.assertEqual(progress[peer]["attempts"], P2P.send_retries + 1)
+
+    def test_concurrent_reception(self):
+        """
+        Test whether the server serves several connections at the same time: the payloads are completed in the
+        reverse order of the connections, a server serving one connection after another would wait forever.
+        """
+        with socket.create_server(("127.0.0.1", 0)) as probe:
+            host = "127.0.0.1:%d" % probe.getsockname()[1]
+        identifiers = [101, 202, 303]
+        config = P2PTester.configuration_generator(2, {"password": "T35T", "verbose": 0, "asymmetric": False})[0]
+        config.update({"host": host, "peers": ["127.0.0.1:%d" % (60000 + i) for i in identifiers]})
+        keyring = Keyring()
+        encryption = EncryptionSymmetric(config)
+        aes_key = encryption.get_key("T35T", True)
+        for identifier in identifiers:
+            keyring.add_peer(identifier, aes_key, True)
+
+        results, server_ready = {}, Event()
+        thread = Thread(target=Server, args=(config, keyring, False, results, server_ready), daemon=True)
+        thread.start()
+        server_ready.wait()
+
+        payloads = {identifier: dumps(P2PTester.get_dump_data(100 * identifier)) for identifier in identifiers}
+
+        def envelope(payload: bytes) -> bytes:
+            session_key, body = Envelope.seal(payload)
+            return Envelope.wrap(session_key, aes_key) + body
+
+        packages = {identifier: P2PPackage.build_packages(3, P2P.min_chunk_size, identifier,
+                                                          envelope(payloads[identifier]))
+                    for identifier in identifiers}
+        connections = [socket.create_connection(("127.0.0.1", int(host.split(":")[1])), timeout=10)
+                       for _ in identifiers]
+        try:
+            for conn, identifier in zip(connections, identifiers):
+                conn.sendall(packages[identifier][0].build_binary_package())
+            for conn, identifier in reversed(list(zip(connections, identifiers))):
+                for pkg in packages[identifier][1:]:
+                    conn.sendall(pkg.build_binary_package())
+                self.assertEqual(conn.recv(1), P2P.ack)
+        finally:
+            [conn.close() for conn in connections]
+        thread.join(10)
+
+        self.assertEqual(payloads, results)
+
+    def test_rounds(self):
+        """
+        Test whether the server acknowledges payloads sent again after a lost acknowledgement (of this or a former
+        round) without collecting them and rejects the payload of a later round.
+        """
+        with socket.create_server(("127.0.0.1", 0)) as probe:
+            host = "127.0.0.1:%d" % probe.getsockname()[1]
+        identifiers = [101, 202]
+        config = P2PTester.configuration_generator(2, {"password": "T35T", "verbose": 0, "asymmetric": False})[0]
+        config.update({"host": host, "peers": ["127.0.0.1:%d" % (60000 + i) for i in identifiers]})
+        keyring = Keyring()
+        aes_key = EncryptionSymmetric(config).get_key("T35T", True)
+        for identifier in identifiers:
+            keyring.add_peer(identifier, aes_key, True)
+        keyring.next_round()
+        self.assertEqual(keyring.next_round(), 2)
+
+        results, server_ready = {}, Event()
+        thread = Thread(target=Server, args=(config, keyring, False, results, server_ready), daemon=True)
+        thread.start()
+        server_ready.wait()
+
+        def send(identifier: int, round: int) -> bytes:
+            session_key, body = Envelope.seal(b"%d in round %d" % (identifier, round))
+            packages = P2PPackage.build_packages(3, P2P.min_chunk_size, identifier,
+                                                 Envelope.wrap(session_key, aes_key) + body, 0, round)
+            with socket.create_connection(("127.0.0.1", int(host.split(":")[1])), timeout=10) as conn:
+                for pkg in packages:
+                    conn.sendall(pkg.build_binary_package())
+                return conn.recv(1)
+
+        self.assertEqual(send(101, 3), P2P.nak)
+        self.assertEqual(send(101, 1), P2P.ack)
+        self.assertEqual(send(101, 2), P2P.ack)
+        self.assertEqual(send(101, 2), P2P.ack)
+        self.assertEqual(send(202, 2), P2P.ack)
+        thread.join(10)
+
+        self.assertEqual({101: b"101 in round 2", 202: b"202 in round 2"}, results)
+
+    def test_envelope(self):
+        payload = dumps(P2PTester.get_dump_data(20000))
+        session_key, body = Envelope.seal(payload)
+        # the payload is encrypted once, the envelopes of the peers only differ in the wrapped session key
+        aes_keys = [EncryptionSymmetric({"verbose": 0}).get_key("T35T%d" % k, True) for k in range(2)]
+        envelopes = [Envelope.wrap(session_key, aes_key) + body for aes_key in aes_keys]
+        self.assertEqual(envelopes[0][-len(body):], envelopes[1][-len(body):])
+        self.assertEqual(payload, Envelope.open(envelopes[1], aes_keys[1]))
+        self.assertIsNone(Envelope.open(envelopes[1], aes_keys[0]))
+
+        # RSA is not limited by the size of the payload
+        private_key, public_key = EncryptionAsymmetric.get_key(verbose=False)
+        self.assertGreater(len(payload), 190)
+        self.assertEqual(payload, Envelope.open(Envelope.wrap(session_key, public_key, True) + body, private_key, True))
+
+        tampered = bytearray(envelopes[0])
+        tampered[-1] ^= 1
+        self.assertIsNone(Envelope.open(bytes(tampered), aes_keys[0]))
+
+    def test_compression(self):
+        payload = dumps(P2PTester.get_dump_data(2000))
+        for codec in Compression.available():
+            compressed = Compression.compress(payload, codec, 9)
+            self.assertEqual(compressed[0], Compression.codecs[codec])
+            self.assertEqual(payload, Compression.decompress(compressed), "Codec %s differs" % codec)
+        self.assertLess(len(Compression.compress(payload, "zlib")), len(payload))
+        with self.assertRaises(GlindaP2PProtocolError):
+            Compression.decompress(b"\xff" + payload)
+
+    def test_compression_negotiation(self):
+        everything = Compression.mask()
+        without_lzma = everything & ~(1 << Compression.codecs["lzma"])
+        self.assertEqual(Compression.choose("lzma", [everything, everything]), "lzma")
+        self.assertEqual(Compression.choose("lzma", [everything, without_lzma]), "zlib")
+        self.assertEqual(Compression.choose("bz2", [1 << Compression.codecs["none"]]), "none")
+        self.assertEqual(Compression.choose("none", [everything]), "none")
+
     def test_peer2peer_002n(self):
         self.assertTrue(P2PTester.expected_answers(self.simulate_peers(2), 2))
 
@@ -153,3 +448,12 @@ class SimulatePeers(unittest.TestCase):
 
     def test_peer2peer_008n_rsa(self):
         self.assertTrue(P2PTester.expected_answers(self.simulate_peers(8, True), 8))
+
+    def test_peer2peer_004n_asyncio(self):
+        self.assertTrue(P2PTester.expected_answers(self.simulate_peers(4, False, "asyncio"), 4))
+
+    def test_peer2peer_008n_asyncio(self):
+        self.assertTrue(P2PTester.expected_answers(self.simulate_peers(8, False, "asyncio"), 8))
+
+    def test_peer2peer_004n_rsa_asyncio(self):
+        self.assertTrue(P2PTester.expected_answers(self.simulate_peers(4, True, "asyncio"), 4))